@@ -0,0 +1,145 @@
+"""
+识别项与OCR行的内存/构造时间对比：原来的 dict 行 + 普通对象 vs OcrPage 列式页面 + __slots__ SingleItem
+
+    python benchmark/bench_item_model.py [--repeat 50] [--json]
+
+样本：resource/ 下的pdf（读取文本层得到与OCR结果相同字段的行）以及 result/ 下手写单据的识别项
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import fitz
+
+from data_preprocess import extract_text_layer, text_layer_to_ocr
+from fuzzy_match.item import SingleItem
+from fuzzy_match.ocr_page import OcrPage
+
+RESOURCE_DIR = 'resource'
+RESULT_DIR = 'result'
+
+
+class LegacyItem:
+    """改动前 fuzzy_match_print.SingleItem 的结构（实例属性存放在 __dict__ 中）"""
+    def __init__(self):
+        self.product_id = None
+        self.matched_name = None
+        self.origin_input = None
+        self.quantity = None
+        self.match_score = -1
+        self.ocr_score = -1
+        self.box = None
+        self.ocr_text = ''
+        self.final_text = ''
+        self.warning = None
+        self.error = None
+        self.ocr_warning = None
+        self.ocr_error = None
+        self.price = None
+        self.total_price = None
+        self.unit = None
+        self.product_name = None
+        self.row_text = None
+        self.page_index = -1
+
+
+def load_samples():
+    """返回 save_to_json 格式的OCR结果列表"""
+    samples = list()
+    for name in sorted(os.listdir(RESOURCE_DIR)):
+        if not name.endswith('.pdf'):
+            continue
+        with fitz.open(os.path.join(RESOURCE_DIR, name)) as doc:
+            for page in doc:
+                lines, _ = extract_text_layer(page)
+                if lines is not None:
+                    samples.append(text_layer_to_ocr(lines, 300, name))
+    for name in sorted(os.listdir(RESULT_DIR)):
+        with open(os.path.join(RESULT_DIR, name), 'r', encoding='utf-8') as f:
+            output = json.load(f)
+        texts = [(item['origin_input'] or '') + (item['quantity'] or '') for item in output['items']]
+        samples.append(dict(rec_texts=texts, rec_scores=[0.9] * len(texts),
+                            rec_boxes=[[10, 100 * i, 300, 100 * i + 60] for i in range(len(texts))]))
+    return samples
+
+
+def legacy_rows(ocr_result):
+    return [dict(text=text, score=score, box=box) for text, score, box in
+            zip(ocr_result['rec_texts'], ocr_result['rec_scores'], ocr_result['rec_boxes'])]
+
+
+def legacy_items(ocr_result):
+    items = list()
+    for text, score, box in zip(ocr_result['rec_texts'], ocr_result['rec_scores'], ocr_result['rec_boxes']):
+        item = LegacyItem()
+        item.ocr_text, item.ocr_score, item.box = text, score, box
+        items.append(item)
+    return items
+
+
+def slots_items(ocr_result):
+    items = list()
+    for text, score, box in zip(ocr_result['rec_texts'], ocr_result['rec_scores'], ocr_result['rec_boxes']):
+        item = SingleItem()
+        item.ocr_text, item.ocr_score, item.box = text, score, box
+        items.append(item)
+    return items
+
+
+def measure(build, samples, repeat):
+    """返回 (每个token的内存字节数, 每个token的构造时间微秒)，输入数据本身不计入内存"""
+    tokens = sum(len(sample['rec_texts']) for sample in samples) * repeat
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [build(sample) for _ in range(repeat) for sample in samples]
+    memory = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del kept
+
+    # 计时取3轮中最快的一轮
+    elapsed = float('inf')
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for sample in samples:
+                build(sample)
+        elapsed = min(elapsed, time.perf_counter() - start)
+    return memory / tokens, elapsed / tokens * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--json', action='store_true', help='以JSON输出')
+    args = parser.parse_args()
+
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    samples = load_samples()
+    cases = [
+        ('rows: dict per token', legacy_rows),
+        ('rows: OcrPage', OcrPage.from_result),
+        ('items: __dict__ object', legacy_items),
+        ('items: __slots__ SingleItem', slots_items),
+    ]
+    results = list()
+    for name, build in cases:
+        bytes_per_token, us_per_token = measure(build, samples, args.repeat)
+        results.append(dict(case=name, bytes_per_token=round(bytes_per_token, 1), us_per_token=round(us_per_token, 3)))
+
+    if args.json:
+        print(json.dumps(dict(tokens=sum(len(s['rec_texts']) for s in samples), repeat=args.repeat, results=results),
+                         ensure_ascii=False, indent=4))
+        return
+    print(f"samples: {len(samples)} pages, {sum(len(s['rec_texts']) for s in samples)} tokens, repeat {args.repeat}")
+    print(f"{'case':<30}{'bytes/token':>14}{'us/token':>12}")
+    for result in results:
+        print(f"{result['case']:<30}{result['bytes_per_token']:>14}{result['us_per_token']:>12}")
+
+
+if __name__ == '__main__':
+    main()
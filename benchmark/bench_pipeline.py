@@ -0,0 +1,268 @@
+"""
+匹配流程各阶段耗时：回放样本单据的OCR结果，按需放大页数/行数/订单资料规模，不需要PaddleOCR与n8n，只用CPU
+
+    python benchmark/bench_pipeline.py [--pages 20] [--rows 1000] [--skus 0] [--repeat 3] [--json] [--font 字体]
+
+样本：resource/ 下的pdf（文本层结果与OCR结果字段相同，见 data_preprocess.text_layer_to_ocr），
+result/ 下手写单据的识别项拼回OCR行；图像为 resource/ 下的pdf页面与 1-3.jpg
+放大方式：
+    --pages  打印体单据的页数，第一页之后循环使用样本的表格页
+    --rows   手写单据的总行数，超出样本的行随机替换一个字，避免全部命中查询缓存
+    --skus   订单资料的品号数，超出的品号由已有品名随机替换字生成并写成临时xlsx；0为原始订单资料
+每个阶段取 --repeat 轮中最快的一轮，阶段间的缓存（订单资料、查询缓存）按阶段需要清空
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import contextlib
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pandas as pd
+
+# pymupdf 以 fitz 导入时向stdout打印弃用提示，--json 时stdout只输出结果
+with contextlib.redirect_stdout(sys.stderr):
+    import fitz
+    from data_preprocess import render_page, text_layer_to_ocr
+from fuzzy_match import base, catalog
+from fuzzy_match import FuzzyMatchHandwriting, FuzzyMatchPrint
+from fuzzy_match.fuzzy_match_handwriting import split_ocr_row
+from fuzzy_match.fuzzy_match_print import NameIndex
+from fuzzy_match.memo import get_query_memo
+
+RESOURCE_DIR = 'resource'
+RESULT_DIR = 'result'
+HANDWRITING_IMAGES = ['1.jpg', '2.jpg', '3.jpg']
+SEED = 0
+
+
+def load_print_documents(src_dir):
+    """pdf逐页渲染（与预处理相同的DPI选择）并取文本层，返回 [(图像路径列表, OCR结果列表)]"""
+    documents = list()
+    for name in sorted(os.listdir(RESOURCE_DIR)):
+        if not name.endswith('.pdf'):
+            continue
+        src_list, pages = list(), list()
+        with fitz.open(os.path.join(RESOURCE_DIR, name)) as doc:
+            for i, page in enumerate(doc):
+                pix, dpi, lines = render_page(page)
+                if lines is None:
+                    continue
+                image_path = os.path.join(src_dir, f'{os.path.splitext(name)[0]}_{i}.png')
+                pix.save(image_path)
+                src_list.append(image_path)
+                pages.append(text_layer_to_ocr(lines, dpi, image_path))
+        if pages:
+            documents.append((src_list, pages))
+    return documents
+
+
+def load_handwriting_rows():
+    """result/ 下手写单据（非pdf）的识别项拼回 品名+数量+单位 的OCR文字"""
+    texts = list()
+    for name in sorted(os.listdir(RESULT_DIR)):
+        if not os.path.splitext(name)[0].isdigit():
+            continue
+        with open(os.path.join(RESULT_DIR, name), 'r', encoding='utf-8') as f:
+            output = json.load(f)
+        texts.extend((item['origin_input'] or '') + (item['quantity'] or '') for item in output['items'])
+    return texts
+
+
+def mutate(text, alphabet, rng):
+    """随机替换一个字"""
+    if not text:
+        return text
+    i = rng.randrange(len(text))
+    return text[:i] + rng.choice(alphabet) + text[i + 1:]
+
+
+def scale_print_pages(src_list, pages, count):
+    """第一页（含客户信息与表头）之后循环使用其余的表格页"""
+    if count <= len(pages) or len(pages) < 2:
+        return src_list[:count], pages[:count]
+    order = [0] + [1 + i % (len(pages) - 1) for i in range(count - 1)]
+    return [src_list[i] for i in order], [pages[i] for i in order]
+
+
+def scale_handwriting_page(texts, count, alphabet, rng):
+    """按行生成手写单据的OCR结果，每行60像素高"""
+    rows = [texts[i] if i < len(texts) else mutate(texts[i % len(texts)], alphabet, rng) for i in range(count)]
+    return dict(rec_texts=rows, rec_scores=[0.9] * len(rows),
+                rec_boxes=[[10, 80 * i, 600, 80 * i + 60] for i in range(len(rows))])
+
+
+def scale_catalog(count, work_dir, rng):
+    """返回订单资料路径：count 不超过原始品号数时为原始订单资料，否则生成放大后的xlsx"""
+    rows = catalog.read_template_rows(catalog.TEMPLATE_PATH)
+    if count <= len(set(id for id, _, _ in rows)):
+        return catalog.TEMPLATE_PATH, len(rows)
+    names = [name for _, name, _ in rows if name]
+    units = sorted(set(unit for _, _, unit in rows if unit))
+    # 只用汉字替换，避免生成 'NA' 之类读回时被当作空值的品名
+    alphabet = sorted(set(c for c in ''.join(names) if '\u4e00' <= c <= '\u9fff'))
+    ids = set(id for id, _, _ in rows)
+    data = [(id, name, unit) for id, name, unit in rows]
+    while len(ids) < count:
+        id = f'Z{len(ids):07d}'
+        ids.add(id)
+        data.append((id, mutate(rng.choice(names), alphabet, rng), rng.choice(units)))
+    path = os.path.join(work_dir, f'catalog_{count}.xlsx')
+    pd.DataFrame(data, columns=['品號', '品名', '單位']).to_excel(path, index=False, engine='openpyxl')
+    return path, len(data)
+
+
+def best_of(repeat, run, setup=None):
+    """setup 的返回值传给 run，只对 run 计时，返回最快一轮的秒数与最后一轮的结果"""
+    elapsed, result = float('inf'), None
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        start = time.perf_counter()
+        result = run(arg)
+        elapsed = min(elapsed, time.perf_counter() - start)
+    return elapsed, result
+
+
+def clear_catalogs():
+    catalog._CATALOGS.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=20, help='打印体单据页数')
+    parser.add_argument('--rows', type=int, default=1000, help='手写单据行数')
+    parser.add_argument('--skus', type=int, default=0, help='订单资料品号数，0为原始订单资料')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--font', default=base.FONT_PATH, help='渲染结果图使用的字体，不存在时跳过 render_result')
+    parser.add_argument('--no-render', action='store_true', help='跳过 render_result')
+    parser.add_argument('--json', action='store_true', help='以JSON输出')
+    args = parser.parse_args()
+
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    rng = random.Random(SEED)
+    work_dir = tempfile.mkdtemp(prefix='bench-pipeline-')
+    src_dir = os.path.join(work_dir, 'src')
+    os.makedirs(src_dir)
+    try:
+        # 订单资料加载时的提示信息输出到stderr，stdout只有结果
+        with contextlib.redirect_stdout(sys.stderr):
+            results = run_benchmark(args, rng, work_dir, src_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=4))
+        return
+    config = results['config']
+    print(f"pages {config['pages']}, rows {config['rows']}, catalog rows {config['catalog_rows']}, "
+          f"repeat {config['repeat']}")
+    print(f"{'stage':<40}{'ms':>12}{'units':>10}{'us/unit':>12}")
+    for stage in results['stages']:
+        if 'skipped' in stage:
+            print(f"{stage['stage']:<40}{'skipped: ' + stage['skipped']:>34}")
+            continue
+        print(f"{stage['stage']:<40}{stage['ms']:>12}{stage['units']:>10}{stage['us_per_unit']:>12}")
+
+
+def run_benchmark(args, rng, work_dir, src_dir):
+    template_path, catalog_rows = scale_catalog(args.skus, work_dir, rng)
+    documents = load_print_documents(src_dir)
+    print_src, print_pages = scale_print_pages(*documents[0], args.pages)
+    texts = load_handwriting_rows()
+    alphabet = sorted(set(''.join(texts)))
+    handwriting_page = scale_handwriting_page(texts, args.rows, alphabet, rng)
+    handwriting_src = os.path.join(src_dir, HANDWRITING_IMAGES[0])
+    shutil.copyfile(os.path.join(RESOURCE_DIR, HANDWRITING_IMAGES[0]), handwriting_src)
+    memo = get_query_memo()
+    stages = list()
+
+    def record(stage, elapsed, units):
+        stages.append(dict(stage=stage, ms=round(elapsed * 1e3, 3), units=units,
+                           us_per_unit=round(elapsed / max(units, 1) * 1e6, 3)))
+
+    # 订单资料：清空进程内缓存后加载（有编译产物时为mmap加载）
+    for split_name, stage in ((True, 'load_items (handwriting)'), (False, 'load_items (print)')):
+        elapsed, _ = best_of(args.repeat, lambda _: catalog.get_catalog(template_path, split_name),
+                             setup=clear_catalogs)
+        record(stage, elapsed, catalog_rows)
+    handwriting_catalog = catalog.get_catalog(template_path, True)
+    print_catalog = catalog.get_catalog(template_path, False)
+
+    elapsed, _ = best_of(args.repeat, lambda _: FuzzyMatchHandwriting.build_fuzzy_match(
+        handwriting_catalog.template_items, handwriting_catalog.name_to_id))
+    record('build_fuzzy_match', elapsed, len(handwriting_catalog.name_to_id))
+    elapsed, _ = best_of(args.repeat, lambda _: NameIndex(print_catalog.template_items, print_catalog.name_to_id))
+    record('build NameIndex (print)', elapsed, len(print_catalog.name_to_id))
+
+    rows = handwriting_page['rec_texts']
+    elapsed, _ = best_of(args.repeat, lambda _: [split_ocr_row(text) for text in rows])
+    record('split_ocr_row', elapsed, len(rows))
+
+    def legacy_rows(_=None):
+        memo.clear()
+        return [dict(text=text, score=score, box=box) for text, score, box in
+                zip(handwriting_page['rec_texts'], handwriting_page['rec_scores'], handwriting_page['rec_boxes'])]
+    handwriting = FuzzyMatchHandwriting(template_path)
+    elapsed, _ = best_of(args.repeat, handwriting.fuzzy_match_ocr_single, setup=legacy_rows)
+    record('fuzzy_match_ocr_single', elapsed, len(rows))
+
+    def print_matcher(_=None):
+        memo.clear()
+        return FuzzyMatchPrint(template_path)
+    ocr_pages = print_matcher().load_pdf_ocr_result(print_pages)
+
+    def parse(matcher):
+        matcher.parse_ocr_results(ocr_pages)
+        return matcher
+    elapsed, matcher = best_of(args.repeat, parse, setup=print_matcher)
+    record('load_table_item (print)', elapsed, len(matcher.items))
+
+    def match_print(matcher):
+        matcher.fuzzy_match(print_pages)
+        return matcher
+    elapsed, print_result = best_of(args.repeat, match_print, setup=print_matcher)
+    record('fuzzy_match (print)', elapsed, len(print_result.items))
+    elapsed, _ = best_of(args.repeat, match_print, setup=lambda: FuzzyMatchPrint(template_path))
+    record('fuzzy_match (print, memo warm)', elapsed, len(print_result.items))
+
+    def handwriting_matcher(_=None):
+        memo.clear()
+        return FuzzyMatchHandwriting(template_path)
+
+    def match_handwriting(matcher):
+        matcher.fuzzy_match(handwriting_page)
+        return matcher
+    elapsed, handwriting_result = best_of(args.repeat, match_handwriting, setup=handwriting_matcher)
+    record('fuzzy_match (handwriting)', elapsed, len(rows))
+    elapsed, _ = best_of(args.repeat, match_handwriting, setup=lambda: FuzzyMatchHandwriting(template_path))
+    record('fuzzy_match (handwriting, memo warm)', elapsed, len(rows))
+
+    for stage, result in (('format_output (print)', print_result), ('format_output (handwriting)', handwriting_result)):
+        elapsed, _ = best_of(args.repeat, lambda _: result.format_output())
+        record(stage, elapsed, len(result.items))
+
+    skipped = 'disabled' if args.no_render else None
+    if skipped is None and not os.path.exists(args.font):
+        skipped = f'font not found: {args.font}'
+    if skipped is not None:
+        stages.append(dict(stage='render_result', skipped=skipped))
+    else:
+        base.FONT_PATH = args.font
+        base.load_font.cache_clear()
+        elapsed, _ = best_of(args.repeat, lambda _: print_result.render_result(print_src))
+        record('render_result (print)', elapsed, len(print_src))
+        elapsed, _ = best_of(args.repeat, lambda _: handwriting_result.render_result(handwriting_src))
+        record('render_result (handwriting)', elapsed, 1)
+
+    config = dict(pages=len(print_pages), rows=len(rows), skus=args.skus, catalog_rows=catalog_rows,
+                  repeat=args.repeat, cpu_count=os.cpu_count())
+    return dict(config=config, stages=stages)
+
+
+if __name__ == '__main__':
+    main()
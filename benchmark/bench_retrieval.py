@@ -0,0 +1,139 @@
+"""
+手写单据品名匹配：全量计算（compute_names）与两阶段检索（retrieve_names）在大订单资料上的耗时与准确率，只用CPU
+
+    python benchmark/bench_retrieval.py [--names 100000] [--queries 500] [--candidates 50,200] [--coverage 0.7,0.9] [--repeat 3] [--json]
+
+订单资料：原始订单资料的品名，超出的部分由已有品名随机替换一个字生成（去重），只在内存中拟合n-gram索引
+查询：从订单资料中随机抽取品名再随机替换一个字，模拟手写识别错误，原品名为正确答案
+输出每种配置的耗时、准确率（与原品名相同的比例）以及与全量计算结果一致的比例
+每种配置取 --repeat 轮中最快的一轮；两阶段检索的倒排表在计时前构建（服务中随订单资料索引常驻）
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+
+with contextlib.redirect_stdout(sys.stderr):
+    from fuzzy_match import catalog
+    from fuzzy_match import FuzzyMatchHandwriting
+    from fuzzy_match.ngram_index import NgramIndex
+
+SEED = 0
+
+
+class IndexMatcher(FuzzyMatchHandwriting):
+    """只持有两个n-gram索引，不加载订单资料，用于直接调用 compute_names / retrieve_names"""
+    def __init__(self, radical, stroke):
+        self.fcm_name_radical, self.fcm_name_stroke = radical, stroke
+        self.retrieval = False
+
+
+def mutate(text, alphabet, rng):
+    """随机替换一个字"""
+    if not text:
+        return text
+    i = rng.randrange(len(text))
+    return text[:i] + rng.choice(alphabet) + text[i + 1:]
+
+
+def scale_names(count, rng):
+    """原始订单资料的品名放大到 count 个不重复的品名"""
+    # 只用汉字替换，与 bench_pipeline.scale_catalog 相同
+    names = list(dict.fromkeys(name for _, name, _ in catalog.read_template_rows(catalog.TEMPLATE_PATH) if name))
+    alphabet = sorted(set(c for c in ''.join(names) if '\u4e00' <= c <= '\u9fff'))
+    seen = set(names)
+    seeds = list(names)
+    while len(names) < count:
+        name = mutate(rng.choice(seeds), alphabet, rng)
+        if name not in seen:
+            seen.add(name)
+            names.append(name)
+    return names, alphabet
+
+
+def best_of(repeat, run):
+    elapsed, result = float('inf'), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = run()
+        elapsed = min(elapsed, time.perf_counter() - start)
+    return elapsed, result
+
+
+def parse_list(value, cast):
+    return [cast(v) for v in value.split(',') if v]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--names', type=int, default=100000, help='订单资料品名数')
+    parser.add_argument('--queries', type=int, default=500, help='查询数')
+    parser.add_argument('--candidates', default='50,200', help='每种拆分的候选数，逗号分隔')
+    parser.add_argument('--coverage', default='0.7,0.9', help='取候选使用的查询n-gram权重比例，逗号分隔')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', action='store_true', help='以JSON输出')
+    args = parser.parse_args()
+
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run_benchmark(args, random.Random(SEED))
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=4))
+        return
+    config = results['config']
+    print(f"names {config['names']}, queries {config['queries']}, fit {config['fit_seconds']}s, "
+          f"postings {config['postings_seconds']}s, repeat {config['repeat']}")
+    print(f"{'method':<28}{'ms':>12}{'us/query':>12}{'accuracy':>10}{'agreement':>11}{'candidates':>12}")
+    for row in results['methods']:
+        print(f"{row['method']:<28}{row['ms']:>12}{row['us_per_query']:>12}{row['accuracy']:>10}"
+              f"{row['agreement']:>11}{row['mean_candidates']:>12}")
+
+
+def run_benchmark(args, rng):
+    names, alphabet = scale_names(args.names, rng)
+    start = time.perf_counter()
+    radical, stroke = (NgramIndex.fit(names, analyzer, catalog.NGRAM_RANGE) for analyzer in catalog.ANALYZERS)
+    fit_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    radical.postings, stroke.postings
+    postings_seconds = time.perf_counter() - start
+    matcher = IndexMatcher(radical, stroke)
+
+    truth = [rng.choice(names) for _ in range(args.queries)]
+    queries = [mutate(name, alphabet, rng) for name in truth]
+    methods = list()
+
+    def record(method, elapsed, matched, brute, mean_candidates):
+        methods.append(dict(method=method, ms=round(elapsed * 1e3, 3),
+                            us_per_query=round(elapsed / len(queries) * 1e6, 3),
+                            accuracy=round(float(np.mean([m == t for m, t in zip(matched, truth)])), 4),
+                            agreement=round(float(np.mean([m == b for m, b in zip(matched, brute)])), 4),
+                            mean_candidates=mean_candidates))
+
+    elapsed, (brute, _) = best_of(args.repeat, lambda: matcher.compute_names(queries))
+    record('brute force', elapsed, brute, brute, len(names))
+    for k in parse_list(args.candidates, int):
+        for coverage in parse_list(args.coverage, float):
+            elapsed, (matched, _) = best_of(
+                args.repeat, lambda: matcher.retrieve_names(queries, candidates=k, coverage=coverage))
+            vectors = stroke.vectorize(queries), radical.vectorize(queries)
+            columns = [np.union1d(a, b) for a, b in zip(stroke.candidates(vectors[0], k, coverage),
+                                                        radical.candidates(vectors[1], k, coverage))]
+            record(f'two-phase k={k} coverage={coverage}', elapsed, matched, brute,
+                   round(float(np.mean([len(c) for c in columns])), 1))
+
+    config = dict(names=len(names), queries=len(queries), repeat=args.repeat, fit_seconds=round(fit_seconds, 3),
+                  postings_seconds=round(postings_seconds, 3), cpu_count=os.cpu_count())
+    return dict(config=config, methods=methods)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,61 +1,313 @@
 
 from flask import Flask, request, jsonify
-import base64
 import os
 import fitz
-from PIL import Image
-import numpy as np
 import json
+import math
+import time
+import shutil
+import tempfile
+import threading
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from ocr_tiling import sort_boxes, save_ocr_json, mark_rendered_png, RENDER_DPI_KEY
+from upload import copy_stream, read_json_upload
+from result_cache import get_result_cache, file_key, copy_file, restore_ocr_json
+from metrics import register_metrics, span, record_span, incr
 
 app = Flask(__name__)
+register_metrics(app, 'data_preprocess')
+
+# pdf 渲染进程数，页面按进程并行渲染
+PDF_RENDER_WORKERS = int(os.environ.get('PDF_RENDER_WORKERS', os.cpu_count() or 1))
+# 页面有可用的文本层时直接从pdf取文字和box写成OCR结果，跳过OCR
+PDF_TEXT_LAYER = os.environ.get('PDF_TEXT_LAYER', '1') == '1'
+# 文本层可用：非空白字符数足够，且乱码（替换字符/私用区/控制字符）占比低
+TEXT_LAYER_MIN_CHARS = int(os.environ.get('TEXT_LAYER_MIN_CHARS', 20))
+TEXT_LAYER_MAX_BAD_RATIO = float(os.environ.get('TEXT_LAYER_MAX_BAD_RATIO', 0.02))
+# 跳过OCR的页面图像只用于渲染结果，分辨率可以低一些
+TEXT_LAYER_DPI = int(os.environ.get('TEXT_LAYER_DPI', 150))
+# 需要OCR的页面：取保证最小字高不低于识别阈值的最低DPI
+# 字号取自pdf中的文字（不可用的文本层字号仍然可信），纯扫描页按假设的最小字号估算
+MIN_GLYPH_HEIGHT_PX = int(os.environ.get('MIN_GLYPH_HEIGHT_PX', 32))
+ASSUMED_FONT_SIZE_PT = float(os.environ.get('ASSUMED_FONT_SIZE_PT', 9))
+MIN_DPI = int(os.environ.get('PDF_MIN_DPI', 150))
+MAX_DPI = int(os.environ.get('PDF_MAX_DPI', 300))
+# 小于该字号的文字视为装饰/噪声，不参与字号估算
+MIN_FONT_SIZE_PT = 4
 
-def data_dump(uuid, mime_type, file_data, workdir='workdir'):
+def upload_path(uuid, mime_type, workdir='workdir'):
+    """上传文件的存放路径 workdir/<uuid>/src/<uuid>.<扩展名>"""
+    if '/' not in mime_type:
+        raise ValueError(f"无效的文件类型：{mime_type}")
     file_ext = '.' + mime_type.split('/')[1]
     dst_path = os.path.join(workdir, uuid, 'src', uuid + file_ext)
     if not os.path.exists(os.path.dirname(dst_path)):
         os.makedirs(os.path.dirname(dst_path))
+    return dst_path
+
+def data_dump(uuid, mime_type, file_data, workdir='workdir', on_page=None):
+    """
+    on_page(页码, 图像路径, OCR结果路径)：pdf每渲染完一页就回调一次（顺序不保证），可以提前把页面交给OCR
+    有文本层的pdf页直接生成OCR结果，返回的 ocr_list 中对应位置为结果路径，需要OCR的页为None
+    """
+    dst_path = upload_path(uuid, mime_type, workdir)
     with open(dst_path, 'wb') as f:
         f.write(file_data)
+    return data_load(uuid, mime_type, dst_path, workdir, on_page)
+
+def data_load(uuid, mime_type, dst_path, workdir='workdir', on_page=None):
+    """
+    处理已经写入 upload_path 的文件，参数与返回值同 data_dump
+    """
     if mime_type.split('/')[0] == 'image':
+        incr('pages_total', stage='preprocess', source='image')
         json_config = {
             'task_type': 'handwritting',
             'src_list': [dst_path],
         }
         return json_config
     elif mime_type.split('/')[0] == 'application' and mime_type.split('/')[1] == 'pdf':
-        images = pdf_to_images(dst_path)
+        pages = dict()
+        src_dir = os.path.join(workdir, uuid, 'src')
+        ocr_dir = os.path.join(workdir, uuid, 'ocr') if PDF_TEXT_LAYER else None
+        with span('preprocess', uuid) as trace:
+            cache = get_result_cache()
+            cache_key = file_key(dst_path, preprocess_config()) if cache else None
+            entry = cache.get('preprocess', cache_key) if cache else None
+            if entry is not None:
+                page_iter = restore_pdf_pages(entry, src_dir, uuid, ocr_dir)
+            else:
+                page_iter = iter_pdf_pages(dst_path, src_dir, uuid, ocr_dir=ocr_dir)
+            for i, image_dst_path, ocr_path in page_iter:
+                pages[i] = (image_dst_path, ocr_path)
+                if on_page is not None:
+                    on_page(i, image_dst_path, ocr_path)
+            if cache and entry is None:
+                store_pdf_pages(cache, cache_key, [pages[i] for i in sorted(pages)])
+            trace.update(pages=len(pages), cached=entry is not None)
         json_config = {
             'task_type': 'print',
-            'src_list': [],
+            'src_list': [pages[i][0] for i in sorted(pages)],
+            'ocr_list': [pages[i][1] for i in sorted(pages)],
         }
-        for i, data in enumerate(images):
-            pil_image = Image.fromarray(data)
-            image_dst_path = os.path.join(workdir, uuid, 'src', uuid + '_' + str(i) + '.png')
-            pil_image.save(image_dst_path)
-            json_config['src_list'].append(image_dst_path)
         return json_config
     else:
         return False
         
-def pdf_to_images(pdf_path, dpi=300):
-    doc = fitz.open(pdf_path)
-    images = []
-    for page_num in range(len(doc)):
-        page = doc[page_num]
-        pix = page.get_pixmap(matrix=fitz.Matrix(dpi/72, dpi/72), alpha=False)  # 设置分辨率
-        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        images.append(np.array(img))
-    doc.close()
-    return images
+def _is_bad_char(char):
+    code = ord(char)
+    return char == '\ufffd' or 0xE000 <= code <= 0xF8FF or (code < 32 and char not in '\t\n\r')
+
+
+def extract_text_layer(page):
+    """
+    读取页面文本层，返回 (行列表[(文字, bbox)], 最小字号)，bbox单位为pt
+    文本层不可用（字符太少或乱码太多）时行列表为None
+    """
+    lines = list()
+    font_sizes = list()
+    char_count, bad_count = 0, 0
+    for block in page.get_text('dict')['blocks']:
+        for line in block.get('lines', []):
+            text = ''.join(span['text'] for span in line['spans']).strip()
+            if not text:
+                continue
+            lines.append((text, line['bbox']))
+            font_sizes.extend(span['size'] for span in line['spans'] if span['text'].strip())
+            chars = [char for char in text if not char.isspace()]
+            char_count += len(chars)
+            bad_count += sum(_is_bad_char(char) for char in chars)
+    font_sizes = [size for size in font_sizes if size >= MIN_FONT_SIZE_PT]
+    min_font_size = min(font_sizes) if font_sizes else None
+    if char_count < TEXT_LAYER_MIN_CHARS or bad_count > char_count * TEXT_LAYER_MAX_BAD_RATIO:
+        return None, min_font_size
+    return lines, min_font_size
+
+
+def choose_dpi(min_font_size=None):
+    """最小字号渲染后的字高不低于 MIN_GLYPH_HEIGHT_PX 的最低DPI"""
+    font_size = min_font_size or ASSUMED_FONT_SIZE_PT
+    dpi = math.ceil(MIN_GLYPH_HEIGHT_PX * 72 / font_size)
+    return max(MIN_DPI, min(MAX_DPI, dpi))
+
+
+def text_layer_to_ocr(lines, dpi, image_path):
+    """
+    文本层转为与PaddleOCR结果相同的字段，box为渲染图像上的像素坐标，dpi 用于换算坐标
+    """
+    scale = dpi / 72
+    boxes = [[int(round(v * scale)) for v in bbox] for _, bbox in lines]
+    texts, scores, boxes = sort_boxes([text for text, _ in lines], [1.0] * len(lines), boxes)
+    return dict(input_path=image_path, rec_texts=texts, rec_scores=scores, rec_boxes=boxes, dpi=dpi, source='text_layer')
+
+
+def render_page(page, dpi=None, text_layer=True):
+    """
+    渲染单页，返回 (pixmap, dpi, 文本层行列表或None)
+    dpi为None时按页面自适应：text_layer 为真且有可用文本层时返回文本层，否则按字号选择DPI
+    """
+    lines = None
+    if dpi is None:
+        lines, min_font_size = extract_text_layer(page)
+        if lines is not None and text_layer:
+            dpi = TEXT_LAYER_DPI
+        else:
+            lines = None
+            dpi = choose_dpi(min_font_size)
+    pix = page.get_pixmap(matrix=fitz.Matrix(dpi/72, dpi/72), alpha=False)
+    # pHYs 只供查看图片用，OCR服务按 mark_rendered_png 写入的标记取dpi
+    pix.set_dpi(dpi, dpi)
+    return pix, dpi, lines
+
+def _render_page(pdf_path, page_num, dst_path, dpi=None, ocr_path=None):
+    """
+    渲染单页，pixmap直接写png，不经过PIL/numpy
+    给出 ocr_path 且页面有可用文本层时直接写OCR结果
+    返回 (页码, 图像路径, OCR结果路径或None, 耗时秒数)
+    """
+    begin = time.perf_counter()
+    with fitz.open(pdf_path) as doc:
+        pix, dpi, lines = render_page(doc[page_num], dpi, text_layer=ocr_path is not None)
+        pix.save(dst_path)
+    mark_rendered_png(dst_path, dpi)
+    if lines is None:
+        return page_num, dst_path, None, time.perf_counter() - begin
+    save_ocr_json(text_layer_to_ocr(lines, dpi, dst_path), ocr_path)
+    return page_num, dst_path, ocr_path, time.perf_counter() - begin
+
+def _page_rendered(result):
+    """记录渲染耗时（在渲染进程中计时），返回 (页码, 图像路径, OCR结果路径或None)"""
+    page_num, dst_path, ocr_path, seconds = result
+    record_span('render_page', seconds, page=page_num, text_layer=ocr_path is not None)
+    incr('pages_total', stage='preprocess', source='text_layer' if ocr_path else 'image')
+    return page_num, dst_path, ocr_path
+
+_render_executor = None
+_render_executor_lock = threading.Lock()
+
+def get_render_executor():
+    global _render_executor
+    with _render_executor_lock:
+        if _render_executor is None:
+            # flask 多线程下 fork 不安全，使用 spawn，进程池常驻只付一次启动开销
+            _render_executor = ProcessPoolExecutor(max_workers=PDF_RENDER_WORKERS, mp_context=mp.get_context('spawn'))
+        return _render_executor
+
+def iter_pdf_pages(pdf_path, dst_dir, prefix, dpi=None, ocr_dir=None):
+    """
+    逐页渲染pdf并写入 dst_dir/<prefix>_<页码>.png，每完成一页yield一次 (页码, 图像路径, OCR结果路径)
+    dpi为None时逐页自适应选择DPI；给出 ocr_dir 时有文本层的页直接写 ocr_dir/<prefix>_<页码>.json，
+    其余页的OCR结果路径为None
+    多页时在进程池中并行渲染，完成顺序不保证与页码一致
+    """
+    with fitz.open(pdf_path) as doc:
+        page_count = len(doc)
+    paths = [os.path.join(dst_dir, prefix + '_' + str(i) + '.png') for i in range(page_count)]
+    ocr_paths = [os.path.join(ocr_dir, prefix + '_' + str(i) + '.json') if ocr_dir else None for i in range(page_count)]
+    if PDF_RENDER_WORKERS <= 1 or page_count <= 1:
+        for i in range(page_count):
+            yield _page_rendered(_render_page(pdf_path, i, paths[i], dpi, ocr_paths[i]))
+        return
+    executor = get_render_executor()
+    futures = [executor.submit(_render_page, pdf_path, i, paths[i], dpi, ocr_paths[i]) for i in range(page_count)]
+    for future in as_completed(futures):
+        yield _page_rendered(future.result())
+
+def preprocess_config():
+    """影响渲染结果的配置，作为预处理缓存key的一部分"""
+    return dict(text_layer=PDF_TEXT_LAYER, min_chars=TEXT_LAYER_MIN_CHARS, max_bad_ratio=TEXT_LAYER_MAX_BAD_RATIO,
+                text_layer_dpi=TEXT_LAYER_DPI, min_glyph_height=MIN_GLYPH_HEIGHT_PX,
+                assumed_font_size=ASSUMED_FONT_SIZE_PT, min_dpi=MIN_DPI, max_dpi=MAX_DPI,
+                render_marker=RENDER_DPI_KEY)
+
+def store_pdf_pages(cache, cache_key, pages):
+    """pages: 按页码排列的 (图像路径, OCR结果路径或None)，缓存条目内按页码命名"""
+    files = dict()
+    for i, (image_path, ocr_path) in enumerate(pages):
+        files[f'page_{i}.png'] = image_path
+        if ocr_path is not None:
+            files[f'page_{i}.json'] = ocr_path
+    cache.put('preprocess', cache_key, files=files, data={'pages.json': dict(page_count=len(pages))})
+
+def restore_pdf_pages(entry, dst_dir, prefix, ocr_dir=None):
+    """从缓存条目恢复页面，yield 与 iter_pdf_pages 相同的 (页码, 图像路径, OCR结果路径)"""
+    with open(os.path.join(entry, 'pages.json'), 'r', encoding='utf-8') as f:
+        page_count = json.load(f)['page_count']
+    for i in range(page_count):
+        incr('pages_total', stage='preprocess', source='cache')
+        image_path = os.path.join(dst_dir, prefix + '_' + str(i) + '.png')
+        copy_file(os.path.join(entry, f'page_{i}.png'), image_path)
+        ocr_path = None
+        cached_ocr = os.path.join(entry, f'page_{i}.json')
+        if ocr_dir and os.path.exists(cached_ocr):
+            ocr_path = restore_ocr_json(cached_ocr, os.path.join(ocr_dir, prefix + '_' + str(i) + '.json'),
+                                        image_path)
+        yield i, image_path, ocr_path
+
+def _valid_uuid(uuid):
+    return isinstance(uuid, str) and uuid not in ('', '.', '..') and '/' not in uuid and '\\' not in uuid
+
+def receive_upload(workdir='workdir'):
+    """
+    按请求类型把上传文件按块写入 workdir/<uuid>/src，返回 (uuid, mime_type, 文件路径)
+    1. application/json：{"uuid", "mime_type", "data": base64}，data 边读边解码，字段顺序不限
+    2. multipart/form-data：文件字段 file，uuid/mime_type 取表单字段，缺省时取 X-UUID 请求头与文件的类型
+    3. 其他：请求体即文件，Content-Type 为文件类型，uuid 取 X-UUID 请求头或 ?uuid=
+    """
+    if request.mimetype == 'application/json':
+        # uuid 可能在 data 之后，先解码到临时文件，解析完再移动
+        if not os.path.exists(workdir):
+            os.makedirs(workdir)
+        with tempfile.NamedTemporaryFile(dir=workdir, prefix='.upload-', delete=False) as f:
+            tmp_path = f.name
+            try:
+                fields, size = read_json_upload(request.stream, f)
+            except ValueError:
+                os.remove(tmp_path)
+                raise
+        uuid, mime_type = fields.get('uuid'), fields.get('mime_type')
+        if size is None or not _valid_uuid(uuid) or not mime_type:
+            os.remove(tmp_path)
+            raise ValueError("缺少 uuid/mime_type/data")
+        dst_path = upload_path(uuid, mime_type, workdir)
+        os.replace(tmp_path, dst_path)
+        return uuid, mime_type, dst_path
+
+    if request.mimetype == 'multipart/form-data':
+        # werkzeug 按块解析multipart，大文件落在临时文件中
+        file = request.files.get('file')
+        if file is None:
+            raise ValueError("缺少文件字段 file")
+        uuid = request.form.get('uuid') or request.headers.get('X-UUID')
+        mime_type = request.form.get('mime_type') or file.mimetype
+        if not _valid_uuid(uuid) or not mime_type:
+            raise ValueError("缺少 uuid/mime_type")
+        dst_path = upload_path(uuid, mime_type, workdir)
+        with open(dst_path, 'wb') as f:
+            shutil.copyfileobj(file.stream, f)
+        return uuid, mime_type, dst_path
+
+    uuid = request.headers.get('X-UUID') or request.args.get('uuid')
+    mime_type = request.mimetype
+    if not _valid_uuid(uuid) or not mime_type:
+        raise ValueError("缺少 uuid/Content-Type")
+    dst_path = upload_path(uuid, mime_type, workdir)
+    with open(dst_path, 'wb') as f:
+        copy_stream(request.stream, f)
+    return uuid, mime_type, dst_path
 
 @app.route('/data_preprocess', methods=['POST'])
 def data_preprocess():
-    json_data = request.get_json()
-    mime_type = json_data['mime_type']
-    uuid = json_data['uuid']
-    file_data = base64.b64decode(json_data['data'])  # Base64解码
-    
-    config = data_dump(uuid, mime_type, file_data)
+    begin = time.perf_counter()
+    try:
+        uuid, mime_type, dst_path = receive_upload()
+    except ValueError as e:
+        return str(e), 400
+    record_span('receive_upload', time.perf_counter() - begin, uuid, bytes=os.path.getsize(dst_path))
+
+    config = data_load(uuid, mime_type, dst_path)
     if config:
         return jsonify(config), 200
     else:
@@ -1,31 +1,71 @@
-import pandas as pd
-import numpy as np
-import re
 import json
+from functools import lru_cache
 from PIL import Image, ImageDraw, ImageFont
 import os
+import numpy as np
 
-def draw_chinese_text_in_box(img, text, box_coords, font_path="resource/wqy-zenhei.ttc", text_color=(0, 0, 0), bg_color=None):
-    draw = ImageDraw.Draw(img)
+from .catalog import get_catalog
+from .registry import get_catalog_registry
+from .ocr_page import OcrPage, load_ocr_file
 
-    x1, y1, x2, y2 = box_coords
-    box_width = x2 - x1
-    box_height = y2 - y1
-    
-    font_size = 50
-    font = ImageFont.truetype(font_path, font_size, encoding="utf-8")
-    
-    while True:
+# OCR结果中的box统一换算为该DPI下的像素坐标，打印体行/列的像素阈值按300DPI设定
+# 结果中没有dpi字段（如直接上传的图片）时不做换算
+REFERENCE_DPI = 300
+
+# 渲染结果图使用的字体
+FONT_PATH = os.environ.get('FONT_PATH', 'resource/wqy-zenhei.ttc')
+
+# 渲染字号范围，取能放进box的最大字号
+MAX_FONT_SIZE = 50
+MIN_FONT_SIZE = 1
+
+@lru_cache(maxsize=128)
+def load_font(font_path, font_size):
+    """字体文件只按 (路径, 字号) 加载一次"""
+    return ImageFont.truetype(font_path, font_size, encoding="utf-8")
+
+def fit_font(draw, text, box_width, box_height, font_path, max_size=MAX_FONT_SIZE, min_size=MIN_FONT_SIZE):
+    """
+    返回能放进box的最大字号的字体及该字号下的文字宽高
+    文字尺寸与字号近似成正比：按最大字号量一次直接算出目标字号，再逐级微调修正取整与字形带来的误差
+    """
+    def measure(size):
+        font = load_font(font_path, size)
         # pillow <= 9.5.0
         # text_width, text_height = draw.textsize(text, font=font)
         # pillow >= 10.0.0
         text_bbox = draw.textbbox((0, 0), text, font=font)
-        text_width = text_bbox[2] - text_bbox[0]
-        text_height = text_bbox[3] - text_bbox[1] 
-        if text_width <= box_width and text_height <= box_height:
+        return font, text_bbox[2] - text_bbox[0], text_bbox[3] - text_bbox[1]
+
+    def fits(width, height):
+        return width <= box_width and height <= box_height
+
+    font, text_width, text_height = measure(max_size)
+    if fits(text_width, text_height):
+        return font, text_width, text_height
+    ratio = min(box_width / text_width if text_width else 1, box_height / text_height if text_height else 1)
+    size = max(min_size, min(max_size - 1, int(max_size * ratio)))
+    font, text_width, text_height = measure(size)
+    while size > min_size and not fits(text_width, text_height):
+        size -= 1
+        font, text_width, text_height = measure(size)
+    while size + 1 < max_size:
+        larger = measure(size + 1)
+        if not fits(larger[1], larger[2]):
             break
-        font_size -= 1
-        font = ImageFont.truetype(font_path, font_size, encoding="utf-8")
+        size += 1
+        font, text_width, text_height = larger
+    return font, text_width, text_height
+
+def draw_chinese_text_in_box(img, text, box_coords, font_path=None, text_color=(0, 0, 0), bg_color=None):
+    font_path = font_path or FONT_PATH
+    draw = ImageDraw.Draw(img)
+
+    x1, y1, x2, y2 = box_coords
+    box_width = x2 - x1
+    box_height = y2 - y1
+    
+    font, text_width, text_height = fit_font(draw, text, box_width, box_height, font_path)
     
     text_x = x1 + (box_width - text_width) // 2
     text_y = y1 + (box_height - text_height) // 2
@@ -38,58 +78,74 @@ def draw_chinese_text_in_box(img, text, box_coords, font_path="resource/wqy-zenh
     return img
 
 class FuzzyMatchBase:
-    def __init__(self):
+    # 品名是否按照正斜杠与反斜杠拆分为多个词
+    split_item_name = True
+
+    def __init__(self, template_path=None, customer=None):
         self.customer_name = None
         self.order_date = None
         self.order_status = None
         self.order_price = None
-        self.template_path = './resource/客戶訂單資料.xlsx'
+        self.template_path = template_path
+        self.customer = customer
+        # 按加载顺序记录每页box的缩放比例，渲染时图像按同样比例缩放
+        self.page_scales = list()
         self.load_items()
 
     def load_items(self):
-        """订单资料存在重复品号以及品号下多个品名情况，先处理成独立的词
-        处理逻辑：品名按照正斜杠与反斜杠做分隔，品名+单位绑定为一个元组，映射到一个品号id
-        如果品名+单位有重复，只保留第一个
         """
-        ITEMS = dict()
-        NAME_to_ID = dict()
-        df = pd.read_excel(self.template_path, engine='openpyxl')
-        for index, row in df.iterrows():
-            id = row['品號']
-            if not isinstance(id, str) and np.isnan(id):
-                continue
-            ITEMS.setdefault(id, dict())
-            ITEMS[id].setdefault('name', set())
-            if row['品名'] is not None:
-                results = re.split(r'[\\/]', str(row['品名']))
-            else:
-                # results = []
-                print("Error Result ", results)
-                continue
-            unit = row['單位']
-            for result in results:
-                result = result.strip()
-                result_unit = (result, unit)
-                ITEMS[id]['name'].add(result_unit)
-                if result_unit not in NAME_to_ID:
-                    NAME_to_ID[result_unit] = id
-                elif NAME_to_ID[result_unit] != id:
-                    print(f"品名 {result_unit} 重复，请确认品号 {NAME_to_ID[result_unit], id}")
-                else:
-                    pass
-        self.template_items = ITEMS
-        self.name_to_id = NAME_to_ID
+        订单资料按文件缓存在进程内，见 catalog.get_catalog
+        没有指定 template_path 时按客户取该客户的订单资料，见 registry.CatalogRegistry
+        """
+        if self.template_path:
+            self.catalog = get_catalog(self.template_path, self.split_item_name)
+        else:
+            self.catalog = get_catalog_registry().get_catalog(self.customer, self.split_item_name)
+        self.template_items = self.catalog.template_items
+        self.name_to_id = self.catalog.name_to_id
+
+    def select_customer(self, customer):
+        """单据上解析出客户后换用该客户的订单资料"""
+        self.customer = customer
+        self.load_items()
+
+    def read_ocr_result(self, path):
+        """
+        path 为OCR结果json路径，或已经加载的结果dict（单进程流水线直接传递，见 pipeline.py）
+        json旁边有同名的 .ocrp（见 ocr_page.save_ocr_binary）时改为mmap读取，也可以直接传入 .ocrp 路径
+        返回 (结果dict, box缩放比例)，并记录该页的缩放比例
+        """
+        ocr_result = load_ocr_file(path)
+        scale = REFERENCE_DPI / ocr_result['dpi'] if ocr_result.get('dpi') else 1
+        self.page_scales.append(scale)
+        return ocr_result, scale
 
     def load_ocr_result(self, path):
-        with open(path, 'r', encoding='utf-8') as f:
-            ocr_result = json.load(f)
-        ocr_texts = ocr_result['rec_texts']
+        ocr_result, scale = self.read_ocr_result(path)
+        ocr_texts = list(ocr_result['rec_texts'])
         ocr_scores = ocr_result['rec_scores']
         ocr_boxes = ocr_result['rec_boxes']
+        if isinstance(ocr_boxes, np.ndarray):
+            # 二进制结果，转回与json相同的list
+            ocr_scores, ocr_boxes = ocr_scores.tolist(), ocr_boxes.tolist()
+        if scale != 1:
+            ocr_boxes = [[int(round(v * scale)) for v in box] for box in ocr_boxes]
         return [dict(text=text, score=score, box=box) for text, score, box in zip(ocr_texts, ocr_scores, ocr_boxes)]
 
-    def render_result(self, src_path):
+    def load_ocr_page(self, path):
+        """与 load_ocr_result 相同，返回列式的 OcrPage"""
+        return OcrPage.from_result(*self.read_ocr_result(path))
+
+    def load_page_image(self, src_path, page_index=0):
+        """读取页面图像并缩放到与box相同的坐标系"""
         img = Image.open(src_path)
+        scale = self.page_scales[page_index] if page_index < len(self.page_scales) else 1
+        if scale != 1:
+            img = img.resize((int(round(img.width * scale)), int(round(img.height * scale))))
+        return img
+
+    def render_result(self, src_path):
+        img = self.load_page_image(src_path)
         render_path = src_path.replace('src', 'render')
         state2color = {
             'normal': (0, 255, 0),
@@ -124,8 +180,10 @@ class FuzzyMatchBase:
         if not os.path.exists(os.path.dirname(render_path)):
             os.makedirs(os.path.dirname(render_path))
         final_img.save(render_path)
+        return render_path
 
-    def format_output(self, output_path):
+    def format_output(self, output_path=None):
+        """output_path 为None时只返回结果，不写盘"""
         output = {
             "customer_name": self.customer_name,
             "order_date": self.order_date,
@@ -135,6 +193,7 @@ class FuzzyMatchBase:
         }
         for item in self.items:
             output['items'].append(item.format_output())
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(output, f, ensure_ascii=False, indent=4)
+        if output_path is not None:
+            with open(output_path, 'w', encoding='utf-8') as f:
+                json.dump(output, f, ensure_ascii=False, indent=4)
         return output
\ No newline at end of file
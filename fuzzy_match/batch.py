@@ -0,0 +1,144 @@
+import os
+import threading
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .fuzzy_match_print import FuzzyMatchPrint, NameIndex
+from .fuzzy_match_handwriting import FuzzyMatchHandwriting
+from .ocr_page import load_ocr_file
+
+# 批量匹配的进程数，服务启动时由已经加载好订单资料的主进程fork出来，只读的索引按写时复制共享，见 start_batch_pool
+# 只共享默认订单资料；客户的订单资料在每个worker中各自加载，各自按 CATALOG_MEMORY_MB 的预算淘汰
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', os.cpu_count() or 1))
+# 每个进程一次领取的单据数
+BATCH_CHUNK_SIZE = int(os.environ.get('BATCH_CHUNK_SIZE', 8))
+
+PRINT_TITLE = "項次"
+
+
+def detect_task_type(ocr_list):
+    """
+    没有给出 task_type 时：多页或第一页含表头“項次”的为打印体，否则为手写
+    返回 (task_type, ocr_list)，已经读取的第一页以dict替换路径，避免重复读取
+    """
+    if len(ocr_list) > 1:
+        return 'print', ocr_list
+    first_page = load_ocr_file(ocr_list[0])
+    task_type = 'print' if any(PRINT_TITLE in text for text in first_page['rec_texts']) else 'handwritting'
+    return task_type, [first_page]
+
+
+def preload_catalog():
+    """
+    在fork之前加载订单资料以及两种匹配器的索引，子进程直接继承
+    """
+    FuzzyMatchHandwriting()
+    FuzzyMatchPrint().catalog.get_matcher('name_index', NameIndex)
+
+
+def _process_document(document):
+    """
+    在worker中执行：打印体完整匹配后返回结果；手写只拆分到品名，匹配留给主进程合并成一次矩阵运算
+    返回 (task_type, 状态, 结果)
+    """
+    task_type = document.get('task_type')
+    try:
+        ocr_list = document['ocr_list']
+        if not task_type:
+            task_type, ocr_list = detect_task_type(ocr_list)
+        if task_type == 'print':
+            matcher = FuzzyMatchPrint(customer=document.get('customer'))
+            matcher.fuzzy_match(ocr_list)
+            return task_type, 'done', matcher.format_output()
+        matcher = FuzzyMatchHandwriting(customer=document.get('customer'))
+        return task_type, 'parsed', matcher.parse_page(ocr_list[0])
+    except Exception as e:
+        return task_type, 'error', repr(e)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def start_batch_pool(workers=BATCH_WORKERS):
+    """
+    服务启动时、其他线程（请求、渲染队列、订单资料合并定时器）启动之前调用：加载订单资料后fork出全部worker
+    fork时其他线程可能正持有订单资料、查询缓存或metrics的锁，子进程中这些锁永远不会释放
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None and workers > 1:
+            preload_catalog()
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context('fork'))
+            # fork上下文的进程池在第一次提交时创建全部进程，提交空任务使其现在就fork
+            _pool.submit(int).result()
+        return _pool
+
+
+def get_batch_pool():
+    """
+    启动时没有创建（或已损坏被丢弃）时在请求线程中创建，此时fork不安全，
+    改用forkserver，worker各自加载订单资料（有编译产物时为mmap加载）
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=BATCH_WORKERS, mp_context=mp.get_context('forkserver'),
+                                        initializer=preload_catalog)
+        return _pool
+
+
+def _map_documents(documents):
+    """worker异常退出后进程池不能再用（BrokenProcessPool）：丢弃并换新的进程池重试一次"""
+    global _pool
+    pool = get_batch_pool()
+    try:
+        return list(pool.map(_process_document, documents, chunksize=BATCH_CHUNK_SIZE))
+    except BrokenProcessPool:
+        print("批量匹配进程池已损坏，重新创建")
+        with _pool_lock:
+            if _pool is pool:
+                _pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+        return list(get_batch_pool().map(_process_document, documents, chunksize=BATCH_CHUNK_SIZE))
+
+
+def match_documents(documents, parallel=True):
+    """
+    documents: [{'ocr_list': [...], 'task_type': 'print'|'handwritting'(可选), 'customer'(可选), ...}]
+    打印体与手写单据可以混合，按输入顺序返回 [{'task_type', 'output'} 或 {'task_type', 'error'}]
+    单据在进程池中解析，全部手写单据的品名一次性送入 match_names
+    parallel: 是否使用共享的进程池；进程池固定为 BATCH_WORKERS 个进程，BATCH_WORKERS 为1或只有一个单据时在当前进程中处理
+    """
+    if not parallel or BATCH_WORKERS <= 1 or len(documents) <= 1:
+        results = [_process_document(document) for document in documents]
+    else:
+        results = _map_documents(documents)
+
+    # 手写单据按客户分组，同一客户的品名一次性匹配
+    names = dict()
+    for document, (_, state, payload) in zip(documents, results):
+        if state == 'parsed':
+            names.setdefault(document.get('customer'), list()).extend(result['item'] for result in payload[1])
+    matched = {customer: FuzzyMatchHandwriting(customer=customer).match_names(customer_names)
+               for customer, customer_names in names.items()}
+
+    outputs = list()
+    offsets = dict()
+    for document, (task_type, state, payload) in zip(documents, results):
+        if state == 'error':
+            outputs.append(dict(task_type=task_type, error=payload))
+            continue
+        if state == 'parsed':
+            ocr_page, parsed = payload
+            customer = document.get('customer')
+            matched_names, match_scores = matched[customer]
+            offset = offsets.get(customer, 0)
+            matcher = FuzzyMatchHandwriting(customer=customer)
+            matcher.build_items(ocr_page, parsed, matched_names[offset:offset + len(parsed)],
+                                match_scores[offset:offset + len(parsed)])
+            offsets[customer] = offset + len(parsed)
+            payload = matcher.format_output()
+        outputs.append(dict(task_type=task_type, output=payload))
+    return outputs
@@ -0,0 +1,463 @@
+import os
+import re
+import sys
+import json
+import shutil
+import hashlib
+import threading
+from types import MappingProxyType
+
+import numpy as np
+import pandas as pd
+
+from .ngram_index import NgramIndex, SegmentedNgramIndex
+
+TEMPLATE_PATH = './resource/客戶訂單資料.xlsx'
+
+# 编译产物格式版本，格式变化时递增，旧版本产物会被忽略并回退到读取excel
+COMPILED_FORMAT_VERSION = 2
+NGRAM_RANGE = (3, 3)
+ANALYZERS = ('radical', 'stroke')
+# 增量修改后等待该秒数没有新的修改，再在后台重新拟合n-gram索引，合并增量段
+CATALOG_MERGE_DELAY = float(os.environ.get('CATALOG_MERGE_DELAY', 5))
+DELTA_OPS = ('add', 'retire', 'rename')
+# 估算内存时每个dict项（含key/value中的元组与字符串）的平均开销，字节
+ENTRY_BYTES = 256
+
+
+def read_template_rows(template_path):
+    """
+    读取订单资料的原始行 (品号, 品名, 单位)，品号为空的行跳过，缺失的品名/单位为None
+    品号统一为str：xlsx与编译产物两种加载方式得到相同的品号，数字品号（列中有空值时读成float）不带小数点
+    """
+    rows = list()
+    df = pd.read_excel(template_path, engine='openpyxl')
+    for index, row in df.iterrows():
+        id = row['品號']
+        if not isinstance(id, str):
+            if np.isnan(id):
+                continue
+            id = str(int(id)) if float(id).is_integer() else str(id)
+        name = None if pd.isna(row['品名']) else str(row['品名'])
+        unit = None if pd.isna(row['單位']) else str(row['單位'])
+        rows.append((id, name, unit))
+    return rows
+
+
+def build_template(rows, split_name=True):
+    """订单资料存在重复品号以及品号下多个品名情况，先处理成独立的词
+    处理逻辑：品名按照正斜杠与反斜杠做分隔，品名+单位绑定为一个元组，映射到一个品号id
+    如果品名+单位有重复，只保留第一个
+    split_name=False 时品名整体作为一个词（打印体匹配使用）
+    """
+    ITEMS = dict()
+    NAME_to_ID = dict()
+    for id, name, unit in rows:
+        ITEMS.setdefault(id, dict())
+        ITEMS[id].setdefault('name', set())
+        if name is None:
+            print("Error Result ", id)
+            continue
+        if split_name:
+            results = [result.strip() for result in re.split(r'[\\/]', name)]
+        else:
+            results = [name]
+        for result in results:
+            result_unit = (result, unit)
+            ITEMS[id]['name'].add(result_unit)
+            if result_unit not in NAME_to_ID:
+                NAME_to_ID[result_unit] = id
+            elif NAME_to_ID[result_unit] != id:
+                print(f"品名 {result_unit} 重复，请确认品号 {NAME_to_ID[result_unit], id}")
+            else:
+                pass
+    return ITEMS, NAME_to_ID
+
+
+def _edit_name(name, target, replacement=None):
+    """
+    品名整体或其中一个别名（按 / 与 \\ 分隔）等于 target 时替换为 replacement，replacement 为None时去掉
+    返回 (新品名, 是否修改)，别名全部去掉后新品名为None
+    """
+    if name is None:
+        return name, False
+    aliases = [alias.strip() for alias in re.split(r'[\\/]', name)]
+    if name.strip() == target:
+        aliases = [replacement]
+    elif target in aliases:
+        aliases = [replacement if alias == target else alias for alias in aliases]
+    else:
+        return name, False
+    aliases = [alias for alias in aliases if alias]
+    return ('/'.join(aliases) if aliases else None), True
+
+
+def apply_delta(rows, delta):
+    """
+    在订单资料原始行 [(品号, 品名, 单位)] 上应用一条增量修改，返回新的rows（不修改传入的list）
+    add     {'op': 'add', 'id', 'name', 'unit'}                     新增一行，name 可以是 / 分隔的多个别名
+    retire  {'op': 'retire', 'id', 'name'(可选), 'unit'(可选)}       停用品号；给出 name 时只去掉该品名/别名
+    rename  {'op': 'rename', 'id', 'name', 'new_name', 'unit'(可选)}  品号下的品名/别名改名
+    给出 unit 时只修改该单位的行；修改不到任何行时抛出ValueError
+    """
+    op = delta.get('op')
+    if op not in DELTA_OPS:
+        raise ValueError(f"未知的增量修改：{op}")
+    id = delta.get('id')
+    if not id:
+        raise ValueError("增量修改缺少品号 id")
+    id = str(id)
+    if op == 'add':
+        if not delta.get('name'):
+            raise ValueError("新增品号缺少品名 name")
+        row = (id, str(delta['name']), None if delta.get('unit') is None else str(delta['unit']))
+        if row in rows:
+            return list(rows)
+        return list(rows) + [row]
+    if op == 'rename' and not (delta.get('name') and delta.get('new_name')):
+        raise ValueError("改名缺少 name 或 new_name")
+
+    result = list()
+    changed = False
+    for row_id, name, unit in rows:
+        if row_id != id or ('unit' in delta and unit != delta['unit']):
+            result.append((row_id, name, unit))
+            continue
+        if op == 'retire' and not delta.get('name'):
+            changed = True
+            continue
+        name, edited = _edit_name(name, delta['name'], delta.get('new_name') if op == 'rename' else None)
+        changed = changed or edited
+        if name is not None:
+            result.append((row_id, name, unit))
+    if not changed:
+        raise ValueError(f"品号 {id} 下没有可以修改的品名：{delta}")
+    return result
+
+
+def delta_version(version, delta):
+    """应用增量修改后的版本：前一版本与修改内容的sha1，多个进程按相同顺序应用得到相同的版本"""
+    digest = hashlib.sha1(version.encode('utf-8'))
+    digest.update(json.dumps(delta, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def delta_path(template_path):
+    """增量修改日志：每行一条修改，记录所基于的订单资料sha1"""
+    return os.path.splitext(template_path)[0] + '.delta.jsonl'
+
+
+def read_deltas(template_path, source_sha1):
+    """
+    读取基于该版本订单资料的增量修改；excel本身更新后，旧版本上的修改不再应用（应已整理进excel）
+    """
+    path = delta_path(template_path)
+    if not os.path.exists(path):
+        return []
+    deltas = list()
+    skipped = 0
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record.pop('source_sha1', None) != source_sha1:
+                skipped += 1
+                continue
+            deltas.append(record)
+    if skipped:
+        print(f"{path} 中 {skipped} 条增量修改基于旧版本的订单资料，已忽略")
+    return deltas
+
+
+def append_deltas(template_path, deltas, source_sha1):
+    lines = ''.join(json.dumps(dict(delta, source_sha1=source_sha1), ensure_ascii=False) + '\n' for delta in deltas)
+    # 一次追加写入，多个服务进程同时修改时行不会交错
+    with open(delta_path(template_path), 'a', encoding='utf-8') as f:
+        f.write(lines)
+
+
+def read_template(template_path, split_name=True):
+    return build_template(read_template_rows(template_path), split_name)
+
+
+def build_ngram_indexes(name_to_id):
+    """
+    分别build 基于部首和笔画的n-gram索引，两个索引的名称顺序一致
+    """
+    template_item_name = [tup[0] for tup in name_to_id.keys()]
+    return tuple(NgramIndex.fit(template_item_name, analyzer, NGRAM_RANGE) for analyzer in ANALYZERS)
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def compiled_path(template_path):
+    return os.path.splitext(template_path)[0] + '.catalog'
+
+
+def compile_catalog(template_path=TEMPLATE_PATH, output_dir=None):
+    """
+    将订单资料编译为目录形式的二进制产物：
+    manifest.json       格式版本、源文件sha1
+    rows.*.npy          原始的 品号/品名/单位（定长unicode数组）
+    <analyzer>.*.npy    部首/笔画 n-gram 词表、idf 以及名称的tf-idf稀疏矩阵(csr)
+    所有数组都可以 np.load(mmap_mode='r') 加载，fork 出的 worker 共享同一份页缓存
+    """
+    output_dir = output_dir or compiled_path(template_path)
+    version = file_digest(template_path)
+    rows = read_template_rows(template_path)
+    _, name_to_id = build_template(rows, split_name=True)
+
+    tmp_dir = f'{output_dir}.tmp-{os.getpid()}'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    ids, names, units = zip(*rows) if rows else ((), (), ())
+    np.save(os.path.join(tmp_dir, 'rows.id.npy'), np.array(ids, dtype=str))
+    np.save(os.path.join(tmp_dir, 'rows.name.npy'), np.array([name or '' for name in names], dtype=str))
+    np.save(os.path.join(tmp_dir, 'rows.name_missing.npy'), np.array([name is None for name in names], dtype=bool))
+    np.save(os.path.join(tmp_dir, 'rows.unit.npy'), np.array([unit or '' for unit in units], dtype=str))
+    np.save(os.path.join(tmp_dir, 'rows.unit_missing.npy'), np.array([unit is None for unit in units], dtype=bool))
+    for analyzer, index in zip(ANALYZERS, build_ngram_indexes(name_to_id)):
+        index.save(os.path.join(tmp_dir, analyzer))
+    manifest = {
+        'format_version': COMPILED_FORMAT_VERSION,
+        'source': os.path.basename(template_path),
+        'source_sha1': version,
+        'ngram_range': list(NGRAM_RANGE),
+        'analyzers': list(ANALYZERS),
+        'rows': len(rows),
+    }
+    with open(os.path.join(tmp_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=4)
+
+    # 先移走旧产物再改名，已经mmap旧文件的进程不受影响
+    old_dir = f'{output_dir}.old-{os.getpid()}'
+    if os.path.exists(output_dir):
+        os.rename(output_dir, old_dir)
+    os.rename(tmp_dir, output_dir)
+    if os.path.exists(old_dir):
+        shutil.rmtree(old_dir)
+    return output_dir
+
+
+def load_compiled(artifact_dir, version=None):
+    """
+    加载编译产物，返回 (rows, ngram索引)；产物不存在、格式版本不符或与源文件sha1不一致时返回None
+    """
+    manifest_path = os.path.join(artifact_dir, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest.get('format_version') != COMPILED_FORMAT_VERSION:
+        return None
+    if version is not None and manifest.get('source_sha1') != version:
+        return None
+
+    def load_array(name):
+        return np.load(os.path.join(artifact_dir, name + '.npy'), mmap_mode='r')
+    rows = list()
+    for id, name, name_missing, unit, unit_missing in zip(
+            load_array('rows.id'), load_array('rows.name'), load_array('rows.name_missing'),
+            load_array('rows.unit'), load_array('rows.unit_missing')):
+        rows.append((str(id), None if name_missing else str(name), None if unit_missing else str(unit)))
+    indexes = tuple(NgramIndex.load(os.path.join(artifact_dir, analyzer), analyzer, manifest['ngram_range'])
+                    for analyzer in manifest['analyzers'])
+    return rows, indexes
+
+
+class CatalogIndex:
+    """
+    订单资料的只读索引，进程内所有请求共享
+    template_items: 品号 -> {'name': frozenset((品名, 单位), ...)}
+    name_to_id: (品名, 单位) -> 品号
+    version: 订单资料文件内容的sha1，文件变化或增量修改后会生成新的索引而不是修改旧的
+    source_sha1: excel文件内容的sha1；deltas: 已应用的增量修改条数
+    """
+    def __init__(self, template_path, template_items, name_to_id, version, matchers=None,
+                 rows=(), split_name=True, source_sha1=None, deltas=0):
+        self.template_path = template_path
+        self.rows = tuple(rows)
+        self.split_name = split_name
+        self.source_sha1 = source_sha1 or version
+        self.deltas = deltas
+        self.template_items = MappingProxyType({
+            id: MappingProxyType({'name': frozenset(item['name'])}) for id, item in template_items.items()
+        })
+        self.name_to_id = MappingProxyType(dict(name_to_id))
+        self.version = version
+        self._matchers = dict(matchers or {})
+        self._build_lock = threading.Lock()
+
+    def get_matcher(self, key, builder):
+        """
+        拟合好的匹配器按key缓存在索引上，同一份订单资料只拟合一次
+        """
+        matcher = self._matchers.get(key)
+        if matcher is None:
+            with self._build_lock:
+                matcher = self._matchers.get(key)
+                if matcher is None:
+                    matcher = builder(self.template_items, self.name_to_id)
+                    self._matchers[key] = matcher
+        return matcher
+
+    def apply(self, deltas, strict=True):
+        """
+        应用增量修改，返回新的索引（旧索引不变，正在处理的请求不受影响）
+        已经拟合的n-gram索引不重新拟合，改为基础索引 + 增量段，见 SegmentedNgramIndex；其余匹配器在新索引上按需重建
+        strict=False 时跳过无法应用的修改（如其他进程同时停用了同一品号），否则抛出ValueError
+        """
+        rows = self.rows
+        version = self.version
+        for delta in deltas:
+            try:
+                rows = apply_delta(rows, delta)
+            except ValueError as e:
+                if strict:
+                    raise
+                print(f"增量修改无法应用，已跳过：{e}")
+                continue
+            version = delta_version(version, delta)
+        template_items, name_to_id = build_template(rows, self.split_name)
+        matchers = dict()
+        ngram = self._matchers.get('ngram')
+        if ngram is not None:
+            names = [tup[0] for tup in name_to_id.keys()]
+            matchers['ngram'] = tuple(SegmentedNgramIndex.build(index, names) for index in ngram)
+        return CatalogIndex(self.template_path, template_items, name_to_id, version, matchers,
+                            rows, self.split_name, self.source_sha1, self.deltas + len(deltas))
+
+    def memory_bytes(self):
+        """
+        估算常驻内存：原始行、映射以及每个按品名构建的匹配器按每项固定开销计算，n-gram索引按数组大小
+        mmap加载的数组也计入（匹配时会整体访问）
+        """
+        matchers = list(self._matchers.values())
+        size = (len(self.rows) + len(self.name_to_id) * (1 + len(matchers))) * ENTRY_BYTES
+        for matcher in matchers:
+            for index in (matcher if isinstance(matcher, tuple) else (matcher,)):
+                size += getattr(index, 'nbytes', 0)
+        return size
+
+    @property
+    def segmented(self):
+        return any(isinstance(index, SegmentedNgramIndex) for index in self._matchers.get('ngram', ()))
+
+    def merge(self):
+        """增量段合并：按当前的品名重新拟合n-gram索引后替换，版本不变"""
+        if not self.segmented:
+            return
+        indexes = build_ngram_indexes(self.name_to_id)
+        with self._build_lock:
+            self._matchers['ngram'] = indexes
+
+
+def load_catalog(template_path, split_name=True, version=None):
+    """
+    优先加载与源文件一致的编译产物，否则读取excel
+    """
+    version = version or file_digest(template_path)
+    matchers = None
+    compiled = load_compiled(compiled_path(template_path), version)
+    if compiled is not None:
+        rows, indexes = compiled
+        if split_name:
+            matchers = {'ngram': indexes}
+    else:
+        rows = read_template_rows(template_path)
+    template_items, name_to_id = build_template(rows, split_name)
+    return CatalogIndex(template_path, template_items, name_to_id, version, matchers, rows, split_name)
+
+
+_CATALOGS = dict()
+_CATALOGS_LOCK = threading.Lock()
+
+
+def _signature(template_path):
+    path = delta_path(template_path)
+    return file_signature(template_path), file_signature(path) if os.path.exists(path) else None
+
+
+def get_catalog(template_path=TEMPLATE_PATH, split_name=True):
+    """
+    返回进程级缓存的订单资料索引
+    每次调用只对excel与增量修改日志做stat，文件mtime/大小变化时再比较内容hash，内容有变化才重新加载
+    增量修改日志只追加，已加载的索引只应用新增的修改
+    """
+    key = (os.path.abspath(template_path), split_name)
+    signature = _signature(template_path)
+    cached = _CATALOGS.get(key)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    with _CATALOGS_LOCK:
+        cached = _CATALOGS.get(key)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        source_sha1 = file_digest(template_path)
+        deltas = read_deltas(template_path, source_sha1)
+        if cached is not None and cached[1].source_sha1 == source_sha1 and cached[1].deltas <= len(deltas):
+            catalog = cached[1]
+        else:
+            catalog = load_catalog(template_path, split_name, source_sha1)
+        catalog = _apply_deltas(key, catalog, deltas[catalog.deltas:])
+        _CATALOGS[key] = (signature, catalog)
+        return catalog
+
+
+def evict_catalog(template_path, split_name=True):
+    """从进程缓存中移除，下次 get_catalog 时重新加载，见 registry.CatalogRegistry"""
+    with _CATALOGS_LOCK:
+        _CATALOGS.pop((os.path.abspath(template_path), split_name), None)
+
+
+def _apply_deltas(key, catalog, deltas):
+    if not deltas:
+        return catalog
+    catalog = catalog.apply(deltas, strict=False)
+    if catalog.segmented:
+        timer = threading.Timer(CATALOG_MERGE_DELAY, _merge, (key, catalog))
+        timer.daemon = True
+        timer.start()
+    return catalog
+
+
+def _merge(key, catalog):
+    """等待期间又有新的修改时，由新的索引负责合并"""
+    cached = _CATALOGS.get(key)
+    if cached is None or cached[1] is not catalog:
+        return
+    catalog.merge()
+
+
+def update_catalog(deltas, template_path=TEMPLATE_PATH):
+    """
+    增量修改订单资料（新增/停用/改名品号与别名，格式见 apply_delta），不重新读取excel、不重新拟合n-gram索引
+    修改先在当前的订单资料上校验，再追加到增量修改日志，其他进程在下一次 get_catalog 时应用
+    返回修改后的（品名拆分为别名的）订单资料索引
+    """
+    deltas = [dict(delta) for delta in deltas]
+    catalog = get_catalog(template_path, True)
+    rows = catalog.rows
+    for delta in deltas:
+        rows = apply_delta(rows, delta)
+    append_deltas(template_path, deltas, catalog.source_sha1)
+    return get_catalog(template_path, True)
+
+
+if __name__ == '__main__':
+    # python -m fuzzy_match.catalog [订单资料.xlsx]
+    template_path = sys.argv[1] if len(sys.argv) > 1 else TEMPLATE_PATH
+    print(compile_catalog(template_path))
@@ -1,9 +1,21 @@
-import fuzzychinese
+import os
 import re
-import contextlib
-import io
+import numpy as np
 
 from .base import FuzzyMatchBase
+from .catalog import build_ngram_indexes
+from .ngram_index import keep_top_n, SegmentedNgramIndex
+from .item import SingleItem
+from .memo import get_query_memo, MISSING
+from .normalize import NormalizedIndex
+
+# 每批参与矩阵运算的名称数，控制 [批大小, 品名数] 相似度矩阵的内存
+MATCH_CHUNK_SIZE = 256
+# 品名数达到该值的订单资料改用两阶段检索（倒排表取候选，只对候选打分），0为始终使用
+MATCH_RETRIEVAL_MIN_NAMES = int(os.environ.get('MATCH_RETRIEVAL_MIN_NAMES', 20000))
+# 两阶段检索的召回：笔画/部首各取的候选数，以及取候选时使用的查询n-gram权重比例，越大越接近全量计算
+MATCH_CANDIDATES = int(os.environ.get('MATCH_CANDIDATES', 200))
+MATCH_QUERY_COVERAGE = float(os.environ.get('MATCH_QUERY_COVERAGE', 0.8))
 
 def split_ocr_row(text):
     # Updated pattern to capture mixed quantity+unit blocks
@@ -51,51 +63,53 @@ def split_ocr_row(text):
 
     return result
 
-class SingleItem:
-    def __init__(self):
-        self.product_id = None
-        self.matched_name = None
-        self.origin_input = None
-        self.quantity = -1
-        self.match_score = -1
-        self.ocr_score = -1
-        self.box = None
-        self.ocr_text = None
-        self.final_text = None
-        self.warning = None
-        self.error = None
-        self.ocr_warning = None
-        self.ocr_error = None
-
-    def format_output(self):
-        return {
-            'product_id': self.product_id,
-            'matched_name': self.matched_name,
-            'origin_input': self.origin_input,
-            'quantity': self.quantity,
-            'match_score': float(self.match_score),
-        }
-
 class FuzzyMatchHandwriting(FuzzyMatchBase):
-    def __init__(self):
-        super().__init__()
-        self.build_fuzzy_match(self.template_items, self.name_to_id)
+    def __init__(self, template_path=None, customer=None):
+        super().__init__(template_path, customer)
+        self.fcm_name_radical, self.fcm_name_stroke = self.catalog.get_matcher('ngram', self.build_fuzzy_match)
+        self.name_index = self.catalog.get_matcher('normalized', self.build_name_index)
+        self.retrieval = len(self.fcm_name_stroke.names) >= MATCH_RETRIEVAL_MIN_NAMES
+        self.memo_tag = self.matching_tag(self.catalog)
+
+    @classmethod
+    def matching_tag(cls, catalog):
+        """
+        增量段与两阶段检索的结果可能与全量计算略有差异，两阶段检索的结果还随召回参数变化
+        作为查询缓存与匹配结果缓存（见 run_fuzzy_match.match_cache_key）key的一部分
+        """
+        _, stroke = catalog.get_matcher('ngram', cls.build_fuzzy_match)
+        tag = 'ngram-delta' if isinstance(stroke, SegmentedNgramIndex) else 'ngram'
+        if len(stroke.names) >= MATCH_RETRIEVAL_MIN_NAMES:
+            tag += f'-retrieval-{MATCH_RETRIEVAL_MIN_NAMES}-{MATCH_CANDIDATES}-{MATCH_QUERY_COVERAGE}'
+        return tag
     
     def fuzzy_match(self, path):
-        ocr_results = self.load_ocr_result(path)
-        ocr_results = self.fuzzy_match_ocr_single(ocr_results)
+        ocr_page, parsed = self.parse_page(path)
+        matched_names, match_scores = self.match_names([result['item'] for result in parsed])
+        self.build_items(ocr_page, parsed, matched_names, match_scores)
+
+    def parse_page(self, path):
+        """
+        读取OCR结果并拆分每行的 品名/数量/单位，返回 (OcrPage, 拆分结果列表)
+        与匹配分开，批量处理时可以先拆分多张单据，再一次性匹配全部品名
+        """
+        ocr_page = self.load_ocr_page(path)
+        return ocr_page, [split_ocr_row(text) for text in ocr_page.texts]
+
+    def build_items(self, ocr_page, parsed, matched_names, match_scores):
         self.items = list()
-        for result in ocr_results:
+        for i, result in enumerate(parsed):
+            matched_name = str(matched_names[i])
             item = SingleItem()
-            item.product_id = self.name_to_id.get((result['matched_name'], result['unit']), None)
-            item.matched_name = result['matched_name']
+            item.product_id = self.name_to_id.get((matched_name, result['unit']), None)
+            item.matched_name = matched_name
             item.origin_input = result['item']
             item.quantity = result['quantity']
-            item.match_score = result['match_score']
-            item.ocr_score = result['score']
-            item.box = result['box']
-            item.ocr_text = result['text']
-            item.final_text = result['matched_name'] + ' ' + result['quantity'] + ' ' +  result['unit']
+            item.match_score = float(match_scores[i])
+            item.ocr_score = float(ocr_page.scores[i])
+            item.box = ocr_page.boxes[i].tolist()
+            item.ocr_text = ocr_page.texts[i]
+            item.final_text = matched_name + ' ' + result['quantity'] + ' ' + result['unit']
             item.warning = result.get('warning', None)
             item.error = result.get('error', None)
             if item.match_score < 0.8:
@@ -108,58 +122,118 @@ class FuzzyMatchHandwriting(FuzzyMatchBase):
                 item.ocr_error = "ocr score < 0.5"
             self.items.append(item)
                 
-    def build_fuzzy_match(self, template_items, name_to_id):
+    @staticmethod
+    def build_fuzzy_match(template_items, name_to_id):
         """
         分别build 基于笔画和部首的模糊匹配器
+        拟合结果缓存在订单资料索引上，有编译产物时直接mmap加载，见 catalog.compile_catalog
         """
-        template_item_name = [tup[0] for tup in list(name_to_id.keys())]
-        with contextlib.redirect_stderr(io.StringIO()), contextlib.redirect_stdout(io.StringIO()):
-            self.fcm_name_radical = fuzzychinese.FuzzyChineseMatch(analyzer='radical', ngram_range=(3, 3))
-            self.fcm_name_radical.fit(template_item_name)
-            self.fcm_name_stroke = fuzzychinese.FuzzyChineseMatch(analyzer='stroke', ngram_range=(3, 3))
-            self.fcm_name_stroke.fit(template_item_name)
+        return build_ngram_indexes(name_to_id)
+
+    @staticmethod
+    def build_name_index(template_items, name_to_id):
+        return NormalizedIndex([tup[0] for tup in name_to_id.keys()])
 
     def fuzzy_match_ocr_single(self, ocr_results):
-        for row in ocr_results:
-            result = split_ocr_row(row['text'])
-            row.update(result)
-            if row.get('item', None) is None:
+        return self.fuzzy_match_ocr_batch([ocr_results])[0]
+
+    def fuzzy_match_ocr_batch(self, pages):
+        """
+        多页（或多张单据）的OCR结果一起解析，所有品名一次性送入 match_names
+        """
+        rows = list()
+        for ocr_results in pages:
+            for row in ocr_results:
+                result = split_ocr_row(row['text'])
+                row.update(result)
+                if row.get('item', None) is None:
+                    continue
+                rows.append(row)
+        matched_names, match_scores = self.match_names([row['item'] for row in rows])
+        for row, matched_name, match_score in zip(rows, matched_names, match_scores):
+            row['matched_name'] = str(matched_name)
+            row['match_score'] = float(match_score)
+        return pages
+
+    def match_names(self, names, top_n=3):
+        """
+        批量模糊匹配，返回每个名称的 (匹配品名, 匹配分数)
+        与品名精确相同或繁简/全半角/标点归一化后相同的名称直接采用，分数为1，见 normalize.py
+        其余名称重复的只计算一次，之前匹配过的直接取查询缓存，见 memo.py
+        """
+        memo = get_query_memo()
+        matched_names = np.empty(len(names), dtype=object)
+        match_scores = np.zeros(len(names))
+        positions = dict()
+        for i, name in enumerate(names):
+            positions.setdefault(name, list()).append(i)
+        pending = list()
+        for name, index in positions.items():
+            exact = self.name_index.lookup(name)
+            if exact is not None:
+                matched_names[index] = exact
+                match_scores[index] = 1.0
                 continue
-            ocr_item_name = row['item']
-            with contextlib.redirect_stdout(io.StringIO()):
-                fuzzy_result_stroke = self.fcm_name_stroke.transform([ocr_item_name])[0]
-                similarity_scores_stroke = self.fcm_name_stroke.get_similarity_score()[0]
-
-                fuzzy_result_radical = self.fcm_name_radical.transform([ocr_item_name])[0]
-                similarity_scores_radical = self.fcm_name_radical.get_similarity_score()[0]
-            # print(f"OCR识别结果：{ocr_item_name}，模糊匹配结果：{fuzzy_result}, 相似度分数：{similarity_scores}")
-            
-            stroke_scores = {}
-            radical_scores = {}
-            
-            # fuzzy chinese transform 返回结果可能存在重复元素，需要去重处理
-            for item, score in zip(fuzzy_result_stroke, similarity_scores_stroke):
-                if item not in stroke_scores or score > stroke_scores[item]:
-                    stroke_scores[item] = score
-            
-            for item, score in zip(fuzzy_result_radical, similarity_scores_radical):
-                if item not in radical_scores or score > radical_scores[item]:
-                    radical_scores[item] = score
-            
-            # 综合两组评分
-            combined_scores = {}
-            all_items = set(stroke_scores.keys()) | set(radical_scores.keys())
-            
-            for item in all_items:
-                stroke_score = stroke_scores.get(item, 0)
-                radical_score = radical_scores.get(item, 0)
-                combined_scores[item] = max(stroke_score, radical_score) + min(stroke_score, radical_score) / 10
-            
-            sorted_items = sorted(combined_scores.keys(), 
-                                key=lambda x: combined_scores[x], 
-                                reverse=True)
-            sorted_scores = [combined_scores[item] for item in sorted_items]
-    
-            row['matched_name'] = sorted_items[0]
-            row['match_score'] = sorted_scores[0] if sorted_scores[0] < 1.0 else 1.0
-        return ocr_results
+            cached = memo.get((self.catalog.version, self.memo_tag, top_n, name))
+            if cached is MISSING:
+                pending.append(name)
+                continue
+            matched_names[index] = cached[0]
+            match_scores[index] = cached[1]
+        if pending:
+            pending_names, pending_scores = self.compute_names(pending, top_n)
+            for name, matched_name, match_score in zip(pending, pending_names, pending_scores):
+                memo.put((self.catalog.version, self.memo_tag, top_n, name), (matched_name, float(match_score)))
+                matched_names[positions[name]] = matched_name
+                match_scores[positions[name]] = match_score
+        return matched_names, match_scores
+
+    def compute_names(self, names, top_n=3):
+        """
+        笔画与部首各做一次稀疏矩阵乘法，各自只保留top n的分数，
+        综合评分 max + min / 10，分数上限为1
+        大订单资料改用 retrieve_names
+        """
+        if self.retrieval:
+            return self.retrieve_names(names, top_n)
+        matched_names = np.empty(len(names), dtype=object)
+        match_scores = np.zeros(len(names))
+        for start in range(0, len(names), MATCH_CHUNK_SIZE):
+            chunk = names[start:start + MATCH_CHUNK_SIZE]
+            stroke_scores = keep_top_n(self.fcm_name_stroke.similarity(chunk), top_n)
+            radical_scores = keep_top_n(self.fcm_name_radical.similarity(chunk), top_n)
+            combined_scores = np.maximum(stroke_scores, radical_scores) + np.minimum(stroke_scores, radical_scores) / 10
+            best = combined_scores.argmax(axis=1)
+            # 没有共同的n-gram时取第一个有效的品名，分数为0
+            best[combined_scores[np.arange(len(chunk)), best] == 0] = self.fcm_name_stroke.first_active
+            matched_names[start:start + len(chunk)] = self.fcm_name_stroke.names[best]
+            match_scores[start:start + len(chunk)] = np.minimum(combined_scores[np.arange(len(chunk)), best], 1.0)
+        return matched_names, match_scores
+
+    def retrieve_names(self, names, top_n=3, candidates=MATCH_CANDIDATES, coverage=MATCH_QUERY_COVERAGE):
+        """
+        两阶段检索：笔画与部首各自沿倒排表取候选（见 NgramIndex.candidates），合并后只对候选计算两种相似度
+        综合评分与 compute_names 相同，真正的top n都在候选中时结果一致
+        """
+        matched_names = np.empty(len(names), dtype=object)
+        match_scores = np.zeros(len(names))
+        stroke_vectors = self.fcm_name_stroke.vectorize(names)
+        radical_vectors = self.fcm_name_radical.vectorize(names)
+        columns = [np.union1d(stroke, radical) for stroke, radical in zip(
+            self.fcm_name_stroke.candidates(stroke_vectors, candidates, coverage),
+            self.fcm_name_radical.candidates(radical_vectors, candidates, coverage))]
+        stroke_scores = self.fcm_name_stroke.score(stroke_vectors, columns)
+        radical_scores = self.fcm_name_radical.score(radical_vectors, columns)
+        for i, (column, stroke, radical) in enumerate(zip(columns, stroke_scores, radical_scores)):
+            # 与全量计算相同：没有共同的n-gram时取第一个有效的品名，分数为0
+            matched_names[i] = self.fcm_name_stroke.names[self.fcm_name_stroke.first_active]
+            if not len(column):
+                continue
+            stroke = keep_top_n(stroke[None], top_n)[0]
+            radical = keep_top_n(radical[None], top_n)[0]
+            combined = np.maximum(stroke, radical) + np.minimum(stroke, radical) / 10
+            best = combined.argmax()
+            if combined[best] > 0:
+                matched_names[i] = self.fcm_name_stroke.names[column[best]]
+                match_scores[i] = min(combined[best], 1.0)
+        return matched_names, match_scores
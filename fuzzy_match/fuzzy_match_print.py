@@ -1,107 +1,119 @@
-import fuzzywuzzy
 import re
 import os
-import fuzzywuzzy.process
 import numpy as np
-from copy import deepcopy
-import pandas as pd
+from rapidfuzz import fuzz, process
 from .base import FuzzyMatchBase, draw_chinese_text_in_box
-from PIL import Image, ImageDraw, ImageFont
+from .ocr_page import nearest_column
+from .item import SingleItem
+from .memo import get_query_memo, MISSING
+from .normalize import normalize_name
+from PIL import Image
 
-class SingleItem:
-    def __init__(self):
-        self.product_id = None
-        self.matched_name = None
-        self.origin_input = None
-        self.quantity = None
-        self.match_score = -1
-        self.ocr_score = -1
-        self.box = None
-        self.ocr_text = ''
-        self.final_text = ''
-        self.warning = None
-        self.error = None
-        self.ocr_warning = None
-        self.ocr_error = None
-        self.price = None
-        self.total_price = None
-        self.unit = None
-        self.product_name = None
-        self.row_text = None
-        self.page_index = -1
+# 断行阈值与页面box高度中位数的比例，300DPI下行高约40像素，对应原来固定的15像素
+ROW_GAP_RATIO = 0.375
+
+# 品号下品名的匹配分数达到该值时直接采用，否则回退到全量检索，确认品名是否在top5内
+ID_MATCH_SCORE = 80
+# 表头之前的客户信息：客户代号（SAP）或请款对象（Oracle），见 load_customer_info
+CUSTOMER_STR = ["客戶代號", "請款對象"]
+CUSTOMER_INFO_END = ["項次"]
+_NON_WORD = re.compile(r"(?ui)\W")
+_NON_ASCII = dict((i, None) for i in range(128, 256))
+
+
+def full_process(s):
+    """
+    与 fuzzywuzzy.utils.full_process(s, force_ascii=True) 一致，保证分数与原来的 process.extract 相同
+    """
+    return _NON_WORD.sub(" ", str(s).translate(_NON_ASCII)).lower().strip()
+
+
+def find_customer_name(texts):
+    """与 load_customer_info 相同的规则，只取第一页的客户名称，用于匹配前确定订单资料"""
+    customer_name = None
+    for text in texts:
+        if any(x in text for x in CUSTOMER_INFO_END):
+            break
+        if any(x in text for x in CUSTOMER_STR):
+            customer_name = text.split(':')[-1]
+    return customer_name
+
+
+class NameIndex:
+    """
+    打印体品名检索索引，按订单资料缓存
+    choices: 预处理后的全部 (品名, 单位)，用于全量检索
+    id_to_choices: 品号 -> 该品号下的 [(序号, 预处理后的品名)]
+    id_to_normalized: 品号 -> {归一化后的品名: 序号}，同一品号下相同的取第一个
+    """
+    def __init__(self, template_items, name_to_id):
+        self.keys = list(name_to_id.keys())
+        self.ids = [name_to_id[key] for key in self.keys]
+        # 与 fuzzywuzzy 相同，元组整体转为字符串后参与匹配
+        self.choices = [full_process(key) for key in self.keys]
+        self.id_to_choices = dict()
+        self.id_to_normalized = dict()
+        for i, (id, choice) in enumerate(zip(self.ids, self.choices)):
+            self.id_to_choices.setdefault(id, list()).append((i, choice))
+            if self.keys[i][0]:
+                self.id_to_normalized.setdefault(id, dict()).setdefault(normalize_name(self.keys[i][0]), i)
+
+    def match_normalized(self, product_name, product_id):
+        """品号下有归一化后相同的品名时返回其序号，否则返回None"""
+        return self.id_to_normalized.get(product_id, {}).get(normalize_name(product_name))
+
+    def match_id(self, query, product_id):
+        """
+        只对品号下的品名打分，返回 (序号, 分数)，品号下没有品名时返回None
+        """
+        best = None
+        for i, choice in self.id_to_choices.get(product_id, []):
+            score = round(fuzz.WRatio(query, choice, processor=None))
+            if best is None or score > best[1]:
+                best = (i, score)
+        return best
+
+    def extract(self, query, limit=5):
+        """全量检索，返回 [(序号, 分数)]，同分按订单资料顺序"""
+        result = process.extract(query, self.choices, scorer=fuzz.WRatio, processor=None, limit=limit)
+        return [(i, round(score)) for _, score, i in result]
 
-    def format_output(self):
-        return {
-            'product_id': self.product_id,
-            'matched_name': self.matched_name,
-            'origin_input': self.origin_input,
-            'quantity': self.quantity,
-            'match_score': float(self.match_score),
-        }
 
 class FuzzyMatchPrint(FuzzyMatchBase):
     """
     基于打印字的模糊匹配器
     属性的对齐规则，以及用户信息的提取规则基于提供的pdf作为模板设计
     """
-    def __init__(self):
-        super().__init__()
+    # 打印体品名整体匹配，不做拆分
+    split_item_name = False
+
+    def __init__(self, template_path=None, customer=None):
+        super().__init__(template_path, customer)
         self.titles = list()
         self.title_left_position = list()
         self.items = list()
         
-    def load_items(self):
-        """订单资料存在重复品号以及品号下多个品名情况，先处理成独立的词
-        处理逻辑：品名按照正斜杠与反斜杠做分隔，品名+单位绑定为一个元组，映射到一个品号id
-        如果品名+单位有重复，只保留第一个
-        """
-        ITEMS = dict()
-        NAME_to_ID = dict()
-        df = pd.read_excel(self.template_path, engine='openpyxl')
-        for index, row in df.iterrows():
-            id = row['品號']
-            if not isinstance(id, str) and np.isnan(id):
-                continue
-            ITEMS.setdefault(id, dict())
-            ITEMS[id].setdefault('name', set())
-            if row['品名'] is not None:
-                result_unit = (row['品名'], row['單位'])
-                ITEMS[id]['name'].add(result_unit)
-                if result_unit not in NAME_to_ID:
-                    NAME_to_ID[result_unit] = id
-                elif NAME_to_ID[result_unit] != id:
-                    print(f"品名 {result_unit} 重复，请确认品号 {NAME_to_ID[result_unit], id}")
-                else:
-                    pass
-        self.template_items = ITEMS
-        self.name_to_id = NAME_to_ID
-        
     def fuzzy_match(self, path_list):
         ocr_results = self.load_pdf_ocr_result(path_list)
         self.parse_ocr_results(ocr_results)
-        names = list(self.name_to_id.keys())
+        if self.customer is None and self.template_path is None and self.customer_name:
+            self.select_customer(self.customer_name)
+        name_index = self.catalog.get_matcher('name_index', NameIndex)
         for item in self.items:
             item.origin_input = item.product_name
-            if item.product_id is not None and item.product_name is not None:
-                result = fuzzywuzzy.process.extract(item.product_name, names, limit=5)
+            if item.product_id and item.product_name is not None:
                 if item.product_id in self.template_items:
-                    name_matched_id = False
-                    for candidate in result:
-                        candidate_name = candidate[0][0]
-                        if item.product_id == self.name_to_id[candidate[0]]:
-                            item.matched_name = candidate_name
-                            item.match_score = candidate[1] / 100.0
-                            name_matched_id = True
-                            break
-                        else:
-                            pass
-                    if not name_matched_id:
+                    matched = self.match_product_name(name_index, item.product_name, item.product_id)
+                    if matched is not None:
+                        item.matched_name = name_index.keys[matched[0]][0]
+                        item.match_score = matched[1] / 100.0
+                    else:
                         item.error = "Product ID and name do not match"
                         item.match_score = 0.0
                 else:
-                    item.error = "Product ID not found in customer template"
-                    item.match_score = 0.0
-                    item.product_id = None
+                    self.match_by_name(name_index, item, "Product ID not found in customer template")
+            elif item.product_name is not None:
+                self.match_by_name(name_index, item, "Missing product ID")
             else:
                 item.error = "Missing product ID or name"
             if item.product_id is not None:
@@ -124,10 +136,69 @@ class FuzzyMatchPrint(FuzzyMatchBase):
             if item.quantity is None:
                 item.error = "Unrecognizable quantity"
 
+    def match_product_name(self, name_index, product_name, product_id):
+        """
+        先只对品号下的品名打分，分数足够高时直接采用；
+        否则回退到全量检索，品名的top5中第一个属于该品号的候选即为匹配结果
+        结果（包括没有匹配的None）按 (品名, 品号) 记在查询缓存中
+        品号下有繁简/全半角/标点归一化后相同的品名时直接采用，分数为100
+        """
+        exact = name_index.match_normalized(product_name, product_id)
+        if exact is not None:
+            return exact, 100
+        query = full_process(product_name)
+        memo = get_query_memo()
+        key = (self.catalog.version, 'print', query, product_id)
+        matched = memo.get(key)
+        if matched is MISSING:
+            matched = self.compute_product_name(name_index, query, product_id)
+            memo.put(key, matched)
+        return matched
+
+    def match_by_name(self, name_index, item, reason):
+        """
+        品号缺失或不在订单资料中：只按品名全量检索（与品号下分数不足时相同的top5检索），取分数最高的候选及其品号
+        品号未经确认，分数达到 ID_MATCH_SCORE 时给出warning，否则仍为error，匹配结果只作为参考
+        """
+        query = full_process(item.product_name)
+        memo = get_query_memo()
+        key = (self.catalog.version, 'print', query, None)
+        matched = memo.get(key)
+        if matched is MISSING:
+            candidates = name_index.extract(query, limit=5)
+            matched = candidates[0] if candidates else None
+            memo.put(key, matched)
+        if matched is None:
+            item.error = reason
+            item.match_score = 0.0
+            item.product_id = None
+            return
+        item.product_id = name_index.ids[matched[0]]
+        item.matched_name = name_index.keys[matched[0]][0]
+        item.match_score = matched[1] / 100.0
+        if matched[1] >= ID_MATCH_SCORE:
+            # 解析行时记录的品号缺失error由按品名匹配的warning代替
+            item.error = None
+            item.warning = reason + ", matched by name"
+        else:
+            item.error = reason
+
+    def compute_product_name(self, name_index, query, product_id):
+        matched = name_index.match_id(query, product_id)
+        if matched is not None and matched[1] >= ID_MATCH_SCORE:
+            return matched
+        for i, score in name_index.extract(query, limit=5):
+            if name_index.ids[i] == product_id:
+                return i, score
+        return None
+
     def load_pdf_ocr_result(self, path_list):
+        """
+        有二进制结果（.ocrp）的页面只读取header并mmap，数组与文字在解析用到时才从文件读入
+        """
         ocr_results = list()
         for path in path_list:
-            ocr_result = self.load_ocr_result(path)
+            ocr_result = self.load_ocr_page(path)
             ocr_results.append(ocr_result)
         
         return ocr_results
@@ -152,16 +223,13 @@ class FuzzyMatchPrint(FuzzyMatchBase):
         """
         目前读前n项，使用后一项'項次'做确认
         """
-        end_str = ["項次"]
-        customer_str = ["客戶代號", "請款對象"]
         date_str = ["訂單日期"]
         idx = start_index
         while True:
-            item = ocr_result[idx]
-            text = item['text']
-            if any(x in text for x in end_str):
+            text = ocr_result.texts[idx]
+            if any(x in text for x in CUSTOMER_INFO_END):
                 break
-            if any(x in text for x in customer_str):
+            if any(x in text for x in CUSTOMER_STR):
                 self.customer_name = text.split(':')[-1]
             if any(x in text for x in date_str):
                 self.order_date = text.split(':')[-1]
@@ -183,90 +251,61 @@ class FuzzyMatchPrint(FuzzyMatchBase):
         }
         idx = start_index
         while True:
-            item = ocr_result[idx]
-            text = item['text']
+            text = ocr_result.texts[idx]
             if any(x in text for x in list(str_to_keys.keys())):
                 if text not in str_to_keys:
                     raise ValueError(f"未知的表头：{text}")
                 self.titles.append(str_to_keys[text])
-                self.title_left_position.append(item['box'][0])
+                self.title_left_position.append(ocr_result.lefts[idx])
                 idx += 1
                 continue
             break
         self.title_left_position = np.array(self.title_left_position)
         return idx
     
-    def load_table_item(self, origin_ocr_result, page_index, start_index=0):
+    def load_table_item(self, ocr_result, page_index, start_index=0):
         """
-        按照box top pixel 位置来分割行，按行处理
-        按照box left pixel 来确认text属于哪一列
+        按照box top pixel 位置来分割行，相邻top之差超过 ROW_GAP_RATIO * 页面box高度中位数 处断行，按行处理
+        按照box left pixel 来确认text属于哪一列，整页一次性计算
         """
-        ocr_result = deepcopy(origin_ocr_result[start_index:])
-        ocr_result.sort(key=lambda x: x['box'][1])
-        
-        current_row = []
-        previous_top = None
-        
-        for res in ocr_result:
-            top = res['box'][1]
-            if previous_top is not None and abs(top - previous_top) > 15:
-                if len(current_row) <= 2:
-                    item = self.process_special_row(current_row)
-                    if item:
-                        item.page_index = page_index
-                        self.items.append(item)
-                    current_row = []
-                else:
-                    item = self.process_row(current_row)
-                    item.page_index = page_index
-                    self.items.append(item)
-                    current_row = []
-            
-            current_row.append(res)
-            previous_top = top
-        
-        if current_row:
-            if len(current_row) <= 2:
-                item = self.process_special_row(current_row)
+        gap = ROW_GAP_RATIO * ocr_result.median_height()
+        columns = nearest_column(ocr_result.lefts, self.title_left_position)
+        for row in ocr_result.split_rows(start_index, gap):
+            if len(row) <= 2:
+                item = self.process_special_row(ocr_result, row)
                 if item:
                     item.page_index = page_index
                     self.items.append(item)
             else:
-                item = self.process_row(current_row)
+                item = self.process_row(ocr_result, row, columns)
                 item.page_index = page_index
                 self.items.append(item)
 
-    def process_row(self, row_data):
+    def process_row(self, ocr_result, row, columns):
         """
         Process a single row of OCR results and create a SingleItem object.
+        row: 该行文字块在页面中的序号，columns: 页面中每个文字块所属的列（-1为无法归属）
         """
         item = SingleItem()
-        row_box = [float('inf'), float('inf'), float('-inf'), float('-inf')]  # [x1, y1, x2, y2]
-        row_data = sorted(row_data, key=lambda res: res['box'][0])
+        row = row[np.argsort(ocr_result.lefts[row], kind='stable')]
+        row_boxes = ocr_result.boxes[row]
+        # [x1, y1, x2, y2]
+        row_box = [int(row_boxes[:, 0].min()), int(row_boxes[:, 1].min()),
+                   int(row_boxes[:, 2].max()), int(row_boxes[:, 3].max())]
 
-        for res in row_data:
-            text = res['text']
-            score = res['score']
+        for i in row:
+            text = ocr_result.texts[i]
             item.ocr_text += text + ' - '
-            left = res['box'][0]
-            top = res['box'][1]
-            right = res['box'][2]
-            bottom = res['box'][3]
-            
-            row_box[0] = min(row_box[0], left)
-            row_box[1] = min(row_box[1], top)
-            row_box[2] = max(row_box[2], right)
-            row_box[3] = max(row_box[3], bottom)
-            
-            column_index = self.get_column_index(left, self.title_left_position)
+            column_index = columns[i]
             
-            if column_index is None:
+            if column_index < 0:
                 item.warning = f"Text '{text}' has an unrecognized position."
                 continue
             
             column_name = self.titles[column_index]
             setattr(item, column_name, text)
             if column_name in ['quantity','product_id', 'product_name']:
+                score = float(ocr_result.scores[i])
                 if item.ocr_score == -1:
                     item.ocr_score = score
                 else:
@@ -280,8 +319,8 @@ class FuzzyMatchPrint(FuzzyMatchBase):
             item.error = "Missing product name"
         return item
     
-    def process_special_row(self, row_data):
-        text = row_data[0]['text']
+    def process_special_row(self, ocr_result, row):
+        text = ocr_result.texts[row[0]]
         if "總金額" in text:
             numbers = re.findall(r'\d+\.?\d*', text)
             self.order_price = float(numbers[0])
@@ -309,12 +348,6 @@ class FuzzyMatchPrint(FuzzyMatchBase):
             # item.error = "Unrecognized special row"
             # return item
 
-    def get_column_index(self, left_position, title_left_position, threshold=10):
-        diff = np.abs(left_position - title_left_position)
-        min_idx = np.argmin(diff)
-        min_diff = diff[min_idx]
-        return min_idx if min_diff <= threshold else None
-    
     def render_result(self, src_list):
         origin_imgs = list()
         ocr_imgs = list()
@@ -324,8 +357,8 @@ class FuzzyMatchPrint(FuzzyMatchBase):
             'warning': (180, 180, 0),
             'error': (255, 0, 0)
         }
-        for src in src_list:
-            img = Image.open(src)
+        for page_index, src in enumerate(src_list):
+            img = self.load_page_image(src, page_index)
             origin_imgs.append(img)
             width, height = origin_imgs[0].size
             ocr_result_image = Image.new('RGB', (width, height), color='white')
@@ -354,6 +387,7 @@ class FuzzyMatchPrint(FuzzyMatchBase):
             color = state2color[state]
             match_result_image = draw_chinese_text_in_box(match_result_image, item.final_text, box, text_color=color)
             
+        render_paths = list()
         for origin_img, ocr_img, match_img, src_path in zip(origin_imgs, ocr_imgs, match_imgs, src_list):
             final_img = Image.new('RGB', (width*3, height))
             final_img.paste(origin_img, (0, 0))
@@ -363,5 +397,5 @@ class FuzzyMatchPrint(FuzzyMatchBase):
             if not os.path.exists(os.path.dirname(render_path)):
                 os.makedirs(os.path.dirname(render_path))
             final_img.save(render_path)
-            
-            
\ No newline at end of file
+            render_paths.append(render_path)
+        return render_paths
@@ -0,0 +1,42 @@
+class SingleItem:
+    """
+    单个识别项，打印体与手写匹配共用
+    使用 __slots__，实例不带 __dict__，大批量构造时内存与分配次数都更少
+    index 用于打印体表头“項次”一列（按表头名 setattr）
+    """
+    __slots__ = (
+        'product_id', 'matched_name', 'origin_input', 'quantity', 'match_score', 'ocr_score',
+        'box', 'ocr_text', 'final_text', 'warning', 'error', 'ocr_warning', 'ocr_error',
+        'price', 'total_price', 'unit', 'product_name', 'row_text', 'page_index', 'index',
+    )
+
+    def __init__(self):
+        self.product_id = None
+        self.matched_name = None
+        self.origin_input = None
+        self.quantity = None
+        self.match_score = -1
+        self.ocr_score = -1
+        self.box = None
+        self.ocr_text = ''
+        self.final_text = ''
+        self.warning = None
+        self.error = None
+        self.ocr_warning = None
+        self.ocr_error = None
+        self.price = None
+        self.total_price = None
+        self.unit = None
+        self.product_name = None
+        self.row_text = None
+        self.page_index = -1
+        self.index = None
+
+    def format_output(self):
+        return {
+            'product_id': self.product_id,
+            'matched_name': self.matched_name,
+            'origin_input': self.origin_input,
+            'quantity': self.quantity,
+            'match_score': float(self.match_score),
+        }
@@ -0,0 +1,100 @@
+import os
+import atexit
+import pickle
+import threading
+from collections import OrderedDict
+
+# 同一客户的订单反复出现相同的品名写法，按 (订单资料版本, 匹配方式, 查询) 记住匹配结果，重复的查询不再计算相似度
+MATCH_MEMO_SIZE = int(os.environ.get('MATCH_MEMO_SIZE', 100000))
+# 给出路径时启动加载、退出时保存，重启后沿用
+MATCH_MEMO_PATH = os.environ.get('MATCH_MEMO_PATH', '')
+
+MISSING = object()
+
+
+class QueryMemo:
+    """
+    有界的LRU查询结果缓存，打印体与手写匹配器共用
+    key 中包含订单资料的 version，订单资料更新后旧结果不再命中，随LRU淘汰
+    """
+    def __init__(self, size=MATCH_MEMO_SIZE, path=MATCH_MEMO_PATH):
+        self.size = size
+        self.path = path
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if path:
+            self.load(path)
+
+    def get(self, key, default=MISSING):
+        """未命中返回 default（缓存的结果本身可能是None）"""
+        with self.lock:
+            value = self.entries.get(key, MISSING)
+            if value is MISSING:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return dict(size=len(self.entries), capacity=self.size, hits=self.hits, misses=self.misses,
+                        hit_rate=self.hits / total if total else 0.0)
+
+    def load(self, path):
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, 'rb') as f:
+                entries = pickle.load(f)
+        except Exception as e:
+            print(f"匹配缓存 {path} 读取失败：{e!r}")
+            return
+        with self.lock:
+            for key, value in entries:
+                self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def save(self, path=None):
+        path = path or self.path
+        if not path:
+            return
+        with self.lock:
+            entries = list(self.entries.items())
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        tmp_path = f'{path}.tmp-{os.getpid()}'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+
+_memo = None
+_memo_lock = threading.Lock()
+
+
+def get_query_memo():
+    global _memo
+    with _memo_lock:
+        if _memo is None:
+            _memo = QueryMemo()
+            if _memo.path:
+                atexit.register(_memo.save)
+        return _memo
@@ -0,0 +1,305 @@
+import os
+import logging
+
+import numpy as np
+import scipy.sparse as sp
+from fuzzychinese import Stroke, Radical
+
+# 非中文字符以及无法拆分的字fuzzychinese会逐个打印warning
+logging.getLogger('fuzzychinese').setLevel(logging.ERROR)
+# 估算词表dict每项的内存开销，字节
+VOCABULARY_ENTRY_BYTES = 160
+
+_TOKENIZERS = dict()
+
+
+def get_tokenizer(analyzer):
+    """笔画/部首字典读取较慢，进程内只读一次"""
+    if analyzer not in _TOKENIZERS:
+        if analyzer == 'stroke':
+            _TOKENIZERS[analyzer] = Stroke().get_stroke
+        elif analyzer == 'radical':
+            _TOKENIZERS[analyzer] = Radical().get_radical
+        else:
+            raise ValueError(f"未知的analyzer：{analyzer}")
+    return _TOKENIZERS[analyzer]
+
+
+def select_terms(vectors, coverage):
+    """
+    每个查询向量只保留权重最大的若干n-gram，保留部分的权重平方和达到总和的 coverage
+    idf高（罕见）的n-gram权重大、倒排表短，只用它们取候选，不扫描常见n-gram的长倒排表
+    """
+    indptr = [0]
+    indices = [np.zeros(0, dtype=np.int32)]
+    data = [np.zeros(0)]
+    for i in range(vectors.shape[0]):
+        start, end = vectors.indptr[i], vectors.indptr[i + 1]
+        weights = vectors.data[start:end]
+        order = np.argsort(-weights, kind='stable')
+        cumulative = np.cumsum(weights[order] ** 2)
+        if len(order):
+            order = order[:int(np.searchsorted(cumulative, coverage * cumulative[-1])) + 1]
+        indices.append(vectors.indices[start:end][order])
+        data.append(weights[order])
+        indptr.append(indptr[-1] + len(order))
+    return sp.csr_matrix((np.concatenate(data), np.concatenate(indices), np.asarray(indptr)), shape=vectors.shape)
+
+
+def keep_top_n(sim, n):
+    """
+    每行只保留最大的n个分数，其余置0
+    """
+    n = min(n, sim.shape[1])
+    top_index = np.argpartition(-sim, range(n), axis=1)[:, :n]
+    kept = np.zeros_like(sim)
+    np.put_along_axis(kept, top_index, np.take_along_axis(sim, top_index, axis=1), axis=1)
+    return kept
+
+
+class NgramIndex:
+    """
+    基于笔画或部首n-gram的TF-IDF余弦相似度检索，计算方式与 fuzzychinese.FuzzyChineseMatch 一致
+    词表、idf以及名称的特征矩阵都是普通的numpy数组，可以编译到磁盘后以mmap方式加载
+    重复的名称只保留一行（重复名称的特征向量相同），idf仍按全部名称统计
+    """
+    def __init__(self, analyzer, ngram_range, names, vocabulary, idf, data, indices, indptr):
+        self.analyzer = analyzer
+        self.ngram_range = tuple(ngram_range)
+        self.names = names
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.matrix = sp.csr_matrix((data, indices, indptr), shape=(len(names), len(idf)), copy=False)
+        self.tokenizer = get_tokenizer(analyzer)
+        self._postings = None
+        # 没有共同n-gram的查询（整行为0分）返回的名称列
+        self.first_active = 0
+
+    def analyze(self, word):
+        """
+        与fuzzychinese相同：每个字拆成笔画/部首后以'*'连接，再切成n-gram
+        """
+        min_n, max_n = self.ngram_range
+        decomposed = '*'.join(self.tokenizer(char) for char in word)
+        if min_n == 1:
+            ngrams = list(decomposed)
+            min_n += 1
+        else:
+            ngrams = []
+        for n in range(min_n, min(max_n + 1, len(decomposed) + 1)):
+            ngrams += [decomposed[i:i + n] for i in range(len(decomposed) - n + 1)]
+        return ngrams
+
+    @classmethod
+    def fit(cls, names, analyzer='stroke', ngram_range=(3, 3)):
+        index = cls.__new__(cls)
+        index.analyzer = analyzer
+        index.ngram_range = tuple(ngram_range)
+        index.tokenizer = get_tokenizer(analyzer)
+
+        vocabulary = dict()
+        unique_names = dict()
+        document_columns = list()
+        rows = list()
+        for name in names:
+            counts = dict()
+            for ngram in index.analyze(name):
+                column = vocabulary.setdefault(ngram, len(vocabulary))
+                counts[column] = counts.get(column, 0) + 1
+            document_columns.extend(counts.keys())
+            if name not in unique_names:
+                unique_names[name] = len(unique_names)
+                rows.append(counts)
+
+        # 与sklearn TfidfVectorizer(smooth_idf=True)相同
+        df = np.bincount(np.asarray(document_columns, dtype=np.int64), minlength=len(vocabulary))
+        idf = np.log((1 + len(names)) / (1 + df.astype(np.float64))) + 1
+        matrix = cls._tfidf(rows, idf)
+        return cls(analyzer, ngram_range, np.array(list(unique_names), dtype=str),
+                   vocabulary, idf, matrix.data, matrix.indices, matrix.indptr)
+
+    @staticmethod
+    def _tfidf(rows, idf):
+        indptr = [0]
+        indices = list()
+        values = list()
+        for counts in rows:
+            indices.extend(counts.keys())
+            values.extend(counts.values())
+            indptr.append(len(indices))
+        matrix = sp.csr_matrix((np.asarray(values, dtype=np.float64),
+                                np.asarray(indices, dtype=np.int32),
+                                np.asarray(indptr, dtype=np.int32)),
+                               shape=(len(rows), len(idf)))
+        matrix = matrix.multiply(idf).tocsr()
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        matrix = sp.diags(1 / norms).dot(matrix).tocsr()
+        matrix.sort_indices()
+        return matrix
+
+    def vectorize(self, words):
+        """将待匹配的词转为l2归一化的tf-idf向量，词表外的n-gram忽略"""
+        rows = list()
+        for word in words:
+            counts = dict()
+            for ngram in self.analyze(word):
+                column = self.vocabulary.get(ngram)
+                if column is not None:
+                    counts[column] = counts.get(column, 0) + 1
+            rows.append(counts)
+        return self._tfidf(rows, self.idf)
+
+    def similarity(self, words):
+        """返回 [len(words), len(names)] 的余弦相似度矩阵"""
+        return self.vectorize(words).dot(self.matrix.T).toarray()
+
+    @property
+    def postings(self):
+        """n-gram -> 名称的倒排表（特征矩阵的转置，csr），首次两阶段检索时构建"""
+        if self._postings is None:
+            self._postings = self.matrix.T.tocsr()
+        return self._postings
+
+    def candidates(self, vectors, k, coverage):
+        """
+        两阶段检索的第一阶段：vectors 为 vectorize 的结果
+        按 select_terms 取每个查询的部分n-gram，沿倒排表累加部分分数，返回部分分数最高的k个名称序号（每个查询一个数组）
+        耗时与取到的倒排表长度成正比：部首n-gram较罕见，只涉及少量名称；笔画n-gram常见，倒排表长，用 coverage 限制
+        """
+        partial = select_terms(vectors, coverage).dot(self.postings).tocsr()
+        result = list()
+        for i in range(partial.shape[0]):
+            start, end = partial.indptr[i], partial.indptr[i + 1]
+            columns = partial.indices[start:end]
+            if len(columns) > k:
+                columns = columns[np.argpartition(-partial.data[start:end], k - 1)[:k]]
+            result.append(np.sort(columns))
+        return result
+
+    def score(self, vectors, candidates):
+        """第二阶段：每个查询与其候选名称的余弦相似度，与 similarity 中对应列的值相同（求和顺序不同，末位可能有差异）"""
+        lengths = [len(columns) for columns in candidates]
+        if not sum(lengths):
+            return [np.zeros(0) for _ in candidates]
+        # 所有查询的候选一次取出，查询向量按候选数重复后逐行点乘
+        rows = np.repeat(np.arange(len(candidates)), lengths)
+        scores = np.asarray(vectors[rows].multiply(self.matrix[np.concatenate(candidates)]).sum(axis=1)).ravel()
+        return np.split(scores, np.cumsum(lengths)[:-1])
+
+    def top_n(self, words, n=3):
+        """
+        返回每个词最相似的n个名称及分数，按分数从高到低排列
+        """
+        sim = self.similarity(words)
+        n = min(n, sim.shape[1])
+        top_index = np.argpartition(-sim, range(n), axis=1)[:, :n]
+        return self.names[top_index], np.take_along_axis(sim, top_index, axis=1)
+
+    @property
+    def nbytes(self):
+        """数组大小加上词表dict的估算"""
+        arrays = (self.matrix.data, self.matrix.indices, self.matrix.indptr, self.idf, np.asarray(self.names))
+        if self._postings is not None:
+            arrays += (self._postings.data, self._postings.indices, self._postings.indptr)
+        return sum(array.nbytes for array in arrays) + len(self.vocabulary) * VOCABULARY_ENTRY_BYTES
+
+    def save(self, path):
+        """按 <path>.<字段>.npy 存盘，load 时可mmap"""
+        vocabulary = np.empty(len(self.vocabulary), dtype=object)
+        for ngram, column in self.vocabulary.items():
+            vocabulary[column] = ngram
+        np.save(path + '.names.npy', np.asarray(self.names, dtype=str))
+        np.save(path + '.vocabulary.npy', vocabulary.astype(str))
+        np.save(path + '.idf.npy', self.idf)
+        np.save(path + '.data.npy', self.matrix.data)
+        np.save(path + '.indices.npy', self.matrix.indices)
+        np.save(path + '.indptr.npy', self.matrix.indptr)
+
+    @classmethod
+    def load(cls, path, analyzer, ngram_range, mmap_mode='r'):
+        def load_array(field):
+            return np.load(path + '.' + field + '.npy', mmap_mode=mmap_mode)
+        vocabulary = {str(ngram): column for column, ngram in enumerate(load_array('vocabulary'))}
+        return cls(analyzer, ngram_range, load_array('names'), vocabulary, load_array('idf'),
+                   load_array('data'), load_array('indices'), load_array('indptr'))
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(path + '.indptr.npy')
+
+
+class SegmentedNgramIndex:
+    """
+    订单资料增量修改后的n-gram索引：不重新拟合的基础索引 + 只包含新增名称的增量段
+    基础索引中已经不存在的名称屏蔽为0分，新增名称单独拟合；接口与 NgramIndex 的 similarity/names 相同
+    增量段使用自己的idf，分数与完整重新拟合略有差异，后台合并后替换为完整的 NgramIndex，见 CatalogIndex.merge
+    """
+    def __init__(self, base, delta, active):
+        self.base = base
+        self.delta = delta
+        self.analyzer = base.analyzer
+        self.ngram_range = base.ngram_range
+        # base.names 中仍然有效的名称
+        self.active = active
+        if delta is None:
+            self.names = base.names
+        else:
+            self.names = np.concatenate([np.asarray(base.names), delta.names])
+        # 整行为0分时argmax取第0列，可能是已屏蔽的名称，改为第一个仍然有效的名称
+        active_columns = np.flatnonzero(active)
+        if len(active_columns):
+            self.first_active = int(active_columns[0])
+        else:
+            self.first_active = 0 if delta is None else len(base.names)
+
+    @classmethod
+    def build(cls, index, names):
+        """
+        index 为当前的 NgramIndex 或 SegmentedNgramIndex，names 为修改后的全部名称
+        增量段始终相对最初的基础索引拟合，多次修改不会叠加多个增量段
+        """
+        base = index.base if isinstance(index, cls) else index
+        names = list(dict.fromkeys(names))
+        current = set(names)
+        base_names = [str(name) for name in base.names]
+        active = np.fromiter((name in current for name in base_names), dtype=bool, count=len(base_names))
+        existing = set(base_names)
+        added = [name for name in names if name not in existing]
+        delta = NgramIndex.fit(added, base.analyzer, base.ngram_range) if added else None
+        return cls(base, delta, active)
+
+    @property
+    def nbytes(self):
+        return self.base.nbytes + self.active.nbytes + (0 if self.delta is None else self.delta.nbytes)
+
+    @property
+    def delta_size(self):
+        return 0 if self.delta is None else len(self.delta.names)
+
+    def vectorize(self, words):
+        return self.base.vectorize(words), None if self.delta is None else self.delta.vectorize(words)
+
+    def candidates(self, vectors, k, coverage):
+        """基础索引中仍然有效的候选，加上增量段的全部名称（增量段很小）"""
+        base_vectors, _ = vectors
+        delta_columns = np.arange(len(self.base.names), len(self.names))
+        return [np.concatenate([columns[self.active[columns]], delta_columns])
+                for columns in self.base.candidates(base_vectors, k, coverage)]
+
+    def score(self, vectors, candidates):
+        base_vectors, delta_vectors = vectors
+        offset = len(self.base.names)
+        base_scores = self.base.score(base_vectors, [columns[columns < offset] for columns in candidates])
+        if delta_vectors is None:
+            return base_scores
+        delta_scores = self.delta.score(delta_vectors, [columns[columns >= offset] - offset for columns in candidates])
+        return [np.concatenate(pair) for pair in zip(base_scores, delta_scores)]
+
+    def similarity(self, words):
+        """返回 [len(words), len(names)] 的余弦相似度矩阵，前面为基础索引的列，后面为增量段的列"""
+        sim = self.base.similarity(words)
+        sim[:, ~self.active] = 0
+        if self.delta is not None:
+            sim = np.hstack([sim, self.delta.similarity(words)])
+        return sim
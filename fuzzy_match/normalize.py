@@ -0,0 +1,54 @@
+import re
+import unicodedata
+from functools import lru_cache
+
+# 订单资料为繁体，手写OCR常返回简体（猪皮/豬皮），统一转为简体后比较；繁转简是多对一，不会因异体字（麪/麵）对不上
+try:
+    from opencc import OpenCC
+    _T2S = OpenCC('t2s')
+except ImportError:
+    print("未安装 opencc，品名归一化不做繁简转换")
+    _T2S = None
+
+# 空白、标点与下划线
+_NON_WORD = re.compile(r'[\W_]+')
+
+
+@lru_cache(maxsize=65536)
+def normalize_name(text):
+    """全角转半角（NFKC）、繁转简、去掉空白与标点、小写"""
+    text = unicodedata.normalize('NFKC', text)
+    if _T2S is not None:
+        text = _T2S.convert(text)
+    return _NON_WORD.sub('', text).lower()
+
+
+class NormalizedIndex:
+    """
+    品名的hash索引，先按原文查，再按归一化后的品名查
+    归一化后对应多个不同品名的key不收录，交给模糊匹配
+    """
+    def __init__(self, names):
+        self.names = list(names)
+        self.exact = dict()
+        self.normalized = dict()
+        ambiguous = set()
+        for i, name in enumerate(names):
+            self.exact.setdefault(name, i)
+            key = normalize_name(name)
+            if not key:
+                continue
+            first = self.normalized.setdefault(key, i)
+            if names[first] != name:
+                ambiguous.add(key)
+        for key in ambiguous:
+            del self.normalized[key]
+
+    def lookup(self, name):
+        """返回订单资料中的品名，没有精确/归一化后相同的品名时返回None"""
+        if not name:
+            return None
+        i = self.exact.get(name)
+        if i is None:
+            i = self.normalized.get(normalize_name(name))
+        return None if i is None else self.names[i]
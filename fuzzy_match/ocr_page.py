@@ -0,0 +1,244 @@
+import os
+import json
+import mmap
+import struct
+import hashlib
+import operator
+
+import numpy as np
+
+# 二进制OCR结果：与json并存的同名 .ocrp 文件，box/score 为连续的定长数组，文字为UTF-8拼接的blob加偏移表
+# 读取时整个文件mmap，数组直接是文件上的视图，文字按下标访问时才解码
+OCR_BINARY_SUFFIX = '.ocrp'
+_MAGIC = b'OCRPAGE1'
+_ALIGN = 8
+
+
+class OcrPage:
+    """
+    单页OCR结果的列式表示
+    texts: 文字列表；scores: [n] 识别分数；boxes: [n, 4] 的 (left, top, right, bottom)
+    行切分、列归属等按数组整体计算，不为每个文字块构造dict
+    """
+    def __init__(self, texts, scores, boxes):
+        self.texts = texts if isinstance(texts, TextColumn) else list(texts)
+        self.scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+        self.boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+
+    @classmethod
+    def from_result(cls, ocr_result, scale=1):
+        """ocr_result 为 save_to_json 格式的dict，box按 scale 换算（取整方式与 load_ocr_result 相同）"""
+        # 整数box（二进制结果的mmap数组）在不缩放时不复制
+        boxes = np.asarray(ocr_result['rec_boxes']).reshape(-1, 4)
+        if scale != 1:
+            boxes = np.rint(boxes * scale)
+        return cls(ocr_result['rec_texts'], ocr_result['rec_scores'], boxes)
+
+    def __len__(self):
+        return len(self.texts)
+
+    @property
+    def lefts(self):
+        return self.boxes[:, 0]
+
+    @property
+    def tops(self):
+        return self.boxes[:, 1]
+
+    def median_height(self):
+        if not len(self):
+            return 0.0
+        return float(np.median(self.boxes[:, 3] - self.boxes[:, 1]))
+
+    def split_rows(self, start_index=0, gap=15):
+        """
+        start_index 之后的文字块按top排序，相邻top相差超过 gap 处断开
+        返回每行的文字块序号数组（行内保持按top排序的顺序）
+        """
+        index = np.arange(start_index, len(self))
+        if not len(index):
+            return []
+        index = index[np.argsort(self.tops[index], kind='stable')]
+        breaks = np.flatnonzero(np.abs(np.diff(self.tops[index])) > gap) + 1
+        return np.split(index, breaks)
+
+
+def nearest_column(lefts, title_left_position, threshold=10):
+    """
+    每个left对应的最近表头列序号，距离超过 threshold 的为-1
+    表头按位置排序后 searchsorted，只比较两侧相邻的表头；等距时取表头顺序靠前的一列（与 argmin 相同）
+    """
+    lefts = np.asarray(lefts)
+    titles = np.asarray(title_left_position)
+    if not len(titles):
+        return np.full(len(lefts), -1)
+    order = np.argsort(titles, kind='stable')
+    sorted_titles = titles[order]
+    position = np.searchsorted(sorted_titles, lefts)
+    right = np.minimum(position, len(titles) - 1)
+    left = np.maximum(position - 1, 0)
+    right_diff = np.abs(lefts - sorted_titles[right])
+    left_diff = np.abs(lefts - sorted_titles[left])
+    use_right = (right_diff < left_diff) | ((right_diff == left_diff) & (order[right] < order[left]))
+    column = np.where(use_right, order[right], order[left])
+    diff = np.where(use_right, right_diff, left_diff)
+    return np.where(diff <= threshold, column, -1)
+
+
+class TextColumn:
+    """
+    offset-indexed 的文字列：blob[offsets[i]:offsets[i+1]] 为第i个文字的UTF-8编码
+    按下标取值时解码，不预先构造整页的字符串列表
+    """
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = operator.index(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('text index out of range')
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __reduce__(self):
+        # mmap上的memoryview不能pickle（批量匹配的进程池），复制为bytes
+        return TextColumn, (bytes(self.blob), np.array(self.offsets))
+
+
+def binary_result_path(json_path):
+    return os.path.splitext(json_path)[0] + OCR_BINARY_SUFFIX
+
+
+def fresh_binary_result(json_path):
+    """
+    json旁边有不早于它的 .ocrp 时返回其路径，否则返回None
+    json被单独改写（如关闭二进制输出后重新OCR）时，旧的 .ocrp 不再使用
+    """
+    binary_path = binary_result_path(json_path)
+    try:
+        if os.stat(binary_path).st_mtime_ns >= os.stat(json_path).st_mtime_ns:
+            return binary_path
+    except OSError:
+        pass
+    return None
+
+
+def _padding(size):
+    return -size % _ALIGN
+
+
+def _encode_texts(texts):
+    """文字列 -> (UTF-8 blob, int64偏移表)，TextColumn 直接返回其blob与偏移表"""
+    if isinstance(texts, TextColumn):
+        return texts.blob, texts.offsets
+    encoded = [text.encode('utf-8') for text in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(text) for text in encoded], out=offsets[1:])
+    return b''.join(encoded), offsets
+
+
+def _canonical_boxes(boxes):
+    """box全部为整数时为int64，否则为float64（二进制结果中的存储类型）"""
+    boxes = np.asarray(boxes)
+    if boxes.dtype == np.int64:
+        return boxes.reshape(-1, 4)
+    boxes = boxes.astype(np.float64).reshape(-1, 4)
+    if np.array_equal(boxes, np.rint(boxes)):
+        boxes = boxes.astype(np.int64)
+    return boxes
+
+
+def load_ocr_file(path):
+    """
+    OCR结果json路径 -> save_to_json 格式的dict
+    旁边有新的 .ocrp 时（或直接传入 .ocrp 路径）mmap读取，不解析json；已经是dict时原样返回
+    """
+    if isinstance(path, dict):
+        return path
+    binary_path = path if path.endswith(OCR_BINARY_SUFFIX) else fresh_binary_result(path)
+    if binary_path:
+        return read_ocr_binary(binary_path)
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def ocr_content_digest(result):
+    """
+    影响匹配的字段（文字、分数、box、dpi）的sha1，input_path 不参与
+    二进制结果直接对mmap上的数组与文字blob计算，不解码文字；同一结果的json与 .ocrp 得到相同的值
+    """
+    blob, offsets = _encode_texts(result['rec_texts'])
+    digest = hashlib.sha1()
+    for section in (np.ascontiguousarray(result['rec_scores'], dtype=np.float64),
+                    np.ascontiguousarray(_canonical_boxes(result['rec_boxes'])),
+                    np.ascontiguousarray(offsets, dtype=np.int64), blob):
+        digest.update(section)
+    digest.update(json.dumps(result.get('dpi')).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def save_ocr_binary(result, path):
+    """
+    result 为 save_to_json 格式的dict，写成：
+    magic | header长度(uint32) | header json | scores float64[n] | boxes [n, 4] | offsets int64[n + 1] | 文字blob
+    各段按8字节对齐；box全部为整数时存int64，否则存float64
+    """
+    blob, offsets = _encode_texts(result['rec_texts'])
+    count = len(offsets) - 1
+    scores = np.asarray(result['rec_scores'], dtype=np.float64).reshape(-1)
+    boxes = _canonical_boxes(result['rec_boxes'])
+    if not len(scores) == len(boxes) == count:
+        raise ValueError(f"OCR结果的文字、分数、box数量不一致：{count}/{len(scores)}/{len(boxes)}")
+    # 其余字段（dpi、input_path等）原样放在header中
+    header = {key: value for key, value in result.items() if key not in ('rec_texts', 'rec_scores', 'rec_boxes')}
+    header.update(count=count, boxes_dtype=boxes.dtype.str)
+    header = json.dumps(header, ensure_ascii=False, default=str).encode('utf-8')
+
+    tmp_path = f'{path}.tmp-{os.getpid()}'
+    with open(tmp_path, 'wb') as f:
+        f.write(_MAGIC + struct.pack('<I', len(header)) + header)
+        f.write(b'\0' * _padding(len(_MAGIC) + 4 + len(header)))
+        for section in (scores.tobytes(), boxes.tobytes(), offsets.tobytes(), bytes(blob)):
+            f.write(section + b'\0' * _padding(len(section)))
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_ocr_binary(path):
+    """
+    mmap读取 save_ocr_binary 写出的文件，返回与 save_to_json 格式相同字段的dict
+    rec_scores/rec_boxes 为文件上的只读数组，rec_texts 为 TextColumn
+    """
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if buffer[:len(_MAGIC)] != _MAGIC:
+        raise ValueError(f"{path} 不是二进制OCR结果")
+    header_size, = struct.unpack_from('<I', buffer, len(_MAGIC))
+    offset = len(_MAGIC) + 4
+    result = json.loads(bytes(buffer[offset:offset + header_size]).decode('utf-8'))
+    offset += header_size + _padding(offset + header_size)
+    count = result.pop('count')
+    boxes_dtype = np.dtype(result.pop('boxes_dtype'))
+
+    def section(dtype, size):
+        nonlocal offset
+        array = np.frombuffer(buffer, dtype=dtype, count=size, offset=offset)
+        offset += array.nbytes + _padding(array.nbytes)
+        return array
+
+    result['rec_scores'] = section(np.float64, count)
+    result['rec_boxes'] = section(boxes_dtype, count * 4).reshape(-1, 4)
+    offsets = section(np.int64, count + 1)
+    result['rec_texts'] = TextColumn(memoryview(buffer)[offset:offset + int(offsets[-1])], offsets)
+    return result
@@ -0,0 +1,126 @@
+import os
+import re
+import json
+import time
+import threading
+from collections import OrderedDict
+
+from .catalog import get_catalog, evict_catalog, TEMPLATE_PATH
+
+# 多客户的订单资料：CATALOG_DIR 下每个客户一份 <客户代号>.xlsx（编译产物为同名的 .catalog/，见 catalog.compile_catalog）
+# 未配置 CATALOG_DIR，或找不到客户的订单资料时使用默认的 TEMPLATE_PATH
+CATALOG_DIR = os.environ.get('CATALOG_DIR', '')
+# 常驻内存的订单资料索引总预算（按 CatalogIndex.memory_bytes 估算），超过后淘汰最久未使用的客户
+# 预算按进程计算：批量匹配的worker（见 batch.py）只继承fork前加载的默认订单资料，
+# 各客户的订单资料在每个worker中各自加载，最坏情况下常驻内存约为 (BATCH_WORKERS + 1) * CATALOG_MEMORY_MB
+CATALOG_MEMORY_MB = int(os.environ.get('CATALOG_MEMORY_MB', 1024))
+# 可选的 CATALOG_DIR/customers.json：{单据上的客户名称: 客户代号}，用于单据上没有客户代号的格式（如“請款對象”）
+CUSTOMER_ALIASES_FILE = 'customers.json'
+
+# 客户代号只用作文件名，不允许路径分隔符
+_CUSTOMER_RE = re.compile(r'[\w\-.]+')
+# 单据上的“202088 (林小美)”取开头的代号
+_LEADING_CODE = re.compile(r'^[\w\-.]+')
+
+
+class CatalogRegistry:
+    """
+    客户 -> 订单资料索引，按需加载，常驻的索引总大小超过预算后按LRU淘汰
+    淘汰只是从进程缓存中移除，正在使用该索引的请求不受影响，下次访问时重新加载（有编译产物时为mmap加载）
+    """
+    def __init__(self, catalog_dir=CATALOG_DIR, budget_bytes=CATALOG_MEMORY_MB << 20, default_path=TEMPLATE_PATH):
+        self.catalog_dir = catalog_dir
+        self.budget_bytes = budget_bytes
+        self.default_path = default_path
+        self.aliases = self.load_aliases()
+        # (订单资料路径, split_name) -> 估算的内存占用
+        self.resident = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_seconds = 0.0
+
+    def load_aliases(self):
+        path = os.path.join(self.catalog_dir, CUSTOMER_ALIASES_FILE) if self.catalog_dir else ''
+        if not path or not os.path.exists(path):
+            return dict()
+        with open(path, 'r', encoding='utf-8') as f:
+            return {str(name).strip(): str(code) for name, code in json.load(f).items()}
+
+    def customer_path(self, customer):
+        if not self.catalog_dir or not customer or not _CUSTOMER_RE.fullmatch(customer) or customer.startswith('.'):
+            return None
+        path = os.path.join(self.catalog_dir, customer + '.xlsx')
+        return path if os.path.exists(path) else None
+
+    def resolve(self, customer):
+        """
+        客户（请求中给出的客户代号，或单据上解析出的客户名称）-> 客户代号，没有该客户的订单资料时返回None
+        依次尝试：customers.json 中的名称、原文、开头的代号
+        """
+        if not customer:
+            return None
+        customer = str(customer).strip()
+        leading = _LEADING_CODE.match(customer)
+        for candidate in (self.aliases.get(customer), customer, leading and leading.group()):
+            if self.customer_path(candidate):
+                return candidate
+        return None
+
+    def template_path(self, customer=None):
+        return self.customer_path(self.resolve(customer)) or self.default_path
+
+    def get_catalog(self, customer=None, split_name=True):
+        key = (self.template_path(customer), split_name)
+        with self.lock:
+            hit = key in self.resident
+            if hit:
+                self.hits += 1
+                self.resident.move_to_end(key)
+            else:
+                self.misses += 1
+        begin = time.perf_counter()
+        catalog = get_catalog(key[0], split_name)
+        elapsed = time.perf_counter() - begin
+        with self.lock:
+            if not hit:
+                self.load_seconds += elapsed
+            # 匹配器按需构建，每次访问时重新估算
+            self.resident[key] = catalog.memory_bytes()
+            self.resident.move_to_end(key)
+            self.evict(keep=key)
+        return catalog
+
+    def evict(self, keep=None):
+        """在锁内调用，保留 keep（刚访问的索引本身超过预算时也不淘汰）"""
+        total = sum(self.resident.values())
+        for key in list(self.resident):
+            if total <= self.budget_bytes:
+                break
+            if key == keep:
+                continue
+            total -= self.resident.pop(key)
+            evict_catalog(*key)
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return dict(customers=len({path for path, _ in self.resident}), resident=len(self.resident),
+                        resident_mb=sum(self.resident.values()) / (1 << 20), budget_mb=self.budget_bytes / (1 << 20),
+                        hits=self.hits, misses=self.misses, hit_rate=self.hits / total if total else 0.0,
+                        evictions=self.evictions, load_seconds=self.load_seconds,
+                        mean_load_seconds=self.load_seconds / self.misses if self.misses else 0.0)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_catalog_registry():
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = CatalogRegistry()
+        return _registry
@@ -0,0 +1,309 @@
+from flask import Flask, request, jsonify, Response
+import os
+import json
+import time
+import queue
+import itertools
+import threading
+from collections import OrderedDict
+from concurrent.futures import as_completed
+
+from data_preprocess import receive_upload, data_load
+from ocr import get_ocr_pool, ocr_result_path, lookup_ocr_cache, store_ocr_cache, OCR_TILING, OCR_JOB_TIMEOUT
+from run_fuzzy_match import match_with_cache, write_output
+from metrics import register_metrics, span, record_span, incr
+
+app = Flask(__name__)
+register_metrics(app, 'jobs')
+
+# 同时处理的订单数；OCR并发由 OCR_WORKERS 控制，pdf渲染并发由 PDF_RENDER_WORKERS 控制
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+# 排队上限，队列满时提交返回429，由调用方稍后重试
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', 64))
+# 已结束的任务保留最近N个，供查询状态与结果
+JOB_HISTORY_SIZE = int(os.environ.get('JOB_HISTORY_SIZE', 1024))
+JOB_RETRY_AFTER = 5
+
+# 任务阶段依次为 queued -> preprocess -> ocr -> match -> done，失败时为 error
+FINISHED_STAGES = ('done', 'error')
+
+
+class Job:
+    """
+    一个订单的处理任务，状态变化时通知等待的订阅者
+    """
+    def __init__(self, uuid, mime_type, file_path, priority=0, workdir='workdir'):
+        self.uuid = uuid
+        self.mime_type = mime_type
+        self.file_path = file_path
+        self.priority = priority
+        self.workdir = workdir
+        self.stage = 'queued'
+        self.task_type = None
+        self.pages_total = None
+        self.pages_done = 0
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.stage_times = dict(queued=self.created_at)
+        self.version = 0
+        self.condition = threading.Condition()
+
+    def update(self, **fields):
+        with self.condition:
+            if 'stage' in fields and fields['stage'] != self.stage:
+                self.stage_times[fields['stage']] = time.time()
+            for key, value in fields.items():
+                setattr(self, key, value)
+            self.updated_at = time.time()
+            self.version += 1
+            self.condition.notify_all()
+
+    def wait_update(self, version, timeout=None):
+        """等待状态版本超过 version，返回最新版本"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.version > version, timeout=timeout)
+            return self.version
+
+    @property
+    def finished(self):
+        return self.stage in FINISHED_STAGES
+
+    def snapshot(self, with_result=False):
+        with self.condition:
+            status = dict(
+                uuid=self.uuid, stage=self.stage, task_type=self.task_type, priority=self.priority,
+                pages_total=self.pages_total, pages_done=self.pages_done, error=self.error,
+                created_at=self.created_at, updated_at=self.updated_at, stage_times=dict(self.stage_times),
+                version=self.version,
+            )
+            if with_result:
+                status['result'] = self.result
+            return status
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class JobManager:
+    """
+    有界优先级队列 + 固定数量的处理线程；priority 越大越先执行，同优先级先进先出
+    """
+    def __init__(self, workers=JOB_WORKERS, queue_size=JOB_QUEUE_SIZE, history_size=JOB_HISTORY_SIZE):
+        self.queue = queue.PriorityQueue(maxsize=queue_size)
+        self.history_size = history_size
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.sequence = itertools.count()
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def full(self):
+        return self.queue.full()
+
+    def get(self, uuid):
+        with self.lock:
+            return self.jobs.get(uuid)
+
+    def submit(self, job):
+        """队列已满时抛出 JobQueueFull，同一uuid的任务未结束时抛出 ValueError"""
+        with self.lock:
+            existing = self.jobs.get(job.uuid)
+            if existing is not None and not existing.finished:
+                raise ValueError(f"任务 {job.uuid} 正在处理")
+            try:
+                self.queue.put_nowait((-job.priority, next(self.sequence), job))
+            except queue.Full:
+                raise JobQueueFull()
+            self.jobs[job.uuid] = job
+            self.jobs.move_to_end(job.uuid)
+            self._evict()
+        return job
+
+    def _evict(self):
+        finished = [uuid for uuid, job in self.jobs.items() if job.finished]
+        for uuid in finished[:max(0, len(self.jobs) - self.history_size)]:
+            del self.jobs[uuid]
+
+    def _work(self):
+        while True:
+            _, _, job = self.queue.get()
+            record_span('queued', time.time() - job.created_at, job.uuid, priority=job.priority)
+            try:
+                with span('job', job.uuid):
+                    run_job(job)
+            except Exception as e:
+                job.update(stage='error', error=repr(e))
+            incr('jobs_total', stage=job.stage)
+
+
+def run_job(job):
+    """
+    预处理 -> OCR -> 匹配
+    pdf每渲染完一页就提交OCR，渲染与OCR重叠进行；文本层页面不需要OCR
+    """
+    job.update(stage='preprocess')
+    pool = get_ocr_pool()
+    futures = dict()
+    cached = dict()
+
+    def submit(page_index, src):
+        ocr_path = lookup_ocr_cache(src, ocr_result_path(src))
+        if ocr_path is not None:
+            cached[page_index] = ocr_path
+        else:
+            futures[pool.submit([(src, ocr_result_path(src))], OCR_TILING)] = page_index
+
+    def on_page(page_index, src, ocr_path):
+        if ocr_path is None:
+            submit(page_index, src)
+
+    config = data_load(job.uuid, job.mime_type, job.file_path, job.workdir, on_page=on_page)
+    if not config:
+        raise ValueError("Unsupported file format")
+    src_list = config['src_list']
+    ocr_list = config.get('ocr_list') or [None] * len(src_list)
+    submitted = set(futures.values()) | set(cached)
+    for page_index, src in enumerate(src_list):
+        if ocr_list[page_index] is None and page_index not in submitted:
+            submit(page_index, src)
+    for page_index, ocr_path in cached.items():
+        ocr_list[page_index] = ocr_path
+
+    job.update(stage='ocr', task_type=config['task_type'], pages_total=len(src_list),
+               pages_done=len(src_list) - len(futures))
+    # 预处理期间已经提交的页面在这里只计等待剩余OCR的时间
+    with span('ocr_wait', pages=len(futures)):
+        # 超时从 as_completed 抛出，任务以异常结束；未完成的页面从OCR队列中撤回，不再占用worker
+        try:
+            for future in as_completed(futures, timeout=OCR_JOB_TIMEOUT * max(len(futures), 1)):
+                page_index = futures[future]
+                ocr_list[page_index] = future.result()[0]
+                store_ocr_cache(src_list[page_index], ocr_list[page_index])
+                job.update(pages_done=job.pages_done + 1)
+        finally:
+            for future in futures:
+                if not future.done():
+                    pool.cancel(future)
+
+    job.update(stage='match')
+    output, _ = match_with_cache(config['task_type'], ocr_list if config['task_type'] == 'print' else ocr_list[:1],
+                                 job.uuid)
+    write_output(ocr_list[0], output)
+    job.update(stage='done', result=dict(src_list=src_list, ocr_list=ocr_list, output=output))
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_job_manager():
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = JobManager()
+        return _manager
+
+
+def _too_busy():
+    response = jsonify(dict(error="job queue is full"))
+    response.headers['Retry-After'] = str(JOB_RETRY_AFTER)
+    return response, 429
+
+
+def _discard_upload(file_path):
+    """删除没有入队的上传文件，workdir/<uuid>/src 与 workdir/<uuid> 为空时一并删除"""
+    os.remove(file_path)
+    src_dir = os.path.dirname(file_path)
+    for path in (src_dir, os.path.dirname(src_dir)):
+        try:
+            os.rmdir(path)
+        except OSError:
+            break
+
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """
+    上传方式与 /data_preprocess 相同，立即返回202与任务uuid
+    优先级取 X-Priority 请求头或 ?priority=（整数，越大越先执行，默认0）
+    """
+    manager = get_job_manager()
+    # 排队已满时不再接收文件
+    if manager.full():
+        return _too_busy()
+    # 请求头给出uuid时提前检查，避免覆盖正在处理的文件
+    existing = manager.get(request.headers.get('X-UUID'))
+    if existing is not None and not existing.finished:
+        return f"任务 {existing.uuid} 正在处理", 409
+    try:
+        priority = int(request.headers.get('X-Priority', request.args.get('priority', 0)))
+        uuid, mime_type, file_path = receive_upload()
+        job = manager.submit(Job(uuid, mime_type, file_path, priority))
+    except JobQueueFull:
+        # 检查之后队列被其他请求占满：文件已经写入，删除后再返回
+        _discard_upload(file_path)
+        return _too_busy()
+    except ValueError as e:
+        return str(e), 400
+    response = jsonify(job.snapshot())
+    response.headers['X-UUID'] = uuid
+    response.headers['Location'] = f'/jobs/{uuid}'
+    return response, 202
+
+
+def _get_job_or_404(uuid):
+    job = get_job_manager().get(uuid)
+    if job is None:
+        return None, ("Unknown uuid", 404)
+    return job, None
+
+
+@app.route('/jobs/<uuid>', methods=['GET'])
+def job_status(uuid):
+    """任务状态，结束后包含结果；?wait=秒数 时阻塞到状态变化或超时（长轮询）"""
+    job, error = _get_job_or_404(uuid)
+    if error:
+        return error
+    wait = float(request.args.get('wait', 0))
+    if wait > 0 and not job.finished:
+        job.wait_update(int(request.args.get('version', job.version)), timeout=wait)
+    return jsonify(job.snapshot(with_result=job.finished)), 200
+
+
+@app.route('/jobs/<uuid>/events', methods=['GET'])
+def job_events(uuid):
+    """Server-Sent Events：每次阶段/进度变化推送一次状态，任务结束后关闭"""
+    job, error = _get_job_or_404(uuid)
+    if error:
+        return error
+
+    def stream():
+        version = -1
+        while True:
+            if job.version != version:
+                version = job.version
+                status = job.snapshot(with_result=job.finished)
+                yield f"event: {status['stage']}\ndata: {json.dumps(status, ensure_ascii=False)}\n\n"
+                if job.finished:
+                    return
+            if job.wait_update(version, timeout=15) == version:
+                # 保持连接
+                yield ": keep-alive\n\n"
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    manager = get_job_manager()
+    with manager.lock:
+        jobs = list(manager.jobs.values())
+    return jsonify(dict(queued=manager.queue.qsize(), jobs=[job.snapshot() for job in jobs])), 200
+
+
+if __name__ == '__main__':
+    get_ocr_pool()
+    app.run(host='0.0.0.0', port=5004, threaded=True)
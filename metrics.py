@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# 各服务的阶段耗时与计数，GET /metrics 以Prometheus文本格式输出（只在进程内统计，重启后清零）
+# 带uuid的阶段同时追加到 workdir/<uuid>/trace.jsonl，一行一个阶段，多个服务写同一个文件
+METRICS_TRACE = os.environ.get('METRICS_TRACE', '1') == '1'
+METRICS_PREFIX = 'invoice_agent_'
+# 阶段耗时直方图的桶（秒）
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_lock = threading.Lock()
+_counters = dict()
+_gauges = dict()
+# (阶段, 服务) -> [各桶计数, 总耗时, 次数]
+_durations = dict()
+_collectors = list()
+_local = threading.local()
+
+service = os.environ.get('METRICS_SERVICE', 'agent')
+workdir = 'workdir'
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def incr(name, value=1, **labels):
+    """计数器加 value"""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_max(name, value, **labels):
+    """只保留最大值的gauge，如显存峰值"""
+    key = _key(name, labels)
+    with _lock:
+        if value > _gauges.get(key, float('-inf')):
+            _gauges[key] = value
+
+
+def register_collector(collect):
+    """collect() 返回 [(名称, labels dict, 值)]，输出 /metrics 时调用，用于查询缓存命中率等已有的统计"""
+    with _lock:
+        _collectors.append(collect)
+
+
+def current_uuid():
+    stack = getattr(_local, 'stack', None)
+    return stack[-1][1] if stack else None
+
+
+def record_span(name, seconds, uuid=None, start=None, **attrs):
+    """
+    记录一个已经结束的阶段（例如在子进程中执行、只拿到耗时的阶段）
+    uuid 缺省时取当前线程所在的外层阶段，阶段名前加上外层阶段名
+    """
+    stack = getattr(_local, 'stack', None) or []
+    parent = stack[-1][0] if stack else None
+    if uuid is None and stack:
+        uuid = stack[-1][1]
+    with _lock:
+        histogram = _durations.setdefault((name, service), [[0] * len(DURATION_BUCKETS), 0.0, 0])
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if seconds <= bound:
+                histogram[0][i] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+    if uuid and METRICS_TRACE:
+        _write_trace(uuid, dict(service=service, span=name, parent=parent, pid=os.getpid(),
+                                start=start if start is not None else time.time() - seconds,
+                                seconds=round(seconds, 6), **attrs))
+
+
+@contextmanager
+def span(name, uuid=None, **attrs):
+    """
+    阶段计时：with span('preprocess', uuid): ...
+    嵌套的阶段继承外层的uuid；yield 的dict可以补充写入trace的属性（页数、行数等）
+    """
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = list()
+    if uuid is None and stack:
+        uuid = stack[-1][1]
+    extra = dict(attrs)
+    start = time.time()
+    begin = time.perf_counter()
+    stack.append((name, uuid))
+    error = None
+    try:
+        yield extra
+    except Exception as e:
+        error = repr(e)
+        raise
+    finally:
+        stack.pop()
+        if error is not None:
+            extra['error'] = error
+            incr('stage_errors_total', stage=name, service=service)
+        record_span(name, time.perf_counter() - begin, uuid, start, **extra)
+
+
+def workdir_uuid(path):
+    """
+    workdir/<uuid>/<src|ocr|output>/<文件> 中的uuid
+    路径不在 workdir 下时返回None，不为任意的上级目录名创建 workdir/<目录名>/trace.jsonl
+    """
+    parts = os.path.relpath(os.path.abspath(path), os.path.abspath(workdir)).split(os.sep)
+    if len(parts) != 3 or parts[0] in (os.curdir, os.pardir):
+        return None
+    return parts[0]
+
+
+def _write_trace(uuid, record):
+    path = os.path.join(workdir, uuid, 'trace.jsonl')
+    try:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        # O_APPEND 单次写入一行，多个服务进程同时追加不会交错
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+    except OSError as e:
+        print(f"trace写入失败 {path}：{e!r}")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{str(v)}"' for k, v in labels) + '}'
+
+
+def render_metrics():
+    """Prometheus 文本格式"""
+    lines = list()
+    with _lock:
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items())
+        durations = sorted((key, [list(value[0]), value[1], value[2]]) for key, value in _durations.items())
+        collectors = list(_collectors)
+    for (name, labels), value in counters:
+        lines.append(f'{METRICS_PREFIX}{name}{_format_labels(labels)} {value}')
+    for (name, labels), value in gauges:
+        lines.append(f'{METRICS_PREFIX}{name}{_format_labels(labels)} {value}')
+    for collect in collectors:
+        for name, labels, value in collect():
+            lines.append(f'{METRICS_PREFIX}{name}{_format_labels(sorted(labels.items()))} {value}')
+    if durations:
+        name = f'{METRICS_PREFIX}stage_duration_seconds'
+        lines.append(f'# TYPE {name} histogram')
+    for (stage, stage_service), (buckets, total, count) in durations:
+        labels = (('service', stage_service), ('stage', stage))
+        for bound, bucket_count in zip(DURATION_BUCKETS, buckets):
+            lines.append(f'{name}_bucket{_format_labels(labels + (("le", bound),))} {bucket_count}')
+        lines.append(f'{name}_bucket{_format_labels(labels + (("le", "+Inf"),))} {count}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+        lines.append(f'{name}_count{_format_labels(labels)} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+def register_metrics(app, name):
+    """给Flask服务加上 GET /metrics，name 为写入trace与标签的服务名"""
+    global service
+    from flask import Response
+    service = name
+
+    def metrics():
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+    app.add_url_rule('/metrics', 'metrics', metrics, methods=['GET'])
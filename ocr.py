@@ -1,12 +1,42 @@
 from flask import Flask, request, jsonify
-from paddleocr import PaddleOCR
 import os
+import atexit
+import time
+import resource
+import itertools
+import threading
+from collections import deque
+import multiprocessing as mp
+from multiprocessing.connection import wait
+from concurrent.futures import Future
+
+from ocr_tiling import (predict_tiled, save_ocr_json, annotate_dpi,
+                        OCR_TILE_WIDTH, OCR_TILE_HEIGHT, OCR_TILE_OVERLAP)
+from result_cache import get_result_cache, file_key, restore_ocr_json
+from metrics import register_metrics, span, record_span, incr, set_max, workdir_uuid
 
 app = Flask(__name__)
+register_metrics(app, 'ocr')
+
+# OCR worker 配置，CPU 模式用于没有显卡的测试环境
+OCR_DEVICE = os.environ.get('OCR_DEVICE', 'gpu')
+OCR_WORKERS = int(os.environ.get('OCR_WORKERS', 1))
+# worker 处理完N个任务，或显存/内存超过水位线后退出并重新拉起，释放累积的显存
+OCR_MAX_JOBS_PER_WORKER = int(os.environ.get('OCR_MAX_JOBS_PER_WORKER', 100))
+OCR_MEMORY_WATERMARK_MB = int(os.environ.get('OCR_MEMORY_WATERMARK_MB', 10240))
+# 切块模式：大图切成重叠的块在显存预算内分批推理，多页可以合并为一个任务，见 ocr_tiling.py
+OCR_TILING = os.environ.get('OCR_TILING', '0') == '1'
+OCR_PAGES_PER_JOB = int(os.environ.get('OCR_PAGES_PER_JOB', 4))
+# worker 加载模型失败（paddleocr缺失、CUDA初始化失败等）后间隔 OCR_RESTART_BACKOFF * 2^(n-1) 秒重试，
+# 连续失败 OCR_STARTUP_RETRIES 次后不再拉起，排队中的任务以异常结束
+OCR_STARTUP_RETRIES = int(os.environ.get('OCR_STARTUP_RETRIES', 3))
+OCR_RESTART_BACKOFF = float(os.environ.get('OCR_RESTART_BACKOFF', 1))
+# 等待单个OCR任务的超时（秒），超时后请求/任务以异常结束，不再无限等待
+OCR_JOB_TIMEOUT = float(os.environ.get('OCR_JOB_TIMEOUT', 600))
+
 
 # PP-OCRv5_server 模型
-ocr_model = PaddleOCR(
-    device="gpu",
+OCR_MODEL_CONFIG = dict(
     det_db_unclip_ratio=2.0,
     text_detection_model_name="PP-OCRv5_server_det",
     text_recognition_model_name="PP-OCRv5_server_rec",
@@ -15,33 +45,358 @@ ocr_model = PaddleOCR(
     use_textline_orientation=False,
 )
 
-from multiprocessing import Process, Queue
 
-def _predict(queue, src):
-    result = ocr_model.predict(src)
-    queue.put(result)
+def build_ocr_model(device):
+    from paddleocr import PaddleOCR
+    return PaddleOCR(device=device, **OCR_MODEL_CONFIG)
+
+
+def ocr_config():
+    """影响OCR结果的配置，作为OCR缓存key的一部分；GPU编号不影响结果"""
+    config = dict(OCR_MODEL_CONFIG, device=OCR_DEVICE.split(':')[0], tiling=OCR_TILING)
+    if OCR_TILING:
+        config.update(tile_width=OCR_TILE_WIDTH, tile_height=OCR_TILE_HEIGHT, tile_overlap=OCR_TILE_OVERLAP)
+    return config
+
+
+def lookup_ocr_cache(src, dst):
+    """按页面图像内容查找OCR结果，命中时写到 dst 并返回 dst，否则返回None"""
+    cache = get_result_cache()
+    if cache is None:
+        return None
+    entry = cache.get('ocr', file_key(src, ocr_config()))
+    if entry is None:
+        return None
+    return restore_ocr_json(os.path.join(entry, 'ocr.json'), dst, src)
+
+
+def store_ocr_cache(src, dst):
+    cache = get_result_cache()
+    if cache is not None:
+        cache.put('ocr', file_key(src, ocr_config()), files={'ocr.json': dst})
+
+
+def memory_usage_mb(device):
+    """
+    GPU 取 paddle 当前占用的显存，CPU 取进程内存峰值
+    """
+    if device.startswith('gpu'):
+        import paddle
+        return paddle.device.cuda.memory_reserved() / (1 << 20)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _worker_main(device, conn, max_jobs, watermark_mb):
+    """
+    常驻的OCR进程：模型只加载一次，循环处理进程池通过 conn 分发的任务并回报状态
+    加载成功、以及每处理完一个任务后仍继续运行时回报 'ready'，进程池只向回报过 'ready' 的worker分发任务
+    """
+    try:
+        ocr_model = build_ocr_model(device)
+    except Exception as e:
+        conn.send(('failed', None, repr(e)))
+        conn.close()
+        return
+    conn.send(('ready', None, None))
+    jobs_done = 0
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        job_id, pages, tiling = job
+        begin = time.perf_counter()
+        try:
+            if tiling:
+                results = predict_tiled(ocr_model, [src for src, _ in pages])
+                for result, (_, dst) in zip(results, pages):
+                    save_ocr_json(result, dst)
+            else:
+                for src, dst in pages:
+                    result = ocr_model.predict(src)
+                    result[0].save_to_json(dst)
+                    annotate_dpi(dst, src)
+            memory_mb = memory_usage_mb(device)
+            conn.send(('stats', job_id, dict(seconds=time.perf_counter() - begin, memory_mb=memory_mb,
+                                             pages=[dst for _, dst in pages])))
+            conn.send(('done', job_id, [dst for _, dst in pages]))
+        except Exception as e:
+            conn.send(('error', job_id, repr(e)))
+            memory_mb = memory_usage_mb(device)
+        jobs_done += 1
+        if jobs_done >= max_jobs or memory_mb >= watermark_mb:
+            break
+        conn.send(('ready', None, None))
+    conn.close()
+
+
+class OcrWorkerPool:
+    """
+    常驻的OCR进程池，任务在主进程排队，逐个分发给空闲的worker，submit 返回 Future
+    worker 主动退出（任务数/水位线）或异常退出后自动重新拉起，异常退出时正在处理的任务以异常结束
+    worker 连续 startup_retries 次没能加载模型时不再拉起，排队中与之后提交的任务都以异常结束
+    """
+    def __init__(self, size=OCR_WORKERS, device=OCR_DEVICE,
+                 max_jobs=OCR_MAX_JOBS_PER_WORKER, watermark_mb=OCR_MEMORY_WATERMARK_MB,
+                 startup_retries=OCR_STARTUP_RETRIES, restart_backoff=OCR_RESTART_BACKOFF):
+        # CUDA 不能在 fork 出的子进程中初始化
+        self.context = mp.get_context('spawn')
+        self.device = device
+        self.max_jobs = max_jobs
+        self.watermark_mb = watermark_mb
+        self.startup_retries = startup_retries
+        self.restart_backoff = restart_backoff
+        self.job_ids = itertools.count()
+        self.futures = dict()
+        # 排队中的任务 (job_id, pages, tiling)
+        self.pending = deque()
+        # worker_id -> [进程, 管道, 正在处理的job_id, 是否空闲, 是否加载过模型, 模型加载失败的原因]
+        self.workers = dict()
+        # worker_id -> 重新拉起的时间（time.monotonic）
+        self.restarts = dict()
+        self.startup_failures = 0
+        self.failure = None
+        self.lock = threading.Lock()
+        self.closed = False
+        for worker_id in range(size):
+            self._spawn(worker_id)
+        self.collector = threading.Thread(target=self._collect, daemon=True)
+        self.collector.start()
+
+    def _spawn(self, worker_id):
+        conn, child_conn = self.context.Pipe()
+        process = self.context.Process(
+            target=_worker_main,
+            args=(self.device, child_conn, self.max_jobs, self.watermark_mb),
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        with self.lock:
+            self.workers[worker_id] = [process, conn, None, False, False, None]
+
+    def submit(self, pages, tiling=False):
+        """
+        pages: [(图像路径, OCR结果json路径)]，一个任务内的页面由同一个worker处理
+        Future 的结果为json路径列表
+        """
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("OCR worker pool is closed")
+            if self.failure is not None:
+                raise RuntimeError(self.failure)
+            job_id = next(self.job_ids)
+            self.futures[job_id] = future
+            self.pending.append((job_id, pages, tiling))
+            self._dispatch()
+        return future
+
+    def cancel(self, future):
+        """
+        排队中的任务从队列中移除；已经交给worker的任务无法中断，完成后结果丢弃
+        返回任务是否还在线程池中（未完成）
+        """
+        with self.lock:
+            job_id = next((job_id for job_id, f in self.futures.items() if f is future), None)
+            if job_id is None:
+                return False
+            del self.futures[job_id]
+            self.pending = deque(job for job in self.pending if job[0] != job_id)
+        future.cancel()
+        return True
+
+    def _dispatch(self):
+        """在锁内调用：排队的任务交给空闲的worker，发送前记录该worker正在处理的任务"""
+        for worker in list(self.workers.values()):
+            if not self.pending:
+                break
+            if not worker[3] or self.closed:
+                continue
+            job = self.pending.popleft()
+            worker[2], worker[3] = job[0], False
+            try:
+                worker[1].send(job)
+            except OSError:
+                # worker已退出，_collect 按正在处理的任务结束
+                pass
+
+    def _finish(self, job_id, result=None, error=None):
+        with self.lock:
+            future = self.futures.pop(job_id, None)
+        if future is None:
+            return
+        if error is not None:
+            future.set_exception(RuntimeError(error))
+        else:
+            future.set_result(result)
+
+    def _receive(self, worker):
+        """读取worker已发出的全部状态消息"""
+        conn = worker[1]
+        try:
+            while conn.poll():
+                kind, job_id, payload = conn.recv()
+                if kind == 'ready':
+                    with self.lock:
+                        worker[3] = worker[4] = True
+                        self.startup_failures = 0
+                        self._dispatch()
+                elif kind == 'failed':
+                    worker[5] = payload
+                elif kind == 'stats':
+                    self._record(payload)
+                elif kind == 'done':
+                    worker[2] = None
+                    self._finish(job_id, result=payload)
+                elif kind == 'error':
+                    worker[2] = None
+                    self._finish(job_id, error=payload)
+        except (EOFError, OSError):
+            pass
+
+    def _record(self, stats):
+        """worker回报的推理耗时（不含排队）与显存/内存占用"""
+        pages = stats['pages']
+        record_span('ocr_job', stats['seconds'], path_uuid(pages[0]), pages=len(pages))
+        incr('pages_total', stage='ocr', source='model', value=len(pages))
+        set_max('ocr_memory_peak_mb', stats['memory_mb'], device=self.device)
+
+    def _collect(self):
+        while self.workers or self.restarts:
+            waitables = dict()
+            for worker_id, (process, conn, _, _, _, _) in self.workers.items():
+                waitables[conn] = worker_id
+                waitables[process.sentinel] = worker_id
+            ready_workers = set(waitables[ready] for ready in wait(list(waitables), timeout=1)) if waitables else ()
+            if not waitables:
+                time.sleep(min(1, max(0, min(self.restarts.values()) - time.monotonic())))
+            for worker_id in ready_workers:
+                worker = self.workers[worker_id]
+                self._receive(worker)
+                process, conn, _, _, loaded, failure = worker
+                if process.is_alive():
+                    continue
+                # 进程已退出：消息读完后仍在处理中的任务随进程一起丢失
+                process.join()
+                with self.lock:
+                    del self.workers[worker_id]
+                    job_id = worker[2]
+                conn.close()
+                if job_id is not None:
+                    self._finish(job_id, error=f"OCR worker exited with code {process.exitcode}")
+                if self.closed or self.failure is not None:
+                    continue
+                if loaded:
+                    self._spawn(worker_id)
+                    continue
+                self._startup_failed(worker_id, failure or f"OCR worker exited with code {process.exitcode}")
+            now = time.monotonic()
+            for worker_id, restart_at in list(self.restarts.items()):
+                if restart_at <= now:
+                    del self.restarts[worker_id]
+                    if not self.closed and self.failure is None:
+                        self._spawn(worker_id)
+
+    def _startup_failed(self, worker_id, error):
+        """
+        worker没能加载模型：退避后重新拉起
+        连续失败过多且没有正常运行的worker时放弃，结束全部排队的任务
+        """
+        self.startup_failures += 1
+        incr('ocr_startup_failures_total', device=self.device)
+        print(f"OCR worker {worker_id} 启动失败（第{self.startup_failures}次）：{error}")
+        with self.lock:
+            healthy = any(worker[4] for worker in self.workers.values())
+        if self.startup_failures < self.startup_retries or healthy:
+            delay = self.restart_backoff * 2 ** min(self.startup_failures - 1, 6)
+            self.restarts[worker_id] = time.monotonic() + delay
+            return
+        with self.lock:
+            self.failure = f"OCR worker failed to start: {error}"
+            pending = list(self.pending)
+            self.pending.clear()
+        self.restarts.clear()
+        for job_id, _, _ in pending:
+            self._finish(job_id, error=self.failure)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            pending = list(self.pending)
+            self.pending.clear()
+            for process, conn, _, _, _, _ in self.workers.values():
+                try:
+                    conn.send(None)
+                except OSError:
+                    pass
+        for job_id, _, _ in pending:
+            self._finish(job_id, error="OCR worker pool is closed")
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_ocr_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = OcrWorkerPool()
+            atexit.register(_pool.close)
+        return _pool
+
+
+def path_uuid(path):
+    """workdir/<uuid>/<src|ocr>/<页面> 中的uuid，不在 workdir 下时为None（不写trace）"""
+    return workdir_uuid(path)
+
+
+def ocr_result_path(src):
+    """workdir/<uuid>/src/<页面>.png 的OCR结果路径 workdir/<uuid>/ocr/<页面>.json"""
+    output_dir = os.path.dirname(src).replace('src', 'ocr')
+    basename = os.path.splitext(os.path.basename(src))[0]
+    return os.path.join(output_dir, basename + '.json')
+
 
 @app.route('/ocr', methods=['POST'])
 def ocr():
     json_data = request.get_json()
     src_list = json_data['src_list']
     output_dir = os.path.dirname(src_list[0]).replace('src', 'ocr')
-    ocr_list = []
-    # 大图如pdf推理太占显存，目前机器12GB显存只能推一张。实际能输入图像list
-    for src in src_list:
-        q = Queue()
-        p = Process(target=_predict, args=(q, src))
-        p.start()
-        result = q.get()
-        p.join()  # 进程结束自动释放显存
-        
-        basename = os.path.splitext(os.path.basename(src))[0]
-        # png结果用于调试，对结果无影响
-        # result[0].save_to_img(os.path.join(output_dir, basename + '.png'))
-        result[0].save_to_json(os.path.join(output_dir, basename + '.json'))
-        ocr_list.append(os.path.join(output_dir, basename + '.json'))
+    # 大图如pdf推理太占显存，目前机器12GB显存只能推一张，由 OCR_WORKERS 控制并发的页数
+    pool = get_ocr_pool()
+    with span('ocr', json_data.get('uuid') or path_uuid(src_list[0])) as trace:
+        # 预处理阶段已经从pdf文本层得到结果的页面不再OCR
+        ocr_list = json_data.get('ocr_list') or [None] * len(src_list)
+        pending = list()
+        pages = list()
+        for i, src in enumerate(src_list):
+            if ocr_list[i] is not None:
+                continue
+            basename = os.path.splitext(os.path.basename(src))[0]
+            # png结果用于调试，对结果无影响
+            # result[0].save_to_img(os.path.join(output_dir, basename + '.png'))
+            dst = os.path.join(output_dir, basename + '.json')
+            # 相同的页面图像已经识别过
+            ocr_list[i] = lookup_ocr_cache(src, dst)
+            if ocr_list[i] is None:
+                pending.append(i)
+                pages.append((src, dst))
+        # 切块模式下单页显存有上限，多页合并为一个任务分批推理
+        pages_per_job = OCR_PAGES_PER_JOB if OCR_TILING else 1
+        futures = [pool.submit(pages[i:i + pages_per_job], OCR_TILING) for i in range(0, len(pages), pages_per_job)]
+        results = [path for future in futures for path in future.result(timeout=OCR_JOB_TIMEOUT)]
+        for i, path in zip(pending, results):
+            ocr_list[i] = path
+            store_ocr_cache(src_list[i], path)
+        trace.update(pages=len(src_list), ocr_pages=len(pages))
     json_data['ocr_list'] = ocr_list
     return jsonify(json_data), 200
-        
+
+
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=5001)
\ No newline at end of file
+    get_ocr_pool()
+    app.run(host='0.0.0.0', port=5001)
@@ -0,0 +1,211 @@
+import os
+import json
+import zlib
+import struct
+
+import numpy as np
+from PIL import Image
+
+from fuzzy_match.ocr_page import save_ocr_binary, binary_result_path
+
+# 切块配置：默认按整页宽度切成水平条带，避免横向切断整行文字
+# 重叠区域需要大于单行文字的高度，被切断的文字在相邻块中是完整的
+OCR_TILE_WIDTH = int(os.environ.get('OCR_TILE_WIDTH', 4096))
+OCR_TILE_HEIGHT = int(os.environ.get('OCR_TILE_HEIGHT', 1024))
+OCR_TILE_OVERLAP = int(os.environ.get('OCR_TILE_OVERLAP', 160))
+# 一批送入模型的图像总显存预算，按像素数估算
+OCR_MEMORY_BUDGET_MB = int(os.environ.get('OCR_MEMORY_BUDGET_MB', 6000))
+OCR_MB_PER_MEGAPIXEL = int(os.environ.get('OCR_MB_PER_MEGAPIXEL', 1200))
+# box 距离块内侧边缘小于该值视为被切断
+EDGE_MARGIN = 2
+# 写json的同时写一份同名的二进制结果 .ocrp，匹配服务优先mmap读取；json照常写出，供n8n等其他流程使用
+OCR_BINARY = os.environ.get('OCR_BINARY', '1') == '1'
+# pdf渲染出的png追加的 tEXt 块的关键字，内容为渲染DPI，见 mark_rendered_png
+RENDER_DPI_KEY = 'invoice_agent_render_dpi'
+_PNG_IEND = b'\x00\x00\x00\x00IEND\xaeB`\x82'
+
+
+def _spans(length, tile, overlap):
+    if length <= tile:
+        return [(0, length)]
+    step = tile - overlap
+    starts = list(range(0, length - tile, step)) + [length - tile]
+    return [(start, start + tile) for start in starts]
+
+
+def plan_tiles(width, height, tile_width=OCR_TILE_WIDTH, tile_height=OCR_TILE_HEIGHT, overlap=OCR_TILE_OVERLAP):
+    """
+    返回覆盖整页、相互重叠的切块 [(x1, y1, x2, y2)]，页面不超过切块大小时只有一块
+    """
+    return [(x1, y1, x2, y2)
+            for y1, y2 in _spans(height, tile_height, overlap)
+            for x1, x2 in _spans(width, tile_width, overlap)]
+
+
+def sort_boxes(texts, scores, boxes):
+    """
+    与PaddleOCR相同的阅读顺序：先按top再按left排序，top相差10以内的视为同一行按left排序
+    """
+    order = sorted(range(len(boxes)), key=lambda i: (boxes[i][1], boxes[i][0]))
+    for i in range(len(order) - 1):
+        for j in range(i, -1, -1):
+            a, b = boxes[order[j]], boxes[order[j + 1]]
+            if abs(b[1] - a[1]) < 10 and b[0] < a[0]:
+                order[j], order[j + 1] = order[j + 1], order[j]
+            else:
+                break
+    return [texts[i] for i in order], [scores[i] for i in order], [boxes[i] for i in order]
+
+
+def merge_tiles(tiles, tile_results, width, height):
+    """
+    将各块的识别结果合并回整页坐标
+    1. 丢弃贴着块内侧边缘（被切断）的box，重叠区域保证其在相邻块中完整出现
+    2. 重叠区域中重复识别的box，交叠面积超过较小box一半时只保留分数高的
+    """
+    candidates = list()
+    for (x1, y1, x2, y2), (texts, scores, boxes) in zip(tiles, tile_results):
+        for text, score, box in zip(texts, scores, boxes):
+            left, top, right, bottom = box[0] + x1, box[1] + y1, box[2] + x1, box[3] + y1
+            clipped = ((x1 > 0 and left - x1 < EDGE_MARGIN) or (x2 < width and x2 - right < EDGE_MARGIN) or
+                       (y1 > 0 and top - y1 < EDGE_MARGIN) or (y2 < height and y2 - bottom < EDGE_MARGIN))
+            if clipped:
+                continue
+            candidates.append((float(score), text, [int(left), int(top), int(right), int(bottom)]))
+
+    candidates.sort(key=lambda x: -x[0])
+    kept = list()
+    for score, text, box in candidates:
+        area = (box[2] - box[0]) * (box[3] - box[1])
+        duplicated = False
+        for _, _, other in kept:
+            iw = min(box[2], other[2]) - max(box[0], other[0])
+            ih = min(box[3], other[3]) - max(box[1], other[1])
+            if iw <= 0 or ih <= 0:
+                continue
+            other_area = (other[2] - other[0]) * (other[3] - other[1])
+            if iw * ih > 0.5 * max(min(area, other_area), 1):
+                duplicated = True
+                break
+        if not duplicated:
+            kept.append((score, text, box))
+    scores, texts, boxes = zip(*kept) if kept else ((), (), ())
+    return sort_boxes(list(texts), list(scores), list(boxes))
+
+
+def _batches(crops, budget_mb=OCR_MEMORY_BUDGET_MB, mb_per_megapixel=OCR_MB_PER_MEGAPIXEL):
+    """按估算显存把切块分批，每批至少一块"""
+    batch, batch_mb = list(), 0
+    for crop in crops:
+        crop_mb = crop[2].shape[0] * crop[2].shape[1] / 1e6 * mb_per_megapixel
+        if batch and batch_mb + crop_mb > budget_mb:
+            yield batch
+            batch, batch_mb = list(), 0
+        batch.append(crop)
+        batch_mb += crop_mb
+    if batch:
+        yield batch
+
+
+def predict_tiled(ocr_model, src_list):
+    """
+    多页图像切块后在显存预算内分批推理（不同页的块可以在同一批），再按页合并
+    src_list 中可以是图像路径或BGR数组，返回每页的 dict(rec_texts, rec_scores, rec_boxes)
+    """
+    crops = list()
+    pages = list()
+    for page_index, src in enumerate(src_list):
+        if isinstance(src, np.ndarray):
+            image = src
+        else:
+            # PaddleOCR 的数组输入为BGR
+            image = np.asarray(Image.open(src).convert('RGB'))[:, :, ::-1]
+        height, width = image.shape[:2]
+        tiles = plan_tiles(width, height)
+        pages.append((width, height, tiles, [None] * len(tiles)))
+        for tile_index, (x1, y1, x2, y2) in enumerate(tiles):
+            crops.append((page_index, tile_index, np.ascontiguousarray(image[y1:y2, x1:x2])))
+
+    for batch in _batches(crops):
+        results = ocr_model.predict([crop for _, _, crop in batch])
+        for (page_index, tile_index, _), result in zip(batch, results):
+            pages[page_index][3][tile_index] = (list(result['rec_texts']),
+                                                [float(score) for score in result['rec_scores']],
+                                                np.asarray(result['rec_boxes']).reshape(-1, 4).tolist())
+
+    outputs = list()
+    for src, (width, height, tiles, tile_results) in zip(src_list, pages):
+        texts, scores, boxes = merge_tiles(tiles, tile_results, width, height)
+        if isinstance(src, np.ndarray):
+            outputs.append(dict(input_path=None, rec_texts=texts, rec_scores=scores, rec_boxes=boxes))
+            continue
+        output = dict(input_path=src, rec_texts=texts, rec_scores=scores, rec_boxes=boxes)
+        dpi = image_dpi(src)
+        if dpi is not None:
+            output['dpi'] = dpi
+        outputs.append(output)
+    return outputs
+
+
+def result_to_dict(result, input_path=None):
+    """PaddleOCR 的单页结果转为与 save_to_json 相同字段的dict"""
+    return dict(input_path=input_path,
+                rec_texts=list(result['rec_texts']),
+                rec_scores=[float(score) for score in result['rec_scores']],
+                rec_boxes=np.asarray(result['rec_boxes']).reshape(-1, 4).tolist())
+
+
+def mark_rendered_png(path, dpi):
+    """
+    在png的IEND之前插入 tEXt 块 RENDER_DPI_KEY=dpi，不重新编码图像
+    用户上传的png也可能带pHYs（如截图、手机图片的72dpi），只有带该标记的才是渲染出的页面
+    """
+    data = f'{RENDER_DPI_KEY}\0{dpi}'.encode('latin-1')
+    chunk = struct.pack('>I', len(data)) + b'tEXt' + data + struct.pack('>I', zlib.crc32(b'tEXt' + data))
+    with open(path, 'r+b') as f:
+        f.seek(-len(_PNG_IEND), os.SEEK_END)
+        if f.read() != _PNG_IEND:
+            raise ValueError(f"{path} 不是完整的png")
+        f.seek(-len(_PNG_IEND), os.SEEK_END)
+        f.write(chunk + _PNG_IEND)
+
+
+def image_dpi(src):
+    """
+    pdf渲染出的png中由 mark_rendered_png 记录了渲染DPI，其他图像（包括带pHYs的上传图片）返回None（不做坐标换算）
+    标记在文件末尾（IEND之前），只读文件尾，不解码图像
+    """
+    if not src.lower().endswith('.png'):
+        return None
+    marker = b'tEXt' + RENDER_DPI_KEY.encode('latin-1') + b'\0'
+    with open(src, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - len(marker) - 32))
+        tail = f.read()
+    start = tail.rfind(marker)
+    if start < 0 or not tail.endswith(_PNG_IEND):
+        return None
+    value = tail[start + len(marker):len(tail) - len(_PNG_IEND) - 4]
+    return int(value) if value.isdigit() else None
+
+
+def annotate_dpi(dst, src):
+    """PaddleOCR save_to_json 的结果中补上图像的DPI（并写出二进制结果）"""
+    dpi = image_dpi(src)
+    if dpi is None and not OCR_BINARY:
+        return
+    with open(dst, 'r', encoding='utf-8') as f:
+        result = json.load(f)
+    if dpi is not None:
+        result['dpi'] = dpi
+    save_ocr_json(result, dst)
+
+
+def save_ocr_json(result, dst):
+    """与PaddleOCR save_to_json 相同的字段名，load_ocr_result 可以直接读取"""
+    if not os.path.exists(os.path.dirname(dst)):
+        os.makedirs(os.path.dirname(dst))
+    with open(dst, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=4)
+    if OCR_BINARY:
+        save_ocr_binary(result, binary_result_path(dst))
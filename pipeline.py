@@ -0,0 +1,167 @@
+from flask import Flask, request, jsonify
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import fitz
+import numpy as np
+
+from data_preprocess import upload_path, receive_upload, render_page, text_layer_to_ocr, PDF_TEXT_LAYER
+from ocr import build_ocr_model, OCR_DEVICE, OCR_TILING
+from ocr_tiling import predict_tiled, result_to_dict, save_ocr_json, mark_rendered_png
+from fuzzy_match import FuzzyMatchHandwriting, FuzzyMatchPrint
+from metrics import register_metrics, span, incr
+
+app = Flask(__name__)
+register_metrics(app, 'pipeline')
+
+# 单进程流水线：预处理 -> OCR -> 匹配 在同一进程内完成，页面图像与OCR结果以内存对象传递
+# 中间结果（页面图像、OCR结果、匹配结果）写盘为可选项，由后台线程异步写入，目录结构与n8n流程相同
+PIPELINE_WRITE_FILES = os.environ.get('PIPELINE_WRITE_FILES', '1') == '1'
+
+_ocr_model = None
+# 显存只够一页推理，同一时间只有一个请求使用模型
+_ocr_lock = threading.Lock()
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """单线程写盘，任务按提交顺序执行（页面图像先于渲染结果写入）"""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = ThreadPoolExecutor(max_workers=1)
+        return _writer
+
+
+def ocr_image(image):
+    """
+    image 为图像路径或BGR数组，返回与 save_to_json 相同字段的dict
+    """
+    global _ocr_model
+    with _ocr_lock:
+        if _ocr_model is None:
+            _ocr_model = build_ocr_model(OCR_DEVICE)
+        if OCR_TILING:
+            return predict_tiled(_ocr_model, [image])[0]
+        return result_to_dict(_ocr_model.predict(image)[0])
+
+
+def _save_pixmap(pix, path, dpi):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    pix.save(path)
+    mark_rendered_png(path, dpi)
+
+
+def load_pages(uuid, mime_type, file_path, workdir='workdir', write_files=PIPELINE_WRITE_FILES):
+    """
+    返回 (任务类型, 页面迭代器)，不支持的文件类型返回 (None, None)
+    页面为 dict(image=图像路径或BGR数组, src_path=图像路径, ocr=OCR结果或None, dpi=渲染DPI或None)
+    pdf页在取下一页时才在内存中渲染，有文本层的页直接得到OCR结果；write_files 为真时页面图像异步写入 src 目录
+    """
+    main_type, sub_type = mime_type.split('/')[0], mime_type.split('/')[1]
+    if main_type == 'image':
+        return 'handwritting', iter([dict(image=file_path, src_path=file_path, ocr=None, dpi=None)])
+    if main_type != 'application' or sub_type != 'pdf':
+        return None, None
+    return 'print', _iter_pdf_pages(uuid, mime_type, file_path, workdir, write_files)
+
+
+def _iter_pdf_pages(uuid, mime_type, file_path, workdir, write_files):
+    """逐页渲染，调用方处理完一页（释放图像）后再渲染下一页，内存中只有一页图像"""
+    src_dir = os.path.dirname(upload_path(uuid, mime_type, workdir))
+    with fitz.open(file_path) as doc:
+        for i, page in enumerate(doc):
+            with span('render_page', uuid, page=i) as trace:
+                pix, dpi, lines = render_page(page, text_layer=PDF_TEXT_LAYER)
+                trace.update(text_layer=lines is not None)
+            src_path = os.path.join(src_dir, uuid + '_' + str(i) + '.png')
+            image = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+            ocr_result = None if lines is None else text_layer_to_ocr(lines, dpi, src_path)
+            if write_files:
+                get_writer().submit(_save_pixmap, pix, src_path, dpi)
+            yield dict(image=np.ascontiguousarray(image[:, :, ::-1]), src_path=src_path, ocr=ocr_result, dpi=dpi)
+
+
+def run_pipeline(uuid, mime_type, file_path, workdir='workdir', write_files=PIPELINE_WRITE_FILES,
+                 render=False, wait=False):
+    """
+    单个订单的完整处理流程，file_path 为已经写入 workdir/<uuid>/src 的上传文件
+    返回与 /fuzzy_match_print、/fuzzy_match_handwriting 相同的结果，不支持的文件类型返回None
+    write_files: 异步写入页面图像、OCR结果与匹配结果；render: 同时异步渲染结果图（需要 write_files）
+    wait: 等待写盘完成后再返回
+    """
+    task_type, page_iter = load_pages(uuid, mime_type, file_path, workdir, write_files)
+    if task_type is None:
+        return None
+    pages = list()
+    # 渲染一页、识别一页，匹配阶段不再需要图像，识别后立即释放
+    for page in page_iter:
+        if page['ocr'] is None:
+            with span('ocr_page', uuid):
+                page['ocr'] = ocr_image(page['image'])
+            page['ocr']['input_path'] = page['src_path']
+            if page['dpi'] is not None:
+                page['ocr']['dpi'] = page['dpi']
+            incr('pages_total', stage='ocr', source='model')
+        page['image'] = None
+        pages.append(page)
+
+    ocr_results = [page['ocr'] for page in pages]
+    with span('match', uuid, task_type=task_type, pages=len(pages)) as trace:
+        if task_type == 'print':
+            matcher = FuzzyMatchPrint()
+            matcher.fuzzy_match(ocr_results)
+        else:
+            matcher = FuzzyMatchHandwriting()
+            matcher.fuzzy_match(ocr_results[0])
+        output = matcher.format_output()
+        trace.update(rows=len(output['items']))
+    incr('rows_total', value=len(output['items']), task_type=task_type)
+
+    if write_files:
+        future = get_writer().submit(_write_results, matcher, task_type, pages, output, workdir, uuid, render)
+        if wait:
+            future.result()
+    return output
+
+
+def _write_results(matcher, task_type, pages, output, workdir, uuid, render):
+    """与n8n流程相同的目录结构：ocr/<页面>.json、output/output.json、render/<页面>.png"""
+    for page in pages:
+        basename = os.path.splitext(os.path.basename(page['src_path']))[0]
+        save_ocr_json(page['ocr'], os.path.join(workdir, uuid, 'ocr', basename + '.json'))
+    output_dir = os.path.join(workdir, uuid, 'output')
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(os.path.join(output_dir, 'output.json'), 'w', encoding='utf-8') as f:
+        json.dump(output, f, ensure_ascii=False, indent=4)
+    if render:
+        src_list = [page['src_path'] for page in pages]
+        matcher.render_result(src_list if task_type == 'print' else src_list[0])
+
+
+@app.route('/pipeline', methods=['POST'])
+def pipeline():
+    """
+    上传方式与 /data_preprocess 相同，直接返回匹配结果
+    ?write=0 不写中间结果，?render=1 同时生成渲染图
+    """
+    try:
+        uuid, mime_type, file_path = receive_upload()
+    except ValueError as e:
+        return str(e), 400
+    write_files = request.args.get('write', '1' if PIPELINE_WRITE_FILES else '0') == '1'
+    render = request.args.get('render', '0') == '1'
+    output = run_pipeline(uuid, mime_type, file_path, write_files=write_files, render=render and write_files)
+    if output is None:
+        return "Unsupported file format", 400
+    return jsonify(output), 200
+
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=5003)
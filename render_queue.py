@@ -0,0 +1,88 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import span
+
+# 结果图只用于调试，默认不渲染；RENDER_ON_MATCH=1 时匹配完成后自动提交渲染（后台执行，不阻塞响应）
+RENDER_ON_MATCH = os.environ.get('RENDER_ON_MATCH', '0') == '1'
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', 1))
+# 保留最近N个订单的匹配器，之后的渲染请求才能找到对应的匹配结果
+RENDER_CACHE_SIZE = int(os.environ.get('RENDER_CACHE_SIZE', 256))
+
+
+class RenderQueue:
+    """
+    结果图的后台渲染队列
+    匹配完成后按uuid登记匹配器与页面图像路径，需要时再提交渲染，状态可按uuid查询
+    匹配器引用进程内共享的订单资料索引，不能跨进程传递，所以在线程中渲染
+    """
+    def __init__(self, workers=RENDER_WORKERS, size=RENDER_CACHE_SIZE):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.size = size
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def register(self, uuid, matcher, src):
+        """
+        src 为 render_result 的参数：打印体为图像路径列表，手写为单个图像路径
+        matcher 也可以是返回匹配器的函数（匹配结果来自缓存时），渲染时才调用
+        """
+        with self.lock:
+            self.jobs[uuid] = dict(uuid=uuid, matcher=matcher, src=src, status='registered', future=None,
+                                   render_list=None, error=None)
+            self.jobs.move_to_end(uuid)
+            while len(self.jobs) > self.size:
+                self.jobs.popitem(last=False)
+
+    def submit(self, uuid):
+        """
+        提交渲染，已经提交过的直接返回原来的 Future；uuid 未登记（或已被淘汰）时返回None
+        """
+        with self.lock:
+            job = self.jobs.get(uuid)
+            if job is None:
+                return None
+            self.jobs.move_to_end(uuid)
+            if job['future'] is None:
+                job['status'] = 'pending'
+                job['future'] = self.executor.submit(self._render, job)
+            return job['future']
+
+    def _render(self, job):
+        job['status'] = 'running'
+        try:
+            with span('render', job['uuid']):
+                matcher = job['matcher']
+                if callable(matcher):
+                    matcher = matcher()
+                render_list = matcher.render_result(job['src'])
+        except Exception as e:
+            job['status'] = 'error'
+            job['error'] = repr(e)
+            raise
+        job['render_list'] = render_list if isinstance(render_list, list) else [render_list]
+        job['status'] = 'done'
+        # 渲染完成后不再需要匹配结果
+        job['matcher'] = None
+        return job['render_list']
+
+    def status(self, uuid):
+        with self.lock:
+            job = self.jobs.get(uuid)
+            if job is None:
+                return None
+            return dict(uuid=uuid, status=job['status'], render_list=job['render_list'], error=job['error'])
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_render_queue():
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = RenderQueue()
+        return _queue
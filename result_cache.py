@@ -0,0 +1,168 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+
+from fuzzy_match.catalog import file_digest
+from ocr_tiling import save_ocr_json
+from metrics import incr
+
+# 按内容hash缓存各阶段的产物：同一文件重复提交（重试、重复上传）时直接返回，不再渲染/OCR/匹配
+# key 由内容hash与影响结果的配置共同决定，配置变化后自然不命中
+RESULT_CACHE = os.environ.get('RESULT_CACHE', '1') == '1'
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR', os.path.join('workdir', '.cache'))
+# 磁盘占用上限，超过后按最近使用时间淘汰
+RESULT_CACHE_MAX_MB = int(os.environ.get('RESULT_CACHE_MAX_MB', 2048))
+# 写入时只累加本进程的估算大小，超过上限或每写入该数量的条目后才扫描整个缓存目录（包含其他进程写入的条目）
+RESULT_CACHE_SCAN_EVERY = int(os.environ.get('RESULT_CACHE_SCAN_EVERY', 256))
+# 超过上限时淘汰到上限的该比例，留出余量，避免缓存满后每次写入都扫描
+RESULT_CACHE_EVICT_TO = 0.9
+
+
+def content_key(*parts):
+    """将内容hash与配置（dict按键排序序列化）合成缓存key"""
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, (dict, list, tuple)):
+            part = json.dumps(part, sort_keys=True, ensure_ascii=False)
+        if not isinstance(part, bytes):
+            part = str(part).encode('utf-8')
+        digest.update(hashlib.sha1(part).digest())
+    return digest.hexdigest()
+
+
+def file_key(path, config):
+    return content_key(file_digest(path), config)
+
+
+def copy_file(src, dst):
+    """
+    复制而不是硬链接：workdir 中的文件可能被原地覆盖（同一uuid重新处理），不能与缓存共享inode
+    """
+    if not os.path.exists(os.path.dirname(dst)):
+        os.makedirs(os.path.dirname(dst))
+    shutil.copyfile(src, dst)
+
+
+def restore_ocr_json(cached_path, dst, input_path):
+    """缓存中的OCR结果写到 dst，input_path 改为本次请求的图像路径"""
+    with open(cached_path, 'r', encoding='utf-8') as f:
+        result = json.load(f)
+    result['input_path'] = input_path
+    save_ocr_json(result, dst)
+    return dst
+
+
+class ResultCache:
+    """
+    磁盘上的内容寻址缓存，<root>/<namespace>/<key>/ 下存放一组文件
+    写入先落到临时目录再改名，多个服务进程可以共享同一个缓存目录
+    命中时更新目录的mtime，总大小超过上限后淘汰mtime最早的条目
+    """
+    def __init__(self, root=RESULT_CACHE_DIR, max_bytes=RESULT_CACHE_MAX_MB << 20, scan_every=RESULT_CACHE_SCAN_EVERY):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.scan_every = scan_every
+        self.lock = threading.Lock()
+        # 上次扫描时的总大小加上之后本进程写入的大小；None 为还没有扫描过
+        self.size_estimate = None
+        self.puts_since_scan = 0
+
+    def entry_path(self, namespace, key):
+        return os.path.join(self.root, namespace, key)
+
+    def get(self, namespace, key):
+        """命中返回条目目录，否则返回None"""
+        path = self.entry_path(namespace, key)
+        try:
+            os.utime(path)
+        except OSError:
+            # 不存在，或刚好被其他进程淘汰
+            incr('result_cache_requests_total', namespace=namespace, result='miss')
+            return None
+        incr('result_cache_requests_total', namespace=namespace, result='hit')
+        return path
+
+    def put(self, namespace, key, files=None, data=None):
+        """
+        files: {条目内文件名: 源文件路径}，data: {条目内文件名: 可JSON序列化的对象}
+        返回条目目录
+        """
+        path = self.entry_path(namespace, key)
+        tmp_path = f'{path}.tmp-{os.getpid()}-{threading.get_ident()}'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for name, src in (files or {}).items():
+            copy_file(src, os.path.join(tmp_path, name))
+        for name, obj in (data or {}).items():
+            with open(os.path.join(tmp_path, name), 'w', encoding='utf-8') as f:
+                json.dump(obj, f, ensure_ascii=False)
+        size = sum(entry.stat().st_size for entry in os.scandir(tmp_path) if entry.is_file())
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # 其他请求已经写入了相同内容
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            size = 0
+        self.added(size)
+        return path
+
+    def added(self, size):
+        """累加写入的大小，估算超过上限或写入次数达到 scan_every 时扫描并淘汰"""
+        with self.lock:
+            if self.size_estimate is not None:
+                self.size_estimate += size
+            self.puts_since_scan += 1
+            scan = (self.size_estimate is None or self.size_estimate > self.max_bytes
+                    or self.puts_since_scan >= self.scan_every)
+        if scan:
+            self.evict()
+
+    def load_json(self, entry, name):
+        with open(os.path.join(entry, name), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _entries(self):
+        entries = list()
+        if not os.path.isdir(self.root):
+            return entries
+        for namespace in os.scandir(self.root):
+            if not namespace.is_dir():
+                continue
+            for entry in os.scandir(namespace.path):
+                if not entry.is_dir() or '.tmp-' in entry.name:
+                    continue
+                size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+                entries.append((entry.stat().st_mtime, size, entry.path))
+        return entries
+
+    def evict(self):
+        """扫描整个缓存目录，超过上限时按mtime淘汰到 RESULT_CACHE_EVICT_TO，并以扫描结果重置估算大小"""
+        with self.lock:
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            target = self.max_bytes * RESULT_CACHE_EVICT_TO if total > self.max_bytes else total
+            for _, size, path in sorted(entries):
+                if total <= target:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+            self.size_estimate = total
+            self.puts_since_scan = 0
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    """RESULT_CACHE=0 时返回None，调用方跳过缓存"""
+    global _cache
+    if not RESULT_CACHE:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultCache()
+        return _cache
@@ -1,28 +1,114 @@
-from PIL import Image
 from fuzzy_match import FuzzyMatchHandwriting
 from fuzzy_match import FuzzyMatchPrint
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, send_file
 import os
+import json
+
+from fuzzy_match.batch import match_documents, detect_task_type, start_batch_pool
+from fuzzy_match.catalog import update_catalog
+from fuzzy_match.registry import get_catalog_registry
+from fuzzy_match.fuzzy_match_print import find_customer_name
+from fuzzy_match.memo import get_query_memo
+from fuzzy_match.ocr_page import TextColumn, load_ocr_file, ocr_content_digest
+from render_queue import get_render_queue, RENDER_ON_MATCH
+from result_cache import get_result_cache, content_key
+from metrics import register_metrics, register_collector, span, incr, workdir_uuid
 
 app = Flask(__name__)
+register_metrics(app, 'fuzzy_match')
+register_collector(lambda: [('match_memo_' + key, {}, value) for key, value in get_query_memo().stats().items()])
+register_collector(lambda: [('catalog_registry_' + key, {}, value)
+                            for key, value in get_catalog_registry().stats().items()])
+
+# 匹配逻辑或输出格式变化时递增，使已有的匹配结果缓存失效
+MATCH_CACHE_VERSION = 5
+MATCHERS = {'print': FuzzyMatchPrint, 'handwritting': FuzzyMatchHandwriting}
+
+def request_uuid(json_data, ocr_path):
+    """优先取请求中的uuid，否则从 workdir/<uuid>/ocr/<页面>.json 中取"""
+    return json_data.get('uuid') or os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(ocr_path))))
+
+def trace_uuid(json_data, ocr_path):
+    """写入trace的uuid：与 request_uuid 相同，但OCR结果不在 workdir 下时为None"""
+    return json_data.get('uuid') or workdir_uuid(ocr_path)
+
+def match_cache_key(task_type, pages, customer=None):
+    """
+    只取OCR结果中影响匹配的字段（input_path 含uuid，不参与，见 ocr_page.ocr_content_digest），加上所用订单资料的版本
+    增量段合并后版本不变但分数不同（见 CatalogIndex.merge），是否带增量段也参与；
+    手写单据另加两阶段检索的配置，见 FuzzyMatchHandwriting.matching_tag
+    没有给出客户的打印体单据按单据上的客户选择订单资料，与 FuzzyMatchPrint.fuzzy_match 相同
+    """
+    Matcher = MATCHERS[task_type]
+    ocr_content = [ocr_content_digest(page) for page in pages]
+    if customer is None and task_type == 'print':
+        customer = find_customer_name(pages[0]['rec_texts'])
+    catalog = get_catalog_registry().get_catalog(customer, Matcher.split_item_name)
+    tag = Matcher.matching_tag(catalog) if task_type == 'handwritting' else None
+    return content_key(ocr_content, task_type, catalog.version, catalog.segmented, tag, MATCH_CACHE_VERSION)
+
+def run_match(task_type, pages, customer=None):
+    matcher = MATCHERS[task_type](customer=customer)
+    matcher.fuzzy_match(pages if task_type == 'print' else pages[0])
+    return matcher
+
+def match_with_cache(task_type, ocr_list, uuid=None, customer=None):
+    """
+    返回 (输出, 匹配器)；命中缓存时不做匹配，匹配器换成按需重新匹配的函数，只在请求渲染时调用
+    OCR结果有 .ocrp 时mmap读取，缓存key与匹配都直接使用其中的数组
+    """
+    with span('match', uuid, task_type=task_type) as trace:
+        with span('load_ocr'):
+            pages = [load_ocr_file(path) for path in ocr_list]
+        cache = get_result_cache()
+        key = match_cache_key(task_type, pages, customer) if cache else None
+        entry = cache.get('match', key) if cache else None
+        if entry is not None:
+            output, matcher = cache.load_json(entry, 'output.json'), lambda: run_match(task_type, pages, customer)
+        else:
+            with span('fuzzy_match'):
+                matcher = run_match(task_type, pages, customer)
+            with span('format_output'):
+                output = matcher.format_output()
+            if cache:
+                cache.put('match', key, data={'output.json': output})
+        trace.update(pages=len(pages), rows=len(output['items']), cached=entry is not None)
+        incr('rows_total', value=len(output['items']), task_type=task_type)
+    return output, matcher
+
+def write_output(ocr_path, output):
+    """结果写入 workdir/<uuid>/output/output.json"""
+    output_dir = os.path.dirname(ocr_path).replace('ocr', 'output')
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(os.path.join(output_dir, 'output.json'), 'w', encoding='utf-8') as f:
+        json.dump(output, f, ensure_ascii=False, indent=4)
+
+def register_render(json_data, uuid, matcher, src):
+    """
+    结果图改为后台渲染：登记后可以通过 /render/<uuid> 按需渲染与查询
+    请求中 render 为 true/1/"1"（没有给出时取 RENDER_ON_MATCH）或 ?render=1 时立即提交
+    """
+    queue = get_render_queue()
+    queue.register(uuid, matcher, src)
+    # 与查询参数相同只认1，"false"、"0" 之类的字符串不当作真
+    if json_data.get('render', RENDER_ON_MATCH) in (True, 1, '1') or request.args.get('render') == '1':
+        queue.submit(uuid)
 
 @app.route('/fuzzy_match_handwriting', methods=['POST'])
 def fuzzy_match_handwriting():
     json_data = request.get_json()
     ocr_list = json_data['ocr_list']
     
-    Matcher = FuzzyMatchHandwriting()
     ocr_path = ocr_list[0]
-    Matcher.fuzzy_match(ocr_path)
-    output_dir = os.path.dirname(ocr_path).replace('ocr', 'output')
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    output_path = os.path.join(output_dir, 'output.json')
-    output = Matcher.format_output(output_path)
+    uuid = request_uuid(json_data, ocr_path)
+    output, Matcher = match_with_cache('handwritting', [ocr_path], trace_uuid(json_data, ocr_path),
+                                       json_data.get('customer'))
+    write_output(ocr_path, output)
     
     src_list = json_data['src_list']
     src_path = src_list[0]
-    Matcher.render_result(src_path)
+    register_render(json_data, uuid, Matcher, src_path)
     
     return jsonify(output), 200
 
@@ -31,20 +117,154 @@ def fuzzy_match_print():
     json_data = request.get_json()
     ocr_list = json_data['ocr_list']
     
-    Matcher = FuzzyMatchPrint()
-    Matcher.fuzzy_match(ocr_list)
-    output_dir = os.path.dirname(ocr_list[0]).replace('ocr', 'output')
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    output_path = os.path.join(output_dir, 'output.json')
-    output = Matcher.format_output(output_path)
+    uuid = request_uuid(json_data, ocr_list[0])
+    output, Matcher = match_with_cache('print', ocr_list, trace_uuid(json_data, ocr_list[0]), json_data.get('customer'))
+    write_output(ocr_list[0], output)
     
     src_list = json_data['src_list']
-    Matcher.render_result(src_list)
+    register_render(json_data, uuid, Matcher, src_list)
     
     return jsonify(output), 200
 
+def batch_results(documents):
+    """
+    已缓存的单据直接返回，其余的送入批量匹配
+    .ocrp 页面只传路径，由进程池中的worker自己mmap读取；json页面传已解析的dict，避免重复解析
+    """
+    results = [None] * len(documents)
+    cache = get_result_cache()
+    keys = dict()
+    if cache is not None:
+        pending = list()
+        for i, document in enumerate(documents):
+            try:
+                ocr_list = [load_ocr_file(path) for path in document['ocr_list']]
+                task_type = document.get('task_type') or detect_task_type(ocr_list)[0]
+                keys[i] = match_cache_key(task_type, ocr_list, document.get('customer'))
+            except Exception:
+                # 读取失败的单据交给批量匹配，按单据报告错误
+                pending.append((i, document))
+                continue
+            entry = cache.get('match', keys[i])
+            if entry is not None:
+                results[i] = dict(task_type=task_type, output=cache.load_json(entry, 'output.json'))
+            else:
+                ocr_list = [path if isinstance(page['rec_texts'], TextColumn) else page
+                            for path, page in zip(document['ocr_list'], ocr_list)]
+                pending.append((i, dict(document, task_type=task_type, ocr_list=ocr_list)))
+    else:
+        pending = list(enumerate(documents))
+    for (i, _), result in zip(pending, match_documents([document for _, document in pending])):
+        if 'output' in result and i in keys:
+            cache.put('match', keys[i], data={'output.json': result['output']})
+        results[i] = result
+    for result in results:
+        if 'output' in result:
+            incr('rows_total', value=len(result['output']['items']), task_type=result['task_type'])
+    return results
+
+@app.route('/fuzzy_match_batch', methods=['POST'])
+def fuzzy_match_batch():
+    """
+    {"documents": [{"ocr_list": [...], "task_type": "print"|"handwritting"(可选), "uuid"(可选), "customer"(可选)}, ...]}
+    或 {"ocr_list": [路径 或 多页路径列表, ...]}，每一项为一张单据
+    打印体与手写可以混合，结果按输入顺序返回，每张单据的结果同样写入 output/output.json
+    """
+    json_data = request.get_json()
+    documents = json_data.get('documents')
+    if documents is None:
+        documents = [dict(ocr_list=ocr if isinstance(ocr, list) else [ocr]) for ocr in json_data.get('ocr_list', [])]
+    if not documents or any(not document.get('ocr_list') for document in documents):
+        return "Missing ocr_list", 400
+
+    with span('match_batch', documents=len(documents)):
+        results = batch_results(documents)
+
+    for document, result in zip(documents, results):
+        ocr_path = document['ocr_list'][0]
+        result['uuid'] = request_uuid(document, ocr_path)
+        if 'output' in result:
+            write_output(ocr_path, result['output'])
+    return jsonify({'results': results}), 200
+
+@app.route('/match_memo', methods=['GET'])
+def match_memo():
+    """品名查询缓存的命中率，见 fuzzy_match/memo.py"""
+    return jsonify(get_query_memo().stats()), 200
+
+@app.route('/catalog', methods=['GET'])
+def catalog_status(customer=None):
+    """?customer= 指定客户，不指定时为默认的订单资料"""
+    customer = customer or request.args.get('customer')
+    catalog = get_catalog_registry().get_catalog(customer, True)
+    return jsonify(dict(template=os.path.basename(catalog.template_path), version=catalog.version,
+                        source_sha1=catalog.source_sha1, deltas=catalog.deltas,
+                        items=len(catalog.template_items), names=len(catalog.name_to_id),
+                        segmented=catalog.segmented)), 200
+
+@app.route('/catalogs', methods=['GET'])
+def catalogs():
+    """多客户订单资料的常驻数量、内存估算、命中率与加载耗时，见 fuzzy_match/registry.py"""
+    return jsonify(get_catalog_registry().stats()), 200
+
+@app.route('/catalog/delta', methods=['POST'])
+def catalog_delta():
+    """
+    增量修改订单资料，不需要修改excel后重启：
+    {"customer": "客户代号(可选)",
+     "deltas": [{"op": "add", "id": "A001", "name": "猪皮/豬皮", "unit": "斤"},
+                {"op": "retire", "id": "A002"},
+                {"op": "rename", "id": "A003", "name": "旧品名", "new_name": "新品名"}]}
+    格式见 fuzzy_match/catalog.py apply_delta
+    """
+    json_data = request.get_json() or {}
+    deltas = json_data.get('deltas')
+    if not deltas:
+        return "Missing deltas", 400
+    registry = get_catalog_registry()
+    customer = json_data.get('customer')
+    # 客户写错时不能退回默认的订单资料，否则修改会影响所有没有单独订单资料的客户
+    if customer and registry.resolve(customer) is None:
+        return f"Unknown customer: {customer}", 400
+    try:
+        update_catalog(deltas, registry.template_path(customer))
+    except ValueError as e:
+        return str(e), 400
+    return catalog_status(json_data.get('customer'))
+
+@app.route('/render/<uuid>', methods=['POST'])
+def render(uuid):
+    """提交渲染，?wait=1 时等待渲染完成"""
+    queue = get_render_queue()
+    future = queue.submit(uuid)
+    if future is None:
+        return "Unknown uuid", 404
+    if request.args.get('wait') == '1':
+        try:
+            future.result()
+        except Exception:
+            pass
+    return jsonify(queue.status(uuid)), (200 if future.done() else 202)
+
+@app.route('/render/<uuid>', methods=['GET'])
+def render_status(uuid):
+    status = get_render_queue().status(uuid)
+    if status is None:
+        return "Unknown uuid", 404
+    return jsonify(status), 200
+
+@app.route('/render/<uuid>/<int:page>', methods=['GET'])
+def render_image(uuid, page):
+    status = get_render_queue().status(uuid)
+    if status is None or status['status'] != 'done' or page >= len(status['render_list']):
+        return "Render not available", 404
+    return send_file(os.path.abspath(status['render_list'][page]), mimetype='image/png')
+
 
 if __name__ == '__main__':
+    # 批量匹配的进程池在服务线程启动之前fork
+    # debug模式下reloader的父进程只负责监视文件、不处理请求，只在实际服务的子进程中创建
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_batch_pool()
     app.run(debug=True, host='0.0.0.0', port=5002)
     
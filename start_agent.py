@@ -1,6 +1,31 @@
 import requests
 import os
 import uuid
+import time
+
+# 设置后改为提交到任务接口（jobs.py），轮询各阶段进度，例如 http://localhost:5004/jobs
+JOBS_URL = os.environ.get('JOBS_URL')
+
+def submit_job(jobs_url, src, mime_type, uuid_str, priority=0):
+    """提交任务后长轮询状态，打印阶段进度，返回最终状态"""
+    with open(src, 'rb') as f:
+        headers = {
+            'X-UUID': uuid_str,
+            'X-Priority': str(priority),
+        }
+        while True:
+            f.seek(0)
+            response = requests.post(jobs_url, data=f, headers=dict(headers, **{'Content-Type': mime_type}))
+            if response.status_code != 429:
+                break
+            # 队列已满，按服务端建议的时间重试
+            time.sleep(int(response.headers.get('Retry-After', 5)))
+    response.raise_for_status()
+    status = response.json()
+    while status['stage'] not in ('done', 'error'):
+        status = requests.get(f"{jobs_url}/{uuid_str}", params={'wait': 30, 'version': status['version']}).json()
+        print(status['stage'], status['pages_done'], '/', status['pages_total'])
+    return status
 
 if __name__ == '__main__':
     webhook_url = 'http://localhost:5678/webhook-test/c7645656-a150-424d-bacd-f52a9f4eae30'
@@ -9,11 +34,15 @@ if __name__ == '__main__':
     # mime_type = 'image/jpg'
     
     file_ext = os.path.splitext(src)[1][1:]
-    with open(src, 'rb') as f:
-        files = {'file': (src, f, mime_type)}  # 显式指定MIME类型
-        uuid_str = str(uuid.uuid4())
-        headers = {
-            'X-UUID': uuid_str,
-        }
-        status = requests.post(webhook_url, files=files, headers=headers)
-        print(status.status_code)
\ No newline at end of file
+    if JOBS_URL:
+        status = submit_job(JOBS_URL, src, mime_type, str(uuid.uuid4()))
+        print(status['stage'], status['error'])
+    else:
+        with open(src, 'rb') as f:
+            files = {'file': (src, f, mime_type)}  # 显式指定MIME类型
+            uuid_str = str(uuid.uuid4())
+            headers = {
+                'X-UUID': uuid_str,
+            }
+            status = requests.post(webhook_url, files=files, headers=headers)
+            print(status.status_code)
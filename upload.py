@@ -0,0 +1,185 @@
+import re
+import json
+import base64
+import binascii
+
+# 上传文件按块读写，内存占用与文件大小无关
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+_WHITESPACE = b' \t\r\n'
+_QUOTE_OR_ESCAPE = re.compile(rb'["\\]')
+
+
+def copy_stream(stream, dst, chunk_size=UPLOAD_CHUNK_SIZE):
+    """按块将可读流写入文件对象，返回写入的字节数"""
+    size = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        dst.write(chunk)
+        size += len(chunk)
+    return size
+
+
+class Base64StreamWriter:
+    """
+    增量base64解码：write 接收任意切分的base64片段（可含换行），解码后写入 dst
+    不足4个字符的尾部留到下一次，close 时解码剩余部分
+    """
+    def __init__(self, dst):
+        self.dst = dst
+        self.pending = b''
+        self.size = 0
+
+    def write(self, data):
+        data = self.pending + data.translate(None, _WHITESPACE)
+        end = len(data) // 4 * 4
+        self.pending = data[end:]
+        if end:
+            self._decode(data[:end])
+
+    def _decode(self, data):
+        try:
+            decoded = base64.b64decode(data, validate=True)
+        except binascii.Error as e:
+            raise ValueError(f"base64 数据格式错误：{e}")
+        self.dst.write(decoded)
+        self.size += len(decoded)
+
+    def close(self):
+        if self.pending:
+            # 兼容省略了 '=' 的输入
+            self._decode(self.pending + b'=' * (-len(self.pending) % 4))
+            self.pending = b''
+
+
+class _StreamReader:
+    def __init__(self, stream, chunk_size):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buf = b''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, size=1):
+        """保证缓冲区中 pos 之后至少有 size 个字节（流结束时可能不足）"""
+        while len(self.buf) - self.pos < size and not self.eof:
+            chunk = self.stream.read(self.chunk_size)
+            if not chunk:
+                self.eof = True
+                break
+            self.buf = self.buf[self.pos:] + chunk
+            self.pos = 0
+        return len(self.buf) - self.pos >= size
+
+    def peek(self):
+        """跳过空白，返回下一个字节（不消费），流结束返回 b''"""
+        while True:
+            if not self.fill():
+                return b''
+            byte = self.buf[self.pos:self.pos + 1]
+            if byte not in _WHITESPACE:
+                return byte
+            self.pos += 1
+
+    def expect(self, byte):
+        if self.peek() != byte:
+            raise ValueError(f"JSON 格式错误：期望 {byte.decode()}")
+        self.pos += 1
+
+    def stream_string(self, sink):
+        """读取字符串值（起始引号已消费），反转义后分段写入 sink，不在内存中拼接整个字符串"""
+        while True:
+            if not self.fill():
+                raise ValueError("JSON 格式错误：字符串未结束")
+            match = _QUOTE_OR_ESCAPE.search(self.buf, self.pos)
+            if match is None:
+                sink(self.buf[self.pos:])
+                self.pos = len(self.buf)
+                continue
+            end = match.start()
+            if end > self.pos:
+                sink(self.buf[self.pos:end])
+            self.pos = end
+            if match.group() == b'"':
+                self.pos += 1
+                return
+            # 转义序列，\uXXXX 需要6个字节
+            self.fill(6)
+            length = 6 if self.buf[self.pos + 1:self.pos + 2] == b'u' else 2
+            escaped = self.buf[self.pos:self.pos + length]
+            self.pos += length
+            sink(json.loads(b'"' + escaped + b'"').encode('utf-8'))
+
+    def read_string(self):
+        parts = list()
+        self.stream_string(parts.append)
+        return b''.join(parts).decode('utf-8')
+
+    def read_raw_value(self):
+        """
+        读取一个任意JSON值的原始字节（对象/数组按括号深度匹配），交给 json.loads 解析
+        """
+        self.peek()
+        raw = bytearray()
+        depth, in_string, escaped = 0, False, False
+        while True:
+            if not self.fill():
+                if depth or in_string:
+                    raise ValueError("JSON 格式错误：值未结束")
+                return bytes(raw)
+            byte = self.buf[self.pos]
+            if not in_string and depth == 0 and raw and byte in b',}]':
+                return bytes(raw)
+            self.pos += 1
+            raw.append(byte)
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif byte == ord('\\'):
+                    escaped = True
+                elif byte == ord('"'):
+                    in_string = False
+                    if depth == 0:
+                        return bytes(raw)
+            elif byte == ord('"'):
+                in_string = True
+            elif byte in b'{[':
+                depth += 1
+            elif byte in b'}]':
+                depth -= 1
+                if depth == 0:
+                    return bytes(raw)
+
+
+def read_json_upload(stream, dst, field='data', chunk_size=UPLOAD_CHUNK_SIZE):
+    """
+    流式解析JSON对象请求体：field 字段的base64字符串边读边解码写入 dst，其余字段正常解析后返回
+    与 request.get_json() + base64.b64decode 相比，不会在内存中保留请求体和解码后文件的完整副本
+    返回 (其余字段, 解码后的字节数)
+    """
+    reader = _StreamReader(stream, chunk_size)
+    fields = dict()
+    size = None
+    reader.expect(b'{')
+    if reader.peek() == b'}':
+        reader.pos += 1
+        return fields, size
+    while True:
+        reader.expect(b'"')
+        key = reader.read_string()
+        reader.expect(b':')
+        if key == field and reader.peek() == b'"':
+            reader.pos += 1
+            writer = Base64StreamWriter(dst)
+            reader.stream_string(writer.write)
+            writer.close()
+            size = writer.size
+        else:
+            fields[key] = json.loads(reader.read_raw_value())
+        if reader.peek() == b',':
+            reader.pos += 1
+            continue
+        reader.expect(b'}')
+        return fields, size